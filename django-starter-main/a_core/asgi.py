@@ -19,9 +19,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'a_core.settings')
 django_asgi_app = get_asgi_application()
 
 from a_rtchat import routing
+from a_rtchat.metrics import MetricsEndpoint
 
 application = ProtocolTypeRouter({
-  "http": django_asgi_app,
+  "http": MetricsEndpoint(django_asgi_app),
   "websocket": AllowedHostsOriginValidator(
     AuthMiddlewareStack(
       URLRouter(
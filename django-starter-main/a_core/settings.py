@@ -85,6 +85,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'a_rtchat.context_processors.chat_nav',
             ],
         },
     },
@@ -99,6 +100,25 @@ CHANNEL_LAYERS = {
     }
 }   
 
+# To run several worker processes, start `python manage.py run_channel_hub`
+# and use the Unix socket layer instead:
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'a_rtchat.layers.UnixSocketChannelLayer',
+#         'CONFIG': {'path': '/tmp/chat-hub.sock'},
+#     }
+# }
+
+# Who is online in which chatroom. Switch to a_rtchat.presence.FilePresenceStore
+# when running more than one process.
+CHAT_PRESENCE = {
+    'BACKEND': 'a_rtchat.presence.InMemoryPresenceStore',
+    'TTL': 60,
+    'HEARTBEAT_INTERVAL': 20,
+    'BROADCAST_WINDOW': 0.25,
+    'OPTIONS': {},
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -162,3 +182,95 @@ ACCOUNT_AUTHENTICATION_METHOD = 'email'
 
 # Add this instead
 ACCOUNT_SIGNUP_FIELDS = ['email*', 'username*', 'password1*', 'password2*']
+
+# Cache alias and lifetime (seconds) for chatroom access-control answers.
+# Entries are invalidated on change, in the cache of the process making it.
+# With several worker processes and the default LocMemCache, answers only
+# live 5 seconds (see a_rtchat/acl.py); use a shared cache there instead.
+CHAT_ACL_CACHE = 'default'
+CHAT_ACL_TIMEOUT = 300
+
+# Cache alias and lifetime (seconds) for the per-user room index shown in the
+# header (a_rtchat/nav.py). The lifetime also bounds how stale its
+# most-recently-active ordering gets.
+CHAT_NAV_CACHE = 'default'
+CHAT_NAV_TIMEOUT = 300
+
+# Write-behind persistence for chat messages (see a_rtchat/persistence.py).
+# Disabled: every message is written before it is broadcast. With several
+# worker processes, set 'ID_FILE' (e.g. BASE_DIR / 'message_ids.sqlite3') so
+# they all take message ids from one sequence.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.05,
+    'ID_BLOCK_SIZE': 100,
+    'ID_FILE': None,
+}
+
+# Wire protocol used by the chat page: 'html' (htmx ws extension, server
+# rendered fragments) or 'json' (static/js/chat_client.js, chat.json.v1).
+# Sockets negotiate per connection, so both kinds of clients can share a room.
+CHAT_CLIENT_PROTOCOL = 'html'
+
+# Per-socket outbound queue (see a_rtchat/outbound.py)
+CHAT_OUTBOUND = {
+    'MAX_FRAMES': 256,  # frames queued for one socket before presence is dropped / the socket closed
+    'MAX_LAG': 30,      # seconds the oldest queued frame may wait before the socket is closed
+}
+
+# Token-bucket limits for new chat messages (see a_rtchat/ratelimit.py).
+# RATE is tokens per second, BURST the bucket size; None disables a scope.
+CHAT_RATE_LIMITS = {
+    'USER': {'RATE': 1, 'BURST': 10},
+    'ROOM': {'RATE': 20, 'BURST': 50},
+}
+
+# Messages per page of chat history (initial page and each infinite-scroll load)
+CHAT_HISTORY_PAGE_SIZE = 40
+
+# Per-process LRU of rendered chat messages (see a_rtchat/fragments.py)
+CHAT_FRAGMENT_CACHE = {
+    'ENABLED': True,
+    'MAX_BYTES': 16 * 1024 * 1024,
+}
+
+# Prometheus metrics of the chat sockets, served by the ASGI app (see a_rtchat/metrics.py)
+CHAT_METRICS = {
+    'PATH': '/metrics',
+    # Prometheus must send `Authorization: Bearer <TOKEN>`; None disables the endpoint
+    'TOKEN': None,
+}
+
+# Sampled span tracing of chat messages (see a_rtchat/tracing.py); read the
+# file with `python manage.py summarize_traces`
+CHAT_TRACING = {
+    'SAMPLE_RATE': 0,  # fraction of connects/messages traced, e.g. 0.01
+    'PATH': BASE_DIR / 'traces.jsonl',
+}
+
+# Catch-up of reconnecting sockets (see ChatroomConsumer.resume)
+CHAT_RESUME = {
+    'MAX_MESSAGES': 100,  # messages replayed at most; beyond that the client is told to reload
+    'WAIT': 5,            # seconds live messages wait for the client's resume frame
+}
+
+# Results per page of message search (see a_rtchat/search.py)
+CHAT_SEARCH_PAGE_SIZE = 20
+
+# Cold storage of old messages, moved there by `python manage.py archive_messages`
+# (see a_rtchat/archive.py)
+CHAT_ARCHIVE = {
+    'PATH': BASE_DIR / 'archive',
+    'AFTER_DAYS': 90,
+    'SEGMENT_MESSAGES': 5000,
+}
+
+# Resized WebP variants of uploaded avatars, made in a background thread pool
+# (see a_users/thumbnails.py); `python manage.py generate_avatar_thumbnails`
+# makes those of existing avatars
+AVATAR_THUMBNAILS = {
+    'SIZES': [32, 64, 128],
+    'QUALITY': 80,
+    'WORKERS': 2,
+}
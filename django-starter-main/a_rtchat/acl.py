@@ -0,0 +1,150 @@
+"""
+Cached access-control lookups for chatrooms.
+
+Answers "can user U join room R" without loading the room's member list:
+membership is an indexed existence check on the members through table and
+every answer is cached. Entries are dropped by the signal handlers in
+a_rtchat.signals whenever membership, the room or the user's verified
+emails change, and expire after CHAT_ACL_TIMEOUT seconds regardless.
+
+Invalidation only reaches the cache of the process that made the change.
+With several worker processes (any channel layer but the in-memory one)
+and a process-local cache (LocMemCache), other workers would let a
+removed member in until the entry expires, so answers are then kept for
+LOCAL_CACHE_TIMEOUT seconds at most. Point CHAT_ACL_CACHE at a shared
+cache to keep the full timeout.
+
+Rules (same as ChatroomConsumer.connect and chat_view):
+    - Public chat: Open to all authenticated users
+    - Private chat: Only accessible to chat members
+    - Group chat: Requires email verification and membership
+"""
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from a_rtchat.models import ChatGroup
+
+PUBLIC_CHAT = 'public-chat'
+
+# Longest lifetime of an answer cached in one of several processes only
+LOCAL_CACHE_TIMEOUT = 5
+
+_missing = object()
+
+
+def acl_cache():
+    return caches[getattr(settings, 'CHAT_ACL_CACHE', 'default')]
+
+
+def acl_timeout():
+    timeout = getattr(settings, 'CHAT_ACL_TIMEOUT', 300)
+    if isinstance(acl_cache(), LocMemCache) and multi_process():
+        return min(timeout, LOCAL_CACHE_TIMEOUT)
+    return timeout
+
+
+def multi_process():
+    """
+    True if the channel layer spans several processes, so each has its own LocMemCache.
+    """
+    backend = getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {}).get('BACKEND', '')
+    return backend != 'channels.layers.InMemoryChannelLayer'
+
+
+def room_key(chatroom_name):
+    return f'chat:acl:room:{chatroom_name}'
+
+
+def member_key(room_id, user_id):
+    return f'chat:acl:member:{room_id}:{user_id}'
+
+
+def verified_key(user_id):
+    return f'chat:acl:verified:{user_id}'
+
+
+def get_room(chatroom_name):
+    """
+    Return a small dict describing the room, or None if it doesn't exist.
+
+    Keys: id, group_name, is_private, is_public.
+    """
+    cache = acl_cache()
+    room = cache.get(room_key(chatroom_name))
+    if room is None:
+        row = ChatGroup.objects.filter(group_name=chatroom_name).values('id', 'is_private').first()
+        if row is None:
+            return None
+        room = {
+            'id': row['id'],
+            'group_name': chatroom_name,
+            'is_private': row['is_private'],
+            'is_public': chatroom_name == PUBLIC_CHAT,
+        }
+        cache.set(room_key(chatroom_name), room, acl_timeout())
+    return room
+
+
+def is_member(room_id, user_id):
+    """
+    Return True if the user is a member of the room.
+    """
+    cache = acl_cache()
+    member = cache.get(member_key(room_id, user_id), _missing)
+    if member is _missing:
+        member = ChatGroup.members.through.objects.filter(
+            chatgroup_id=room_id, user_id=user_id
+        ).exists()
+        cache.set(member_key(room_id, user_id), member, acl_timeout())
+    return member
+
+
+def is_verified(user_id):
+    """
+    Return True if the user has at least one verified email address.
+    """
+    cache = acl_cache()
+    verified = cache.get(verified_key(user_id), _missing)
+    if verified is _missing:
+        verified = EmailAddress.objects.filter(user_id=user_id, verified=True).exists()
+        cache.set(verified_key(user_id), verified, acl_timeout())
+    return verified
+
+
+def can_join(user_id, chatroom_name):
+    """
+    Check whether the user may join the chatroom.
+
+    Returns:
+        The room dict from get_room() if allowed, otherwise None.
+    """
+    room = get_room(chatroom_name)
+    if room is None:
+        return None
+
+    # 1. Public chat - accessible to everyone
+    if room['is_public']:
+        return room
+
+    # 2. Private chat (direct messages)
+    if room['is_private']:
+        return room if is_member(room['id'], user_id) else None
+
+    # 3. Group chats - need verification and membership
+    if not is_verified(user_id):
+        return None
+    return room if is_member(room['id'], user_id) else None
+
+
+def invalidate_members(room_id, user_ids):
+    acl_cache().delete_many([member_key(room_id, user_id) for user_id in user_ids])
+
+
+def invalidate_room(chatroom_name):
+    acl_cache().delete(room_key(chatroom_name))
+
+
+def invalidate_verified(user_id):
+    acl_cache().delete(verified_key(user_id))
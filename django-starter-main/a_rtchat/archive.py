@@ -0,0 +1,292 @@
+"""
+Cold storage of old chat messages in compressed per-room segment files.
+
+`python manage.py archive_messages` moves the messages older than
+AFTER_DAYS out of the GroupMessage table, so the table only holds recent
+("hot") messages and stays small however long the rooms live. Each room
+gets a directory of segments:
+
+    <PATH>/<room id>/index.json
+    <PATH>/<room id>/000001.json.gz
+    <PATH>/<room id>/000002.json.gz
+    ...
+
+A segment is a gzipped JSON list of messages, oldest first, each one
+[id, author id, created, body]. Segments are written once and never
+changed; later runs only add segments. The index lists them with the
+(created, id) keys of their first and last message, so history pages are
+served by opening the one or two segments that hold them.
+
+history_page continues into the archive once it runs out of hot
+messages, so infinite scroll reaches the first message of the room as
+before. Archived messages are no longer found by search or replayed on
+reconnect. Deleting a room deletes its directory.
+
+    CHAT_ARCHIVE = {
+        'PATH': BASE_DIR / 'archive',
+        'AFTER_DAYS': 90,          # messages older than this are archived
+        'SEGMENT_MESSAGES': 5000,  # messages per segment file at most
+    }
+"""
+import datetime
+import gzip
+import json
+import os
+import shutil
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from a_rtchat.models import GroupMessage
+
+DEFAULT_ARCHIVE = {
+    'PATH': 'archive',
+    'AFTER_DAYS': 90,
+    'SEGMENT_MESSAGES': 5000,
+}
+
+INDEX_FILE = 'index.json'
+
+# Keys are compared as strings: a fixed-width UTC timestamp sorts like the time
+_KEY_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def archive_settings():
+    return {**DEFAULT_ARCHIVE, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def room_dir(group_id):
+    return os.path.join(archive_settings()['PATH'], str(group_id))
+
+
+def format_created(created):
+    return created.astimezone(datetime.timezone.utc).strftime(_KEY_FORMAT)
+
+
+def parse_created(value):
+    return datetime.datetime.strptime(value, _KEY_FORMAT).replace(tzinfo=datetime.timezone.utc)
+
+
+def message_key(message):
+    return (format_created(message.created), message.id)
+
+
+def read_index(group_id):
+    """
+    The list of segments of a room, oldest first ([] if it has no archive).
+    """
+    try:
+        with open(os.path.join(room_dir(group_id), INDEX_FILE), encoding='utf-8') as f:
+            return json.load(f)['segments']
+    except FileNotFoundError:
+        return []
+
+
+def _write_atomic(path, data):
+    # Readers see the old file or the new one, never half of one
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+@lru_cache(maxsize=32)
+def read_segment(path):
+    """
+    The records of a segment file, oldest first.
+
+    Segments never change once written, so the last few read stay cached:
+    scrolling back through a room reads each of them once.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return tuple(tuple(record) for record in json.load(f))
+
+
+def append_segment(group_id, messages):
+    """
+    Write messages as a new segment of the room and add it to the index.
+
+    Parameters:
+        group_id: id of the ChatGroup
+        messages: GroupMessage list, oldest first
+    """
+    directory = room_dir(group_id)
+    os.makedirs(directory, exist_ok=True)
+    segments = read_index(group_id)
+    name = '%06d.json.gz' % (len(segments) + 1)
+    records = [[m.id, m.author_id, format_created(m.created), m.body] for m in messages]
+    _write_atomic(
+        os.path.join(directory, name),
+        gzip.compress(json.dumps(records, separators=(',', ':')).encode('utf-8')),
+    )
+    segments.append({
+        'file': name,
+        'count': len(records),
+        'first': [records[0][2], records[0][0]],
+        'last': [records[-1][2], records[-1][0]],
+        'min_id': min(r[0] for r in records),
+        'max_id': max(r[0] for r in records),
+    })
+    # The segment is only visible once the index names it
+    _write_atomic(
+        os.path.join(directory, INDEX_FILE),
+        json.dumps({'segments': segments}, indent=1).encode('utf-8'),
+    )
+
+
+def archived_ids(group_id, segment):
+    return {record[0] for record in read_segment(os.path.join(room_dir(group_id), segment['file']))}
+
+
+def archive_stats(group_id):
+    """
+    Count and newest record of the messages a room has in the archive.
+
+    Returns:
+        Tuple (count, record). count leaves out the messages an interrupted
+        archive_room left in the table as well, so it adds up with a count
+        of the table; record is [id, author id, created, body] of the newest
+        archived message, None if the room has no archive.
+    """
+    segments = read_index(group_id)
+    if not segments:
+        return 0, None
+    last = segments[-1]
+    hot = GroupMessage.objects.filter(group_id=group_id, id__range=(last['min_id'], last['max_id']))
+    leftovers = archived_ids(group_id, last) & set(hot.values_list('id', flat=True))
+    newest = max(segments, key=lambda segment: tuple(segment['last']))
+    records = read_segment(os.path.join(room_dir(group_id), newest['file']))
+    record = max(records, key=lambda r: (r[2], r[0]))
+    return sum(segment['count'] for segment in segments) - len(leftovers), record
+
+
+def archive_room(group_id, cutoff, segment_messages):
+    """
+    Move the messages of a room created before `cutoff` into new segments.
+
+    A segment is written and indexed before its messages are deleted, so
+    a crash in between leaves them in both places rather than in neither.
+    The next run deletes such leftovers without archiving them twice.
+
+    Returns:
+        Number of messages moved
+    """
+    segments = read_index(group_id)
+    leftovers = archived_ids(group_id, segments[-1]) if segments else set()
+    old = (
+        GroupMessage.objects
+        .filter(group_id=group_id, created__lt=cutoff)
+        .order_by('created', 'id')
+        .only('id', 'author_id', 'created', 'body')
+    )
+    moved = 0
+    while True:
+        batch = list(old[:segment_messages])
+        if not batch:
+            return moved
+        fresh = [message for message in batch if message.id not in leftovers]
+        if fresh:
+            append_segment(group_id, fresh)
+            moved += len(fresh)
+        with transaction.atomic():
+            GroupMessage.objects.filter(id__in=[message.id for message in batch]).delete()
+
+
+def archive_messages(older_than=None, segment_messages=None):
+    """
+    Archive the old messages of every room.
+
+    Parameters:
+        older_than: timedelta, AFTER_DAYS by default
+        segment_messages: messages per segment file, SEGMENT_MESSAGES by default
+
+    Returns:
+        Dict {room id: number of messages moved} of the rooms that had any
+    """
+    config = archive_settings()
+    older_than = older_than or datetime.timedelta(days=config['AFTER_DAYS'])
+    segment_messages = segment_messages or config['SEGMENT_MESSAGES']
+    cutoff = timezone.now() - older_than
+    room_ids = (
+        GroupMessage.objects
+        .filter(created__lt=cutoff)
+        .order_by('group_id')
+        .values_list('group_id', flat=True)
+        .distinct()
+    )
+    moved = {}
+    for group_id in list(room_ids):
+        moved[group_id] = archive_room(group_id, cutoff, segment_messages)
+    return moved
+
+
+def find_key(group_id, message_id):
+    """
+    The (created, id) key of an archived message, or None if it isn't archived.
+    """
+    for segment in read_index(group_id):
+        if segment['min_id'] <= message_id <= segment['max_id']:
+            for record in read_segment(os.path.join(room_dir(group_id), segment['file'])):
+                if record[0] == message_id:
+                    return (record[2], record[0])
+    return None
+
+
+def messages_before(group_id, key, limit):
+    """
+    Fetch archived messages of a room older than a key, newest first.
+
+    Segments normally cover consecutive ranges, newest last; the loop also
+    copes with overlapping ones (a late write-behind flush archived after
+    newer messages) by reading on until no unread segment can hold a
+    message newer than those kept.
+
+    Parameters:
+        group_id: id of the ChatGroup
+        key: (created string, id) to start below, or None for the newest
+        limit: maximum number of messages
+
+    Returns:
+        Tuple (messages, has_more). messages is a list of unsaved
+        GroupMessage with author and profile loaded.
+    """
+    segments = [
+        segment for segment in read_index(group_id)
+        if key is None or tuple(segment['first']) < key
+    ]
+    segments.sort(key=lambda segment: tuple(segment['last']), reverse=True)
+    directory = room_dir(group_id)
+    found = []
+    for segment in segments:
+        if len(found) > limit and tuple(segment['last']) < (found[limit][2], found[limit][0]):
+            break
+        records = read_segment(os.path.join(directory, segment['file']))
+        found.extend(r for r in records if key is None or (r[2], r[0]) < key)
+        found.sort(key=lambda r: (r[2], r[0]), reverse=True)
+    has_more = len(found) > limit
+    found = found[:limit]
+    if not found:
+        return [], has_more
+
+    authors = User.objects.select_related('profile').in_bulk({r[1] for r in found})
+    messages = []
+    for id, author_id, created, body in found:
+        if author_id not in authors:
+            continue  # Deleted users take their messages with them
+        message = GroupMessage(id=id, group_id=group_id, author_id=author_id, body=body, created=parse_created(created))
+        message.author = authors[author_id]
+        messages.append(message)
+    return messages, has_more
+
+
+def delete_room(group_id):
+    """
+    Delete every segment of a room.
+    """
+    shutil.rmtree(room_dir(group_id), ignore_errors=True)
+    read_segment.cache_clear()
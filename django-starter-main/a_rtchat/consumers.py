@@ -1,236 +1,636 @@
+import asyncio
 import json
-from channels.generic.websocket import WebsocketConsumer
-from django.shortcuts import get_object_or_404
+import time
+from urllib.parse import parse_qs
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
 from django.template.loader import render_to_string
-from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
+from a_rtchat import acl, metrics, tracing
+from a_rtchat.history import newer_messages, resume_settings
+from a_rtchat.membership import REMOVED_CLOSE_CODE, user_group
+from a_rtchat.outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, SlowConsumer, outbound_settings
 from a_rtchat.models import ChatGroup, GroupMessage
-from django.contrib.auth.models import User
+from a_rtchat.persistence import save_message
+from a_rtchat.ratelimit import get_rate_limiter
+from a_rtchat.unread import mark_read
+from a_rtchat import protocol
+from a_rtchat.presence import get_presence_coalescer, get_presence_store, presence_settings
+
+
+def join_chatroom(user, chatroom_name, connection_id):
+  """
+  Check permissions and mark the user online.
+
+  The permission check goes through the cached ACL in a_rtchat.acl, so a
+  warm connect does no queries at all and a cold one only runs indexed
+  existence checks, whatever the size of the room.
+
+  Parameters:
+      user: the authenticated user
+      chatroom_name: group_name of the chatroom
+      connection_id: unique id of the socket (its channel name)
+
+  Returns:
+      Tuple (room, came_online, online_user_ids). room is the dict returned
+      by acl.get_room(). came_online is False if the user was already online
+      (e.g. in another tab). Returns None if the user may not join the room.
+  """
+  room = acl.can_join(user.id, chatroom_name)
+  if room is None:
+    return None
+
+  presence = get_presence_store()
+  came_online = presence.connect(chatroom_name, user.id, connection_id)
+  return room, came_online, presence.online(chatroom_name)
+
+
+def create_message(user, room_id, body):
+  """
+  Persist a new chat message and render it once for the whole room.
+
+  With CHAT_WRITE_BEHIND enabled the row is only queued here; the message
+  already has its final id, so it can be broadcast right away.
+
+  The partial differs only by whether the viewer is the author, so both
+  variants are rendered here and shipped inside the group event. Subscribers
+  then just pick one; the fan-out path does no DB access or rendering.
+
+  The author is loaded with their profile for each message: the socket's
+  user object lives as long as the connection, so its cached profile would
+  keep showing the name and avatar the user had when they connected.
+
+  Returns:
+      The message_handler event to broadcast.
+  """
+  author = User.objects.select_related('profile').get(pk=user.pk)
+  with tracing.span('save_message'):
+    message = save_message(author, room_id, body)
+  with tracing.span('render'), metrics.timed(metrics.render_seconds.labels('message')):
+    html = render_message_variants(message)
+    frame = protocol.message_frame(message)
+  return {
+    'type': 'message_handler',  # This must match the method name without "_handler"
+    'message_id': message.id,
+    'author_id': user.id,
+    'html': html,
+    'json': frame,
+  }
+
+
+# Same functions, with their queries recorded per consumer event (see a_rtchat.metrics)
+tracked_join_chatroom = metrics.track_queries('connect', join_chatroom)
+tracked_create_message = metrics.track_queries('message', create_message)
+
+
+def render_message_variants(message):
+  """
+  Render a chat message as seen by its author ('own') and by everyone else ('other').
+  """
+  template = 'a_rtchat/partials/chat_message_p.html'
+  return {
+    'own': render_to_string(template, {'message': message, 'user': message.author}),
+    'other': render_to_string(template, {'message': message, 'user': None}),
+  }
+
+
+def replay_missed(user, chatroom_name, room_id, last_id, json_protocol):
+  """
+  Build the single frame that catches a reconnecting socket up.
+
+  Parameters:
+      user: the user the socket belongs to
+      chatroom_name: group_name of the chatroom
+      room_id: id of the chatroom
+      last_id: id of the newest message the client has, or None if it has none
+      json_protocol: True to build a chat.json.v1 frame instead of HTML
+
+  Returns:
+      Tuple (frame, message_ids). frame is None if nothing was missed;
+      message_ids are the messages it contains. If more than
+      CHAT_RESUME['MAX_MESSAGES'] were missed, or last_id can't be found,
+      the frame tells the client to reload the history.
+  """
+  found = newer_messages(room_id, last_id, resume_settings()['MAX_MESSAGES'])
+  messages, more = found if found is not None else ([], True)
+  if not messages and not more:
+    return None, set()
+  if json_protocol:
+    frame = protocol.replay_frame(messages, more)
+  else:
+    frame = render_to_string('a_rtchat/partials/chat_replay.html', {
+      'messages': messages,
+      'more': more,
+      'user': user,
+      'chatroom_name': chatroom_name,
+    })
+  return frame, {message.id for message in messages}
+
+
+def render_online_status(online_count, online, offline):
+  """
+  Render an online status diff: the new count plus the member dots that changed.
+
+  Only ids are needed, so this never touches the database.
+  """
+  context = {
+    'online_count': online_count,
+    'online': online,
+    'offline': offline,
+  }
+  return render_to_string('a_rtchat/partials/online_status.html', context)
+
 
-class ChatroomConsumer(WebsocketConsumer):
+async def broadcast_presence(chatroom_name, online, offline):
+  """
+  Send one coalesced presence diff to everyone in the chatroom.
+
+  Called by the PresenceCoalescer once its window for the room closes. The
+  diff is the same for every subscriber, so it is rendered once here.
+  """
+  presence = get_presence_store()
+  online_count = await sync_to_async(presence.count, thread_sensitive=False)(chatroom_name)
+  with metrics.timed(metrics.render_seconds.labels('presence')):
+    html = render_online_status(online_count, online, offline)
+    frame = protocol.presence_frame(online_count, online, offline)
+  event = {
+    'type': 'presence_handler',
+    'online': online,
+    'offline': offline,
+    'online_count': online_count,
+    'html': html,
+    'json': frame,
+  }
+  await get_channel_layer().group_send(chatroom_name, event)
+
+
+class ChatroomConsumer(AsyncWebsocketConsumer):
   """
   WebSocket consumer class for handling real-time chat functionality.
-  
-  This consumer manages WebSocket connections to chat rooms, handles message 
+
+  This consumer manages WebSocket connections to chat rooms, handles message
   sending/receiving, tracks online users, and manages security permissions.
+
+  It runs on the event loop; every piece of ORM or template work is batched
+  into a single database_sync_to_async call per event so sockets don't hold
+  a worker thread while they are idle.
+
+  Clients that request the chat.json.v1 subprotocol get compact JSON frames
+  (see a_rtchat.protocol); everyone else gets HTML fragments for htmx.
+
+  Frames go out through a bounded OutboundQueue (see a_rtchat.outbound), so
+  a client that stops reading only ever costs its own queue; it is
+  disconnected once it falls too far behind.
   """
-  
-  def connect(self):
+
+  async def connect(self):
     """
     Establish WebSocket connection with permission checks.
-    
+
     This method:
     1. Verifies user authentication
-    2. Enforces access control based on chat room type:
-       - Public chat: Open to all authenticated users
-       - Private chat: Only accessible to chat members
-       - Group chat: Requires email verification and membership
-    3. Adds user to the channel group for message broadcasting
-    4. Adds user to the online users list
-    5. Updates the online count for all users in the room
-    
+    2. Checks room permissions and marks the user online (one DB hop)
+    3. Adds the socket to the room's channel group for message broadcasting
+       and to the user's own group for events aimed at them
+    4. Queues an online status update for the room and sends this socket
+       a snapshot of who is online
+    5. Starts the heartbeat and the outbound sender tasks
+
     Returns:
         None. Accepts or closes the connection based on permissions.
     """
     self.user = self.scope['user']
+    self.room = None
+    self.heartbeat_task = None
+    self.outbound = None
+    self.sender_task = None
+    self.held = None
+    self.resume_task = None
+    self.last_read = 0
+    # Newest message id broadcast to this socket, written or not
+    self.newest_id = 0
+    self.removed = False
+    self.json_protocol = protocol.JSON_SUBPROTOCOL in self.scope.get('subprotocols', [])
     # First check if user is authenticated
     if self.user.is_anonymous:
-        self.close()
+      await self.close()
+      return
+
+    self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name']
+    with tracing.start_trace('ws.connect', room=self.chatroom_name) as trace:
+      with tracing.span('join_chatroom'):
+        joined = await database_sync_to_async(tracked_join_chatroom)(
+          self.user, self.chatroom_name, self.channel_name
+        )
+      if joined is None:
+        trace.set(denied=True)
+        await self.close()
         return
-    
-    # Get real User object (not lazy)
-    self.user = User.objects.get(pk=self.user.id)
-    
-    self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name'] 
-    self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
-    
-    # 1. Public chat - accessible to everyone
-    if self.chatroom_name == 'public-chat':
-        # No verification needed
-        pass
-        
-    # 2. Private chat (direct messages)
-    elif self.chatroom.is_private:
-        if self.user not in self.chatroom.members.all():
-            self.close()
-            return
-            
-    # 3. Group chats - need verification
-    else:
-        # Check if user is verified
-        if not self.user.emailaddress_set.filter(verified=True).exists():
-            self.close()
-            return
-            
-        # Check if user is a member
-        if self.user not in self.chatroom.members.all():
-            self.close()
-            return
-            
-    # If we reach here, the user is allowed in the chat
-    async_to_sync(self.channel_layer.group_add)(
-        self.chatroom_name,
-        self.channel_name
-    )
+      self.room, came_online, online_user_ids = joined
+      metrics.connects.inc()
+      metrics.room_joined(self.chatroom_name)
+
+      # If we reach here, the user is allowed in the chat
+      with tracing.span('group_add'):
+        await self.channel_layer.group_add(
+          self.chatroom_name,
+          self.channel_name
+        )
+        await self.channel_layer.group_add(user_group(self.user.id), self.channel_name)
+
+      config = outbound_settings()
+      self.outbound = OutboundQueue(
+        self.send_text,
+        protocol.presence_frame if self.json_protocol else render_online_status,
+        max_frames=config['MAX_FRAMES'],
+        max_lag=config['MAX_LAG'],
+        on_sent=self.message_sent,
+        on_failed=self.send_failed,
+      )
+      # A client connecting with ?resume=1 sends a resume frame first; live
+      # messages wait for it so the replay comes before them
+      if parse_qs(self.scope.get('query_string', b'').decode()).get('resume') == ['1']:
+        self.held = []
+      with tracing.span('accept'):
+        if self.json_protocol:
+          await self.accept(subprotocol=protocol.JSON_SUBPROTOCOL)
+          await self.send(text_data=protocol.hello_frame(self.user.id, online_user_ids))
+        else:
+          await self.accept()
+          await self.send(text_data=render_online_status(len(online_user_ids), online_user_ids, []))
+
+    # Started outside the trace so the long-lived tasks don't inherit it
+    if came_online:
+      self.presence_changed(online=True)
+    self.heartbeat_task = asyncio.create_task(self.heartbeat())
+    self.sender_task = asyncio.create_task(self.outbound.run())
+    if self.held is not None:
+      self.resume_task = asyncio.create_task(self.resume_timeout())
 
-    # Add user to online users
-    if self.user not in self.chatroom.users_online.all():
-        self.chatroom.users_online.add(self.user)
-        self.update_online_count()
+  async def send_text(self, text):
+    await self.send(text_data=text)
 
-    self.accept()
+  async def send_failed(self, error):
+    """
+    Close the socket once the outbound queue can no longer write to it.
+
+    Parameters:
+        error: the exception raised by the send
+
+    Returns:
+        None
+    """
+    self.outbound = None
+    try:
+      await self.close()
+    except Exception:
+      pass  # The connection is already gone
+
+  async def enqueue(self, text, presence=None, message=None):
+    """
+    Put a frame on the outbound queue, closing the socket if the client is too far behind.
 
-  def disconnect(self, close_code):
+    Parameters:
+        text: the frame to send
+        presence: (online_count, online, offline) if this is a presence diff;
+                  those may be merged or dropped, chat messages never are
+        message: data handed to message_sent once the frame is written,
+                 if this is a chat message
+
+    Returns:
+        None
+    """
+    if self.outbound is None:
+      return
+    try:
+      if presence is not None:
+        self.outbound.put_presence(*presence, text)
+      else:
+        self.outbound.put(text, data=message)
+    except SlowConsumer:
+      self.outbound = None
+      await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+  async def heartbeat(self):
+    """
+    Keep this socket's presence entry alive.
+
+    Entries expire after CHAT_PRESENCE['TTL'] seconds unless refreshed, which
+    is what clears users left online by a process that died. Users found
+    expired by the heartbeat are broadcast as gone offline.
+    """
+    presence = get_presence_store()
+    interval = presence_settings()['HEARTBEAT_INTERVAL']
+    touch = sync_to_async(presence.heartbeat, thread_sensitive=False)
+    coalescer = get_presence_coalescer()
+    while True:
+      await asyncio.sleep(interval)
+      expired = await touch(self.chatroom_name, self.user.id, self.channel_name)
+      for user_id in expired:
+        coalescer.record(self.chatroom_name, user_id, False, broadcast_presence)
+
+  async def disconnect(self, close_code):
     """
     Handle WebSocket disconnection.
-    
+
     This method:
-    1. Removes the user from the channel group
-    2. Removes the user from the online users list
-    3. Updates the online count for all remaining users
-    
+    1. Removes the socket from the room's and the user's channel groups
+    2. Removes the socket from the presence registry
+    3. Queues an online status update if that was the user's last socket
+    4. Waits for the room's pending status update to be broadcast
+
     Parameters:
         close_code: WebSocket close code
-        
+
     Returns:
         None
     """
-    async_to_sync(self.channel_layer.group_discard)(
+    if self.room is None:
+      return
+    metrics.disconnects.inc()
+    metrics.room_left(self.chatroom_name)
+    if self.heartbeat_task is not None:
+      self.heartbeat_task.cancel()
+    if self.sender_task is not None:
+      self.sender_task.cancel()
+    if self.resume_task is not None:
+      self.resume_task.cancel()
+    await self.channel_layer.group_discard(
       self.chatroom_name,
       self.channel_name
     )
-    if self.user in self.chatroom.users_online.all():
-      self.chatroom.users_online.remove(self.user)
-      self.update_online_count()
+    await self.channel_layer.group_discard(user_group(self.user.id), self.channel_name)
+    presence = get_presence_store()
+    went_offline = await sync_to_async(presence.disconnect, thread_sensitive=False)(
+      self.chatroom_name, self.user.id, self.channel_name
+    )
+    if went_offline:
+      self.presence_changed(online=False)
+    await get_presence_coalescer().wait(self.chatroom_name)
 
-  def receive(self, text_data):
+  async def receive(self, text_data):
     """
     Process incoming WebSocket messages (new chat messages).
-    
+
     This method:
-    1. Parses the JSON message data
-    2. Creates a new GroupMessage in the database
-    3. Triggers a message event to broadcast to all users in the chat
-    
+    1. Parses the JSON message data; {"type": "resume", "last_id": ...}
+       frames go to resume() and {"type": "read", "last_id": ...} frames
+       to read() instead
+    2. Checks the per-user and per-room rate limits; over-limit messages are
+       answered with an error frame carrying retry_after and dropped
+    3. Creates a new GroupMessage in the database and renders it once
+    4. Triggers a message event to broadcast to all users in the chat
+
     Parameters:
         text_data: JSON string containing the message body
-        
+
     Returns:
         None. Triggers message_handler for all users.
     """
+    received_at = time.time()
+    if self.removed:
+      return  # Frames that raced member_removed
     text_data_json = json.loads(text_data)
+    if text_data_json.get('type') == 'resume':
+      await self.resume(text_data_json.get('last_id'))
+      return
+    if text_data_json.get('type') == 'read':
+      await self.read(text_data_json.get('last_id'))
+      return
+    metrics.messages_received.inc()
     body = text_data_json['body']
-    
-    message = GroupMessage.objects.create(
-      author=self.user,
-      group=self.chatroom,
-      body=body
-    )
-    
-    # Create an event to broadcast to the group
-    event = {
-      'type': 'message_handler',  # This must match the method name without "_handler"
-      'message_id': message.id,
-    }
-
-    async_to_sync(self.channel_layer.group_send)( 
-      self.chatroom_name, event
-    )
 
-  def message_handler(self, event):
+    with tracing.start_trace('ws.receive', room=self.chatroom_name) as trace:
+      retry_after = get_rate_limiter().acquire(self.user.id, self.room['id'])
+      if retry_after:
+        metrics.messages_rate_limited.inc()
+        trace.set(rate_limited=True)
+        await self.rate_limited(retry_after)
+        return
+
+      with tracing.span('create_message'):
+        event = await database_sync_to_async(tracked_create_message)(self.user, self.room['id'], body)
+      trace.set(message_id=event['message_id'])
+      event['received_at'] = received_at
+      with tracing.span('group_send'):
+        # Subscribers continue the trace under this span
+        event['trace'] = tracing.inject()
+        await self.channel_layer.group_send(
+          self.chatroom_name, event
+        )
+    metrics.messages_broadcast.inc()
+
+  async def rate_limited(self, retry_after):
+    """
+    Tell the client its message was rejected by the rate limiter.
+
+    Parameters:
+        retry_after: seconds until a message would be accepted
+
+    Returns:
+        None
+    """
+    retry_after = round(retry_after, 2)
+    if self.json_protocol:
+      await self.enqueue(protocol.error_frame('rate_limited', retry_after=retry_after))
+      return
+    await self.enqueue(json.dumps({
+      'type': 'error',
+      'code': 'rate_limited',
+      'retry_after': retry_after,
+    }))
+
+  async def message_handler(self, event):
     """
     Handle chat message events and send to the client.
-    
-    This method:
-    1. Gets the message from the database using the message_id
-    2. Renders the message HTML using a template
-    3. Sends the rendered HTML to the WebSocket client
-    
+
+    The event already carries the rendered HTML, so this only picks the
+    variant matching the current user.
+
     Parameters:
-        event: Dict containing message_id
-        
+        event: Dict containing message_id, author_id, the 'own'/'other'
+               HTML variants, the JSON frame and, for messages sent over
+               a socket, received_at and the trace context
+
     Returns:
-        None. Sends HTML to the WebSocket client.
-    """
-    message_id = event['message_id']
-    message = GroupMessage.objects.get(id=message_id)
-    
-    context = {
-        'message': message,
-        'user': self.user  # Must be included for proper message rendering
-    }
-    
-    html = render_to_string('a_rtchat/partials/chat_message_p.html', context)
-    self.send(text_data=html)
-
-  def update_online_count(self):
-    """
-    Update and broadcast the count of online users.
-    
+        None. Sends HTML or JSON to the WebSocket client.
+    """
+    received_at = event.get('received_at')
+    self.newest_id = max(self.newest_id, event['message_id'])
+    with tracing.continue_trace(event.get('trace'), 'ws.message_handler', user=self.user.id) as span:
+      if received_at is not None:
+        span.set(since_receive_ms=round((time.time() - received_at) * 1000, 3))
+      trace = tracing.inject()
+      message = None
+      if received_at is not None or trace is not None:
+        message = (event['message_id'], received_at, trace, time.time())
+      if self.json_protocol:
+        text = event['json']
+      else:
+        variant = 'own' if event['author_id'] == self.user.id else 'other'
+        text = event['html'][variant]
+      if self.held is not None:
+        self.held.append((event['message_id'], text, message))
+        if self.outbound is not None and len(self.held) >= self.outbound.max_frames:
+          await self.release_held()
+        return
+      await self.enqueue(text, message=message)
+
+  async def resume(self, last_id):
+    """
+    Catch the client up after a reconnect, then resume live delivery.
+
     This method:
-    1. Counts users currently online in the chatroom
-    2. Creates an event with the updated count
-    3. Broadcasts the event to all users in the chatroom
-    
+    1. Loads the messages newer than last_id (one DB hop) and sends them
+       as one frame, or a "reload the history" hint if too many were missed
+    2. Sends the live messages held since connect, minus those in the replay
+
+    Parameters:
+        last_id: id of the newest message the client has, None if it has none
+
     Returns:
-        None. Triggers online_count_handler for all users.
+        None. Only the first resume of a ?resume=1 socket does anything.
+    """
+    if self.held is None:
+      return
+    if self.resume_task is not None:
+      self.resume_task.cancel()
+    try:
+      last_id = int(last_id) if last_id is not None else None
+    except (TypeError, ValueError):
+      await self.release_held()
+      return
+    with tracing.start_trace('ws.resume', room=self.chatroom_name) as trace:
+      frame, replayed = await database_sync_to_async(replay_missed)(
+        self.user, self.chatroom_name, self.room['id'], last_id, self.json_protocol
+      )
+      trace.set(replayed=len(replayed))
+      if frame is not None:
+        await self.enqueue(frame)
+      await self.release_held(replayed)
+
+  async def read(self, last_id):
     """
-    # Count how many users are currently online
-    online_count = self.chatroom.users_online.count()
+    Record that the user has read the room up to message last_id.
 
-    event = {
-      'type': 'online_count_handler',
-      'online_count': online_count
-    }
-    # Send to everyone in the chatroom
-    async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
+    Clients send this when messages are on screen; frames that don't move
+    past the last one this socket recorded cost no query.
 
-  def online_count_handler(self, event):
+    Parameters:
+        last_id: id of the newest message shown to the user
+
+    Returns:
+        None. Moves the user's ReadMarker and resets its unread counter.
     """
-    Handle online count update events and send to the client.
-    
-    This method:
-    1. Gets the online count from the event
-    2. Renders the online count HTML using a template
-    3. Sends the rendered HTML to the WebSocket client
-    
+    try:
+      last_id = int(last_id)
+    except (TypeError, ValueError):
+      return
+    if last_id <= self.last_read:
+      return
+    self.last_read = last_id
+    await database_sync_to_async(mark_read)(self.user.id, self.room['id'], last_id, self.newest_id)
+
+  async def resume_timeout(self):
+    """
+    Stop holding live messages if the resume frame doesn't come.
+    """
+    await asyncio.sleep(resume_settings()['WAIT'])
+    await self.release_held()
+
+  async def release_held(self, skip=()):
+    """
+    Queue the live messages held for the resume frame, except the ids in `skip`.
+    """
+    held, self.held = self.held, None
+    for message_id, text, message in held or ():
+      if message_id not in skip:
+        await self.enqueue(text, message=message)
+
+  def message_sent(self, data):
+    """
+    OutboundQueue callback, run once a chat message frame is written to the socket.
+
     Parameters:
-        event: Dict containing online_count
-        
+        data: (message_id, received_at, trace context, queued_at) as built
+              by message_handler
+
     Returns:
-        None. Sends HTML to the WebSocket client.
+        None. Feeds the delivery metrics and closes the trace with a
+        ws.send span covering the time in the outbound queue.
     """
-    online_count = event['online_count']
-    
-    context = {
-      'online_count': online_count,
-      'chat_group': self.chatroom,
-    }
-    html = render_to_string('a_rtchat/partials/online_count.html', context)
-    self.send(text_data=html)
+    message_id, received_at, trace, queued_at = data
+    if received_at is not None:
+      metrics.deliveries.sent(message_id, received_at)
+    if trace is not None:
+      tracing.record(trace, 'ws.send', queued_at, time.time() - queued_at)
 
-  def member_removed(self, event):
+  def presence_changed(self, online):
+    """
+    Queue this user's online/offline change for the next coalesced broadcast.
+
+    Parameters:
+        online: True if the user came online, False if they went offline
+
+    Returns:
+        None. presence_handler runs for all users once the window closes.
     """
-    Handle member removal events from the chatroom.
-    
+    get_presence_coalescer().record(self.chatroom_name, self.user.id, online, broadcast_presence)
+
+  async def presence_handler(self, event):
+    """
+    Handle coalesced online status diffs and send them to the client.
+
+    If an earlier diff is still waiting in the outbound queue, the two are
+    merged into one frame instead of queueing another.
+
+    Parameters:
+        event: Dict containing online/offline user ids, online_count and
+               the pre-rendered html and json frames
+
+    Returns:
+        None. Sends HTML or JSON to the WebSocket client.
+    """
+    await self.enqueue(
+      event['json'] if self.json_protocol else event['html'],
+      presence=(event['online_count'], event['online'], event['offline']),
+    )
+
+  async def member_removed(self, event):
+    """
+    Handle the removal of this socket's user from a chatroom.
+
+    The event arrives through the user's own channel group (see
+    a_rtchat.membership), so it concerns one of their rooms, not
+    necessarily this one.
+
     This method:
-    1. Checks if the current user is the one being removed
-    2. If so, sends a JSON message to the client to redirect to home page
-    3. The client-side JavaScript will handle the actual redirection
-    
-    This is triggered when an admin removes a user from a chatroom.
-    
+    1. Ignores removals from other rooms
+    2. Leaves the room's channel group so no more messages arrive, and
+       stops accepting frames from the client
+    3. Drops whatever is still queued for the client, sends it a redirect
+       to the home page and closes the socket with REMOVED_CLOSE_CODE
+
     Parameters:
-        event: Dict containing removed_user_id
-        
+        event: Dict containing the room's group_name
+
     Returns:
-        None. May send redirect instruction to client.
-    """
-    removed_user_id = event['removed_user_id']
-    
-    # Check if the current user is the removed one
-    if self.user.id == removed_user_id:
-        # Send a message to redirect the user
-        self.send(text_data=json.dumps({
-            'type': 'redirect',
-            'url': '/'  # Redirect to home page
-        }))
\ No newline at end of file
+        None. Sends redirect instruction to client and closes the socket.
+    """
+    if event['room'] != self.chatroom_name or self.removed:
+      return
+    self.removed = True
+    await self.channel_layer.group_discard(self.chatroom_name, self.channel_name)
+    if self.sender_task is not None:
+      self.sender_task.cancel()
+    self.outbound = None
+    if self.json_protocol:
+      await self.send(text_data=protocol.redirect_frame('/'))
+    else:
+      await self.send(text_data=json.dumps({
+        'type': 'redirect',
+        'url': '/'  # Redirect to home page
+      }))
+    await self.close(code=REMOVED_CLOSE_CODE)
@@ -0,0 +1,33 @@
+from django.utils.functional import SimpleLazyObject
+
+from a_rtchat.nav import get_room_index
+from a_rtchat.unread import unread_counts
+
+
+def room_index_with_unread(user_id):
+    """
+    The user's cached room index with the live unread counter of every room.
+
+    The index is cached but the counters change with every message, so
+    they are read fresh, in one query (see a_rtchat.unread).
+    """
+    index = get_room_index(user_id)
+    counts = unread_counts(user_id)
+    return {
+        **index,
+        'rooms': [{**room, 'unread': counts.get(room['group_name'], 0)} for room in index['rooms']],
+        'public_unread': counts.get('public-chat', 0),
+        'unread_total': sum(counts.values()),
+    }
+
+
+def chat_nav(request):
+    """
+    Add the user's cached room index (see a_rtchat.nav) with unread counters as `chat_nav`.
+
+    It is only fetched if the template actually uses it.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    return {'chat_nav': SimpleLazyObject(lambda: room_index_with_unread(user.id))}
@@ -0,0 +1,124 @@
+"""
+In-process cache of rendered chat messages.
+
+Messages can't be edited, so the HTML of a message only depends on which
+side views it ('own' for its author, 'other' for everyone else) and on the
+author's name, username and avatar. Fragments are cached under
+
+    (message id, variant, author's Profile.version)
+
+and Profile.version is bumped on every profile or username edit, so stale
+fragments are simply never asked for again and age out of the LRU.
+
+    CHAT_FRAGMENT_CACHE = {
+        'ENABLED': True,
+        'MAX_BYTES': 16 * 1024 * 1024,  # memory cap per process
+    }
+"""
+import sys
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+
+DEFAULT_FRAGMENT_CACHE = {
+    'ENABLED': True,
+    'MAX_BYTES': 16 * 1024 * 1024,
+}
+
+OWN = 'own'
+OTHER = 'other'
+
+
+class FragmentCache:
+    """
+    Thread-safe LRU of strings, bounded by their total size in memory.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (html, size)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def set(self, key, html):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (html, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.stats['evictions'] += 1
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+
+def fragment_cache_settings():
+    return {**DEFAULT_FRAGMENT_CACHE, **getattr(settings, 'CHAT_FRAGMENT_CACHE', {})}
+
+
+@lru_cache(maxsize=None)
+def get_fragment_cache():
+    """
+    Return the process-wide FragmentCache, or None if it is disabled.
+    """
+    config = fragment_cache_settings()
+    if not config['ENABLED']:
+        return None
+    return FragmentCache(config['MAX_BYTES'])
+
+
+@receiver(setting_changed)
+def reset_fragment_cache(setting, **kwargs):
+    if setting == 'CHAT_FRAGMENT_CACHE':
+        get_fragment_cache.cache_clear()
+
+
+def render_message(message, variant):
+    """
+    Return the HTML of a_rtchat/chat_message.html for a message, cached.
+
+    Parameters:
+        message: a saved GroupMessage with author and author.profile loaded
+        variant: OWN or OTHER
+
+    Returns:
+        The HTML string
+    """
+    cache = get_fragment_cache()
+    if cache is None:
+        return _render(message, variant)
+    key = (message.id, variant, message.author.profile.version)
+    html = cache.get(key)
+    if html is None:
+        html = _render(message, variant)
+        cache.set(key, html)
+    return html
+
+
+def _render(message, variant):
+    user = message.author if variant == OWN else None
+    return render_to_string('a_rtchat/chat_message.html', {'message': message, 'user': user})
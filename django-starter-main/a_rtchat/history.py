@@ -0,0 +1,126 @@
+"""
+Keyset pagination over a chatroom's messages.
+
+Pages are addressed by the id of the oldest message already shown rather
+than by an offset, so fetching page 1000 costs the same as page 1: the
+(group, created, id) index is entered right at the cursor and read
+backwards for one page.
+
+    CHAT_HISTORY_PAGE_SIZE = 40
+
+Once a room's messages in the table run out, pages continue into its
+archive segments (see a_rtchat.archive) with the same cursors.
+
+It also finds what a reconnecting socket missed (see ChatroomConsumer.resume):
+
+    CHAT_RESUME = {
+        'MAX_MESSAGES': 100,  # replayed at most; beyond that the client is told to reload
+        'WAIT': 5,            # seconds live messages are held for the resume frame
+    }
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from a_rtchat import archive
+from a_rtchat.models import GroupMessage
+
+DEFAULT_PAGE_SIZE = 40
+
+DEFAULT_RESUME = {
+    'MAX_MESSAGES': 100,
+    'WAIT': 5,
+}
+
+
+def page_size():
+    return getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def resume_settings():
+    return {**DEFAULT_RESUME, **getattr(settings, 'CHAT_RESUME', {})}
+
+
+def history_queryset(group_id, before=None):
+    """
+    Messages of the chatroom older than message `before` (all if None), newest first.
+    """
+    messages = (
+        GroupMessage.objects
+        .filter(group_id=group_id)
+        .select_related('author__profile')
+        .order_by('-created', '-id')
+    )
+    if before is not None:
+        cursor = GroupMessage.objects.filter(id=before, group_id=group_id).values('created')[:1]
+        messages = messages.filter(created__lte=cursor).exclude(Q(created=cursor) & Q(id__gte=before))
+    return messages
+
+
+def history_page(group_id, before=None, size=None):
+    """
+    Fetch one page of a chatroom's messages, newest first.
+
+    Messages are ordered by (created, id); the id breaks ties between
+    messages created in the same instant. Author and profile come along in
+    the same query. A page that runs past the oldest message in the table
+    is filled up from the room's archive.
+
+    Parameters:
+        group_id: id of the ChatGroup
+        before: id of the oldest message already shown, or None for the newest page
+        size: messages per page, CHAT_HISTORY_PAGE_SIZE by default
+
+    Returns:
+        Tuple (messages, has_more). messages is a list, newest first;
+        has_more tells whether older messages exist.
+    """
+    size = size or page_size()
+    messages = list(history_queryset(group_id, before)[:size + 1])
+    if len(messages) > size:
+        return messages[:size], True
+    if not archive.read_index(group_id):
+        return messages, False
+
+    # Continue below the oldest message shown, which may itself be archived
+    if messages:
+        key = archive.message_key(messages[-1])
+    elif before is None:
+        key = None
+    else:
+        created = GroupMessage.objects.filter(id=before, group_id=group_id).values_list('created', flat=True).first()
+        key = (archive.format_created(created), before) if created else archive.find_key(group_id, before)
+        if key is None:
+            return [], False
+    archived, has_more = archive.messages_before(group_id, key, size - len(messages))
+    return messages + archived, has_more
+
+
+def newer_messages(group_id, after, limit):
+    """
+    Fetch the messages of a chatroom that came after a given one, oldest first.
+
+    Used to catch a reconnecting socket up with what it missed. If more
+    than `limit` messages are newer, only the newest `limit` are returned.
+
+    Parameters:
+        group_id: id of the ChatGroup
+        after: id of the last message the client has, or None for all of them
+        limit: maximum number of messages to return
+
+    Returns:
+        Tuple (messages, truncated), or None if `after` is not a message of
+        the chatroom (e.g. it was deleted) so the gap can't be located.
+    """
+    messages = (
+        GroupMessage.objects
+        .filter(group_id=group_id)
+        .select_related('author__profile')
+        .order_by('-created', '-id')
+    )
+    if after is not None:
+        cursor = GroupMessage.objects.filter(id=after, group_id=group_id).values_list('created', flat=True).first()
+        if cursor is None:
+            return None
+        messages = messages.filter(created__gte=cursor).exclude(created=cursor, id__lte=after)
+    messages = list(messages[:limit + 1])
+    return messages[:limit][::-1], len(messages) > limit
@@ -0,0 +1,354 @@
+"""
+Channel layer for running the chat on several local worker processes.
+
+InMemoryChannelLayer only reaches sockets of its own process. This layer
+connects every worker to a small hub process over a Unix domain socket; the
+hub owns group membership and forwards group_send/send to the workers that
+hold the target channels. No external broker is needed.
+
+Start the hub once per host, then point every worker at the same path:
+
+    python manage.py run_channel_hub
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'a_rtchat.layers.UnixSocketChannelLayer',
+            'CONFIG': {'path': '/tmp/chat-hub.sock'},
+        }
+    }
+
+Wire format: every frame is a 4-byte big-endian length followed by a JSON
+object, so messages must be JSON serialisable. A group_send costs one frame
+to the hub and one frame per worker that has members in the group, however
+many sockets that worker holds.
+
+The hub never waits on a worker while routing: deliveries go on the
+worker's own bounded queue and a writer task per worker sends them. A
+worker whose queue fills up, or whose socket takes longer than
+DRAIN_TIMEOUT to accept a frame, is disconnected; it reconnects and
+re-registers its groups like after any other lost connection.
+"""
+import asyncio
+import json
+import os
+import struct
+import uuid
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+HEADER = struct.Struct('!I')
+DEFAULT_PATH = '/tmp/chat-hub.sock'
+# Deliveries waiting for one worker before it counts as stuck
+MAX_PENDING = 10000
+# Seconds a worker's socket may take to accept a frame
+DRAIN_TIMEOUT = 5
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+def write_frame(writer, frame):
+    payload = json.dumps(frame, separators=(',', ':')).encode()
+    writer.write(HEADER.pack(len(payload)) + payload)
+
+
+class _Listener:
+    """
+    The delivering connection of one worker, with its queue and writer task.
+    """
+
+    def __init__(self, writer, max_pending):
+        self.writer = writer
+        self.queue = asyncio.Queue(max_pending)
+        self.task = None
+
+
+class ChannelHub:
+    """
+    The hub process: tracks group membership and routes messages to workers.
+
+    A worker may open several connections (one per event loop it uses). The
+    one that sent 'listen' receives the deliveries for that worker; the
+    others are only used to publish.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_pending=MAX_PENDING, drain_timeout=DRAIN_TIMEOUT):
+        self.path = path
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self.listeners = {}  # worker id -> _Listener
+        self.groups = defaultdict(dict)  # group -> {channel: worker id}
+
+    async def serve(self, ready=None):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def run(self, ready=None):
+        asyncio.run(self.serve(ready))
+
+    async def handle(self, reader, writer):
+        worker = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                op = frame['op']
+                if op == 'hello':
+                    worker = frame['worker']
+                elif op == 'listen':
+                    self.listen(worker, writer)
+                elif op == 'group_add':
+                    self.groups[frame['group']][frame['channel']] = worker
+                elif op == 'group_discard':
+                    members = self.groups.get(frame['group'])
+                    if members is not None:
+                        members.pop(frame['channel'], None)
+                        if not members:
+                            del self.groups[frame['group']]
+                elif op == 'group_send':
+                    self.group_send(frame['group'], frame['message'])
+                elif op == 'send':
+                    self.deliver(worker_of(frame['channel']), [frame['channel']], frame['message'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            listener = self.listeners.get(worker)
+            if listener is not None and listener.writer is writer:
+                self.drop_worker(worker)
+            writer.close()
+
+    def listen(self, worker, writer):
+        previous = self.listeners.get(worker)
+        if previous is not None:
+            previous.task.cancel()
+        listener = self.listeners[worker] = _Listener(writer, self.max_pending)
+        listener.task = asyncio.create_task(self._write_deliveries(worker, listener))
+
+    def group_send(self, group, message):
+        by_worker = defaultdict(list)
+        for channel, worker in self.groups.get(group, {}).items():
+            by_worker[worker].append(channel)
+        for worker, channels in by_worker.items():
+            self.deliver(worker, channels, message)
+
+    def deliver(self, worker, channels, message):
+        """
+        Queue a delivery for a worker without waiting for it.
+        """
+        listener = self.listeners.get(worker)
+        if listener is None or listener.writer.is_closing():
+            return
+        try:
+            listener.queue.put_nowait({'op': 'deliver', 'channels': channels, 'message': message})
+        except asyncio.QueueFull:
+            self.drop_worker(worker)
+
+    async def _write_deliveries(self, worker, listener):
+        try:
+            while True:
+                frame = await listener.queue.get()
+                write_frame(listener.writer, frame)
+                await asyncio.wait_for(listener.writer.drain(), self.drain_timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            if self.listeners.get(worker) is listener:
+                self.drop_worker(worker)
+
+    def drop_worker(self, worker):
+        """
+        Forget a worker that went away or got stuck, including its group memberships.
+        """
+        listener = self.listeners.pop(worker)
+        listener.writer.close()
+        if listener.task is not asyncio.current_task():
+            listener.task.cancel()
+        for group in list(self.groups):
+            members = self.groups[group]
+            for channel in [c for c, w in members.items() if w == worker]:
+                del members[channel]
+            if not members:
+                del self.groups[group]
+
+
+def worker_of(channel):
+    """
+    Extract the worker id from a channel name made by UnixSocketChannelLayer.new_channel.
+    """
+    return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+
+class _HubConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reader_task = None
+
+    @property
+    def alive(self):
+        return not self.writer.is_closing() and (self.reader_task is None or not self.reader_task.done())
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer that talks to a ChannelHub over a Unix domain socket.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path=DEFAULT_PATH, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.channels = {}  # channel -> asyncio.Queue, on the listening loop
+        self.receivers = defaultdict(int)  # channel -> pending receive() calls
+        self.memberships = defaultdict(set)  # channel -> groups, re-registered after a reconnect
+        self._connections = {}  # event loop -> _HubConnection
+        self._connect_locks = {}  # event loop -> asyncio.Lock
+        self._listen_loop = None
+
+    # Connection handling
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is not None and connection.alive:
+            return connection
+
+        lock = self._connect_locks.get(loop)
+        if lock is None:
+            lock = self._connect_locks[loop] = asyncio.Lock()
+        async with lock:
+            connection = self._connections.get(loop)
+            if connection is not None and connection.alive:
+                return connection
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            connection = _HubConnection(reader, writer)
+            # Forget connections of event loops that are gone (e.g. async_to_sync calls)
+            self._connections = {l: c for l, c in self._connections.items() if not l.is_closed()}
+            self._connect_locks = {l: k for l, k in self._connect_locks.items() if not l.is_closed()}
+            self._connections[loop] = connection
+            write_frame(writer, {'op': 'hello', 'worker': self.worker_id})
+            if loop is self._listen_loop:
+                self._start_listening(connection)
+            await writer.drain()
+            return connection
+
+    def _start_listening(self, connection):
+        write_frame(connection.writer, {'op': 'listen'})
+        for channel, groups in self.memberships.items():
+            for group in groups:
+                write_frame(connection.writer, {'op': 'group_add', 'group': group, 'channel': channel})
+        connection.reader_task = asyncio.create_task(self._read_deliveries(connection))
+
+    async def _read_deliveries(self, connection):
+        try:
+            while True:
+                frame = await read_frame(connection.reader)
+                for channel in frame['channels']:
+                    queue = self.channels.get(channel)
+                    if queue is None:
+                        if channel not in self.receivers and channel not in self.memberships:
+                            continue  # Discarded while the frame was on its way
+                        queue = self._queue(channel)
+                    try:
+                        queue.put_nowait(frame['message'])
+                    except asyncio.QueueFull:
+                        pass  # Same as the other layers: full channels drop group messages
+        except (asyncio.IncompleteReadError, ConnectionError):
+            connection.writer.close()
+
+    async def _publish(self, frame):
+        connection = await self._connection()
+        write_frame(connection.writer, frame)
+        await connection.writer.drain()
+
+    def _queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(self.get_capacity(channel))
+        return queue
+
+    def _forget_channel(self, channel):
+        """
+        Drop the local queue of a channel nobody can reach or read anymore.
+        """
+        queue = self.channels.get(channel)
+        if (
+            queue is not None and queue.empty()
+            and channel not in self.receivers and channel not in self.memberships
+        ):
+            del self.channels[channel]
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}{self.worker_id}!{uuid.uuid4().hex[:12]}'
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        queue = self.channels.get(channel)
+        if queue is not None and queue.full():
+            raise ChannelFull(channel)
+        await self._publish({'op': 'send', 'channel': channel, 'message': message})
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        loop = asyncio.get_running_loop()
+        if self._listen_loop is None or self._listen_loop.is_closed():
+            self._listen_loop = loop
+            self.channels = {}
+            connection = self._connections.get(loop)
+            if connection is not None and connection.alive:
+                self._start_listening(connection)
+        # (Re)connects if needed; the listening connection starts reading on connect
+        await self._connection()
+        self.receivers[channel] += 1
+        try:
+            return await self._queue(channel).get()
+        finally:
+            self.receivers[channel] -= 1
+            if not self.receivers[channel]:
+                del self.receivers[channel]
+                self._forget_channel(channel)
+
+    async def flush(self):
+        self.channels = {}
+        self.memberships = defaultdict(set)
+
+    async def close(self):
+        for connection in self._connections.values():
+            connection.writer.close()
+        self._connections = {}
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.memberships[channel].add(group)
+        await self._publish({'op': 'group_add', 'group': group, 'channel': channel})
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        groups = self.memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.memberships[channel]
+        self._forget_channel(channel)
+        await self._publish({'op': 'group_discard', 'group': group, 'channel': channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self._publish({'op': 'group_send', 'group': group, 'message': message})
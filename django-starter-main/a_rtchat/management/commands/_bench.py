@@ -0,0 +1,110 @@
+"""
+Shared helpers for the benchmark management commands.
+
+Benchmarks never touch the configured database: they run against a
+throwaway copy created the same way the test runner does it.
+"""
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.db import connection
+from django.urls import path
+from django.test.utils import override_settings
+
+
+@contextmanager
+def bench_database():
+    """
+    Create a fresh, migrated test database for the duration of the block.
+
+    SQLite test databases are normally in-memory; benchmarks use an on-disk
+    file instead so the numbers reflect the real SQLite configuration.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='chat-bench-')
+    settings_dict = connection.settings_dict
+    old_test = settings_dict.get('TEST', {})
+    if connection.vendor == 'sqlite':
+        settings_dict['TEST'] = {**old_test, 'NAME': os.path.join(tmpdir, 'bench.sqlite3')}
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        # Large channel capacity so a benchmark never trips ChannelFull,
+        # and no rate limits so it can send as fast as it likes
+        with override_settings(CHANNEL_LAYERS={
+            'default': {
+                'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                'CONFIG': {'capacity': 100000},
+            }
+        }, CHAT_RATE_LIMITS={'USER': None, 'ROOM': None}):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        settings_dict['TEST'] = old_test
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def create_users(count, prefix='bench'):
+    """
+    Create `count` users (and their profiles, through the post_save signal).
+    """
+    return [User.objects.create(username=f'{prefix}{i}') for i in range(count)]
+
+
+def communicator(consumer, user, chatroom_name):
+    """
+    Build a WebsocketCommunicator for `consumer` connected as `user`.
+    """
+    app = URLRouter([path('ws/chatroom/<chatroom_name>', consumer.as_asgi())])
+    comm = WebsocketCommunicator(app, f'/ws/chatroom/{chatroom_name}')
+    comm.scope['user'] = user
+    return comm
+
+
+async def drain(comm, idle=0.05):
+    """
+    Discard every frame the communicator has queued until it goes quiet.
+    """
+    while not await comm.receive_nothing(timeout=idle):
+        await comm.receive_output()
+
+
+def percentiles(samples):
+    """
+    p50/p90/p99/max of a list of seconds, in milliseconds.
+    """
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def pick(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 3)
+
+    return {
+        'count': len(samples),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': round(samples[-1] * 1000, 3),
+    }
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else float('inf')
+
+
+class Timer:
+    """
+    Tiny context manager measuring wall-clock seconds.
+    """
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,83 @@
+"""
+The thread-based chat consumer, kept as the baseline of bench_consumer.
+
+This is ChatroomConsumer as it was before it moved to the event loop: every
+event runs in the worker threadpool, channel layer calls are wrapped in
+async_to_sync, and each subscriber fetches and renders every message
+itself. It is not routed; only connect, receive and the fan-out that the
+benchmark measures are kept.
+"""
+import json
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import WebsocketConsumer
+from django.contrib.auth.models import User
+from django.shortcuts import get_object_or_404
+from django.template.loader import render_to_string
+
+from a_rtchat.models import ChatGroup, GroupMessage
+from a_rtchat.presence import get_presence_store
+
+
+class SyncChatroomConsumer(WebsocketConsumer):
+
+    def connect(self):
+        self.user = self.scope['user']
+        if self.user.is_anonymous:
+            self.close()
+            return
+
+        # Get real User object (not lazy)
+        self.user = User.objects.get(pk=self.user.id)
+
+        self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name']
+        self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
+
+        if self.chatroom_name != 'public-chat':
+            if not self.chatroom.is_private and not self.user.emailaddress_set.filter(verified=True).exists():
+                self.close()
+                return
+            if self.user not in self.chatroom.members.all():
+                self.close()
+                return
+
+        async_to_sync(self.channel_layer.group_add)(self.chatroom_name, self.channel_name)
+
+        # No heartbeats: entries expire after the TTL
+        if get_presence_store().connect(self.chatroom_name, self.user.id, self.channel_name):
+            self.update_online_count()
+
+        self.accept()
+
+    def disconnect(self, close_code):
+        async_to_sync(self.channel_layer.group_discard)(self.chatroom_name, self.channel_name)
+        if get_presence_store().disconnect(self.chatroom_name, self.user.id, self.channel_name):
+            self.update_online_count()
+
+    def receive(self, text_data):
+        body = json.loads(text_data)['body']
+        message = GroupMessage.objects.create(author=self.user, group=self.chatroom, body=body)
+        async_to_sync(self.channel_layer.group_send)(
+            self.chatroom_name, {'type': 'message_handler', 'message_id': message.id}
+        )
+
+    def message_handler(self, event):
+        message = GroupMessage.objects.get(id=event['message_id'])
+        context = {'message': message, 'user': self.user}
+        self.send(text_data=render_to_string('a_rtchat/partials/chat_message_p.html', context))
+
+    def update_online_count(self):
+        online_user_ids = get_presence_store().online(self.chatroom_name)
+        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, {
+            'type': 'online_count_handler',
+            'online_count': len(online_user_ids),
+            'online_user_ids': list(online_user_ids),
+        })
+
+    def online_count_handler(self, event):
+        context = {
+            'online_count': event['online_count'],
+            'online_user_ids': set(event['online_user_ids']),
+            'chat_group': self.chatroom,
+        }
+        self.send(text_data=render_to_string('a_rtchat/partials/online_count.html', context))
@@ -0,0 +1,29 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from a_rtchat.archive import archive_messages, archive_settings
+
+
+class Command(BaseCommand):
+    help = 'Move old chat messages out of the database into compressed per-room archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, help="Age in days, CHAT_ARCHIVE['AFTER_DAYS'] by default")
+        parser.add_argument('--segment-messages', type=int, help='Messages per segment file at most')
+        parser.add_argument('--vacuum', action='store_true', help='Give the freed pages back to the file system (SQLite)')
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        moved = archive_messages(
+            older_than=datetime.timedelta(days=older_than) if older_than is not None else None,
+            segment_messages=options['segment_messages'],
+        )
+        self.stdout.write(
+            f"Archived {sum(moved.values())} messages of {len(moved)} chatrooms to {archive_settings()['PATH']}"
+        )
+        # Deleted rows leave free pages in the SQLite file until it is vacuumed
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
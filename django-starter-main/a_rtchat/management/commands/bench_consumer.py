@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from a_rtchat.consumers import ChatroomConsumer
+from a_rtchat.models import ChatGroup
+from ._bench import Timer, bench_database, communicator, create_users, drain, rate
+from ._sync_consumer import SyncChatroomConsumer
+
+
+class Command(BaseCommand):
+    help = 'Compare connections/s and messages/s per process for the async and sync chat consumers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=100, help='Sockets connected to the room')
+        parser.add_argument('--messages', type=int, default=50, help='Messages sent by one client')
+
+    def handle(self, *args, **options):
+        consumers = [('sync', SyncChatroomConsumer), ('async', ChatroomConsumer)]
+        with bench_database():
+            users = create_users(options['clients'])
+            ChatGroup.objects.get_or_create(group_name='public-chat')
+            for label, consumer in consumers:
+                result = async_to_sync(self.run)(consumer, users, options['messages'])
+                self.stdout.write(
+                    f"{label:>5}: {result['connects_per_sec']:8.1f} connects/s  "
+                    f"{result['messages_per_sec']:8.1f} messages/s  "
+                    f"{result['deliveries_per_sec']:9.1f} deliveries/s"
+                )
+
+    async def run(self, consumer, users, message_count):
+        """
+        Connect every user to the public chat, then have the first one send
+        `message_count` messages and wait until every socket received them all.
+        """
+        comms = [communicator(consumer, user, 'public-chat') for user in users]
+
+        with Timer() as connect_timer:
+            for comm in comms:
+                connected, _ = await comm.connect(timeout=30)
+                assert connected
+        for comm in comms:
+            await drain(comm)
+
+        async def collect(comm):
+            received = 0
+            while received < message_count:
+                frame = await comm.receive_from(timeout=60)
+                if 'chat_messages' in frame:
+                    received += 1
+
+        with Timer() as message_timer:
+            for i in range(message_count):
+                await comms[0].send_to(text_data=json.dumps({'body': f'message {i}'}))
+            await asyncio.gather(*(collect(comm) for comm in comms))
+
+        for comm in comms:
+            await comm.disconnect()
+
+        return {
+            'connects_per_sec': rate(len(comms), connect_timer.elapsed),
+            'messages_per_sec': rate(message_count, message_timer.elapsed),
+            'deliveries_per_sec': rate(message_count * len(comms), message_timer.elapsed),
+        }
@@ -0,0 +1,76 @@
+import random
+
+from allauth.account.models import EmailAddress
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from a_rtchat.fragments import OTHER, OWN, fragment_cache_settings, get_fragment_cache, render_message
+from a_rtchat.history import history_page
+from a_rtchat.models import ChatGroup
+from a_rtchat.persistence import save_message
+from a_rtchat.views import chat_view
+from ._bench import Timer, bench_database, create_users
+
+
+class Command(BaseCommand):
+    help = 'Report fragment cache hit rate and chat_view render time with and without it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--messages', type=int, default=60, help='Messages per room')
+        parser.add_argument('--page-loads', type=int, default=500)
+        parser.add_argument('--profile-edits', type=int, default=5, help='Profile edits spread over the run')
+
+    def handle(self, *args, **options):
+        with bench_database():
+            users = create_users(options['users'])
+            # Group chats need a verified email
+            EmailAddress.objects.bulk_create([
+                EmailAddress(user=user, email=f'{user.username}@example.com', verified=True, primary=True)
+                for user in users
+            ])
+            rooms = [ChatGroup.objects.create(groupchat_name=f'room {i}') for i in range(options['rooms'])]
+            for room in rooms:
+                room.members.add(*users)
+                for i in range(options['messages']):
+                    save_message(random.choice(users), room.id, f'message {i} in {room.groupchat_name}')
+
+            loads = [(random.choice(users), random.choice(rooms)) for _ in range(options['page_loads'])]
+            edit_every = options['page_loads'] // (options['profile_edits'] + 1)
+            pages = {room.id: history_page(room.id)[0] for room in rooms}
+
+            for label, enabled in (('uncached', False), ('cached', True)):
+                config = {**fragment_cache_settings(), 'ENABLED': enabled}
+                with override_settings(CHAT_FRAGMENT_CACHE=config):
+                    random.seed(0)
+                    with Timer() as t:
+                        self.run(loads, users, edit_every)
+                    line = f'{label:>9}: {t.elapsed / len(loads) * 1000:7.2f} ms/page'
+                    cache = get_fragment_cache()
+                    if cache is not None:
+                        line += (
+                            f'  hit rate {cache.hit_rate():.1%}'
+                            f'  ({cache.stats["hits"]} hits, {cache.stats["misses"]} misses,'
+                            f' {cache.stats["evictions"]} evictions, {cache.size / 1024:.0f} KiB)'
+                        )
+                    self.stdout.write(line)
+
+                    with Timer() as t:
+                        for user, room in loads:
+                            for message in pages[room.id]:
+                                render_message(message, OWN if message.author_id == user.id else OTHER)
+                    self.stdout.write(f'{"":>9}  {t.elapsed / len(loads) * 1000:7.2f} ms/page rendering messages only')
+
+    def run(self, loads, users, edit_every):
+        factory = RequestFactory()
+        for i, (user, room) in enumerate(loads):
+            if edit_every and i and i % edit_every == 0:
+                profile = random.choice(users).profile
+                profile.displayname = f'name {i}'
+                profile.save()
+            request = factory.get(f'/chat/room/{room.group_name}')
+            request.user = user
+            request.htmx = False
+            chat_view(request, room.group_name)
@@ -0,0 +1,77 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from a_rtchat.history import history_page, history_queryset
+from a_rtchat.models import ChatGroup, GroupMessage
+from ._bench import Timer, bench_database, create_users
+
+
+class Command(BaseCommand):
+    help = 'Time the first and a deep page of chat history on a large room, keyset vs OFFSET'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000_000)
+        parser.add_argument('--page', type=int, default=1000, help='Deep page to time')
+        parser.add_argument('--page-size', type=int, default=40)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        size = options['page_size']
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench_history fills the room with SQLite specific SQL')
+        with bench_database():
+            author = create_users(1)[0]
+            room = ChatGroup.objects.create()
+            with Timer() as t:
+                self.fill(room, author, options['messages'])
+            self.stdout.write(f'inserted {options["messages"]} messages in {t.elapsed:.1f}s')
+
+            # The cursor for page N is the oldest message of page N - 1
+            offset = size * (options['page'] - 1)
+            cursor = (
+                GroupMessage.objects.filter(group=room).order_by('-created', '-id')
+                .values_list('id', flat=True)[offset - 1]
+            )
+
+            for label, run in (
+                ('keyset page 1', lambda: history_page(room.id, size=size)),
+                (f'keyset page {options["page"]}', lambda: history_page(room.id, before=cursor, size=size)),
+                (f'offset page {options["page"]}', lambda: self.offset_page(room, offset, size)),
+            ):
+                self.stdout.write(f'{label:20s} {self.time(run, options["repeat"]) * 1000:8.2f} ms')
+
+            sql, params = history_queryset(room.id, before=cursor)[:size].query.sql_with_params()
+            with connection.cursor() as db:
+                db.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                for row in db.fetchall():
+                    self.stdout.write(f'  plan: {row[-1]}')
+
+    def fill(self, room, author, count):
+        start = timezone.now() - datetime.timedelta(seconds=count)
+        # Generated inside SQLite; building 10M model instances would take longer than the benchmark
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq LIMIT %s)
+                INSERT INTO {GroupMessage._meta.db_table} (group_id, author_id, body, created)
+                SELECT %s, %s, 'message ' || x, strftime('%%Y-%%m-%%d %%H:%%M:%%f', %s, '+' || x || ' seconds')
+                FROM seq
+                """,
+                [count, room.id, author.id, start.strftime('%Y-%m-%d %H:%M:%S')],
+            )
+
+    def offset_page(self, room, offset, size):
+        return list(
+            GroupMessage.objects.filter(group=room).select_related('author__profile')
+            .order_by('-created', '-id')[offset:offset + size]
+        )
+
+    def time(self, run, repeat):
+        run()  # warm up
+        with Timer() as t:
+            for _ in range(repeat):
+                run()
+        return t.elapsed / repeat
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from a_rtchat.models import ChatGroup, GroupMessage
+from a_rtchat.persistence import get_message_writer, save_message, write_behind_settings
+from ._bench import Timer, bench_database, create_users, rate
+
+
+class Command(BaseCommand):
+    help = 'Measure sustained messages/s through save_message with and without write-behind'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--rooms', type=int, default=4)
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        with bench_database():
+            user = create_users(1)[0]
+            rooms = [ChatGroup.objects.create().id for _ in range(options['rooms'])]
+
+            for label, enabled in (('sync', False), ('write-behind', True)):
+                config = {**write_behind_settings(), 'ENABLED': enabled}
+                with override_settings(CHAT_WRITE_BEHIND=config):
+                    before = GroupMessage.objects.count()
+                    with Timer() as accept_timer:
+                        for i in range(count):
+                            save_message(user, rooms[i % len(rooms)], f'message {i}')
+                    with Timer() as flush_timer:
+                        writer = get_message_writer()
+                        if writer is not None:
+                            writer.flush()
+                    stored = GroupMessage.objects.count() - before
+
+                total = accept_timer.elapsed + flush_timer.elapsed
+                self.stdout.write(
+                    f'{label:>12}: {rate(count, accept_timer.elapsed):9.1f} accepted/s  '
+                    f'{rate(stored, total):9.1f} stored/s  ({stored} rows)'
+                )
+                self.check_order(rooms)
+
+    def check_order(self, rooms):
+        for room_id in rooms:
+            ids = list(GroupMessage.objects.filter(group_id=room_id).order_by('created', 'id').values_list('id', flat=True))
+            if ids != sorted(ids):
+                self.stderr.write(f'room {room_id}: created/id order mismatch')
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import protocol
+from a_rtchat.consumers import render_message_variants, render_online_status
+from a_rtchat.models import ChatGroup
+from a_rtchat.persistence import save_message
+from ._bench import bench_database, create_users
+
+
+class Command(BaseCommand):
+    help = 'Report bytes per frame and server CPU per frame for the HTML and JSON chat protocols'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000)
+        parser.add_argument('--members', type=int, default=50, help='Users in the presence diff')
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        with bench_database():
+            author = create_users(1)[0]
+            room = ChatGroup.objects.create()
+            message = save_message(author, room.id, 'Hello everyone, how is it going today?')
+            online = list(range(1, options['members'] + 1))
+
+            html = render_message_variants(message)['other']
+            json_frame = protocol.message_frame(message)
+            self.report('message', html, json_frame,
+                        self.cpu(lambda: render_message_variants(message), n),
+                        self.cpu(lambda: protocol.message_frame(message), n))
+
+            html = render_online_status(len(online), online, [])
+            json_frame = protocol.presence_frame(len(online), online, [])
+            self.report(f'presence ({len(online)} users)', html, json_frame,
+                        self.cpu(lambda: render_online_status(len(online), online, []), n),
+                        self.cpu(lambda: protocol.presence_frame(len(online), online, []), n))
+
+    def cpu(self, build, iterations):
+        """
+        CPU microseconds to build one frame (both HTML variants count as one message).
+        """
+        start = time.process_time()
+        for _ in range(iterations):
+            build()
+        return (time.process_time() - start) / iterations * 1e6
+
+    def report(self, label, html, json_frame, html_cpu, json_cpu):
+        self.stdout.write(label)
+        self.stdout.write(f'  html: {len(html.encode()):6d} bytes/frame  {html_cpu:8.1f} us CPU/frame')
+        self.stdout.write(f'  json: {len(json_frame.encode()):6d} bytes/frame  {json_cpu:8.1f} us CPU/frame')
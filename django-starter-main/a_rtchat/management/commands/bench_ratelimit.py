@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat.consumers import create_message
+from a_rtchat.models import ChatGroup
+from a_rtchat.ratelimit import ChatRateLimiter, rate_limit_settings
+from ._bench import bench_database, create_users
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of the chat rate limiter against the rest of the message path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=500, help='Messages for the create_message reference')
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        users, rooms = options['users'], options['rooms']
+        config = rate_limit_settings()
+        keys = [(i % users, i % rooms) for i in range(n)]
+
+        start = time.process_time()
+        for user_id, room_id in keys:
+            pass
+        loop = time.process_time() - start
+
+        # Limits from settings: most calls end up rejected once buckets drain
+        limiter = ChatRateLimiter(config['USER'], config['ROOM'], max_buckets=config['MAX_BUCKETS'])
+        limited = self.cpu(limiter, keys) - loop
+        # Limits nobody reaches: every call takes the accept path
+        unlimited = ChatRateLimiter({'RATE': 1e9, 'BURST': 1e9}, {'RATE': 1e9, 'BURST': 1e9})
+        accepted = self.cpu(unlimited, keys) - loop
+
+        with bench_database():
+            author = create_users(1)[0]
+            room = ChatGroup.objects.create()
+            start = time.process_time()
+            for i in range(options['messages']):
+                create_message(author, room.id, f'message {i}')
+            message_cost = (time.process_time() - start) / options['messages']
+
+        self.stdout.write(f'{users} users, {rooms} rooms, {n} calls')
+        for label, total in (('configured limits', limited), ('always accepting', accepted)):
+            per_call = total / n
+            self.stdout.write(
+                f'  {label:18s} {per_call * 1e9:8.0f} ns/call'
+                f'  ({per_call / message_cost:.2%} of create_message)'
+            )
+        self.stdout.write(f'  create_message     {message_cost * 1e6:8.1f} us/message')
+
+    def cpu(self, limiter, keys):
+        start = time.process_time()
+        for user_id, room_id in keys:
+            limiter.acquire(user_id, room_id)
+        return time.process_time() - start
@@ -0,0 +1,114 @@
+import datetime
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from a_rtchat.models import ChatGroup, GroupMessage
+from a_rtchat.search import search_messages
+from ._bench import Timer, bench_database, create_users
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'shi', 'po', 'de', 'va', 'zu', 'ri', 'bo', 'fe', 'gu', 'ha']
+
+
+class Command(BaseCommand):
+    help = 'Time ranked FTS5 message search against icontains on a large message table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, nargs='+', default=[1_000_000, 10_000_000])
+        parser.add_argument('--rooms', type=int, default=200)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--vocabulary', type=int, default=20000)
+        parser.add_argument('--words', type=int, default=8, help='Words per message')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench_search benchmarks the SQLite FTS5 index')
+        random.seed(0)
+        vocabulary = self.vocabulary(options['vocabulary'])
+        for count in options['messages']:
+            with bench_database():
+                self.run(count, vocabulary, options)
+
+    def run(self, count, vocabulary, options):
+        users = create_users(options['users'])
+        rooms = [ChatGroup.objects.create(groupchat_name=f'room {i}') for i in range(options['rooms'])]
+        searcher = users[0]
+        # The searcher is in half of the rooms
+        for i, room in enumerate(rooms):
+            room.members.add(*(users if i % 2 == 0 else users[1:]))
+
+        with Timer() as t:
+            self.fill(count, rooms, users, vocabulary, options['words'])
+        self.stdout.write(f'{count} messages: inserted and indexed in {t.elapsed:.1f}s')
+
+        # Words are Zipf-like: low ranks are common, high ranks are rare
+        queries = [
+            ('common word', vocabulary[1]),
+            ('mid word', vocabulary[200]),
+            ('rare word', vocabulary[len(vocabulary) - 10]),
+            ('two words', f'{vocabulary[5]} {vocabulary[60]}'),
+            ('no match', 'zzzzqx'),
+        ]
+        self.stdout.write(f'  {"query":12s} {"fts p1":>10s} {"fts p5":>10s} {"icontains p1":>13s} {"icontains p5":>13s}')
+        for label, text in queries:
+            timings = [
+                self.time(lambda: search_messages(searcher.id, text, page=1), options['repeat']),
+                self.time(lambda: search_messages(searcher.id, text, page=5), options['repeat']),
+                self.time(lambda: self.icontains(searcher.id, text, page=1), options['repeat']),
+                self.time(lambda: self.icontains(searcher.id, text, page=5), options['repeat']),
+            ]
+            self.stdout.write(
+                f'  {label:12s} {timings[0] * 1000:8.1f}ms {timings[1] * 1000:8.1f}ms'
+                f' {timings[2] * 1000:11.1f}ms {timings[3] * 1000:11.1f}ms'
+            )
+
+    def vocabulary(self, size):
+        words = set()
+        while len(words) < size:
+            words.add(''.join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))))
+        return sorted(words, key=lambda word: random.random())
+
+    def fill(self, count, rooms, users, vocabulary, words_per_message):
+        start = timezone.now() - datetime.timedelta(seconds=count)
+        size = len(vocabulary)
+        # Generated inside SQLite; the insert trigger indexes every row as the app would
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMP TABLE bench_words (id INTEGER PRIMARY KEY, word TEXT)')
+            cursor.executemany('INSERT INTO bench_words (id, word) VALUES (%s, %s)', list(enumerate(vocabulary)))
+            # random % (1 + random % size) skews picks towards low ids; the unused x
+            # makes the subquery correlated so it runs for every word
+            pick = f'(SELECT word FROM bench_words WHERE id = (abs(random()) + 0 * x) %% (1 + abs(random()) %% {size}))'
+            body = " || ' ' || ".join([pick] * words_per_message)
+            cursor.execute(
+                f"""
+                WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq LIMIT %s)
+                INSERT INTO {GroupMessage._meta.db_table} (group_id, author_id, body, created)
+                SELECT %s + x %% %s, %s + x %% %s, {body},
+                       strftime('%%Y-%%m-%%d %%H:%%M:%%f', %s, '+' || x || ' seconds')
+                FROM seq
+                """,
+                [
+                    count, rooms[0].id, len(rooms), users[0].id, len(users),
+                    start.strftime('%Y-%m-%d %H:%M:%S'),
+                ],
+            )
+            cursor.execute('DROP TABLE bench_words')
+
+    def icontains(self, user_id, text, page, size=20):
+        offset = (page - 1) * size
+        return list(
+            GroupMessage.objects
+            .filter(group__members=user_id, body__icontains=text)
+            .select_related('author__profile', 'group')
+            .order_by('-created', '-id')[offset:offset + size + 1]
+        )
+
+    def time(self, run, repeat):
+        run()  # warm up
+        with Timer() as t:
+            for _ in range(repeat):
+                run()
+        return t.elapsed / repeat
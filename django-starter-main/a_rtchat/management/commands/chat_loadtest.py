@@ -0,0 +1,300 @@
+"""
+In-process load test of the chat sockets.
+
+Every simulated user is a WebsocketCommunicator talking to the real ASGI
+application (a_core.asgi.application), authenticated by a session cookie
+like a browser, so the whole stack is exercised: origin check, auth
+middleware, routing, the consumer, the channel layer and the database.
+
+    python manage.py chat_loadtest --users 200 --rooms 10 --rate 50 --duration 10 --output run.json
+
+Results are printed as one JSON document (and written to --output) so runs
+on different commits can be diffed or compared by a script.
+"""
+import asyncio
+import json
+import random
+import re
+import subprocess
+import threading
+from importlib import import_module
+
+from allauth.account.models import EmailAddress
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from a_rtchat import protocol
+from a_rtchat.models import ChatGroup
+from a_rtchat.persistence import write_behind_settings
+from ._bench import bench_database, create_users, percentiles, rate
+
+MARKER = re.compile(r'loadtest-(\d+)\b')
+
+
+class QueryCounter:
+    """
+    Count the queries run on every database connection, whatever the thread.
+
+    Consumers reach the database from the thread running the command and
+    from worker threads, each with its own connection. Connections are
+    thread-local, so the counter wraps those of the installing thread and
+    every one opened anywhere while it is installed; install it before the
+    sockets start.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def wrap(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        self.existing = connections.all()
+        for connection in self.existing:
+            self.wrap(connection)
+        connection_created.connect(self.wrap)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self.wrap)
+        # Connections opened by other threads keep the wrapper; it only adds to a number nobody reads
+        for connection in self.existing:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def session_cookie(user):
+    """
+    Log `user` in without a request and return the session cookie header.
+    """
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'.encode()
+
+
+class Client:
+    """
+    One simulated user: a socket, and the frames it received.
+    """
+
+    def __init__(self, application, user, room, json_protocol):
+        self.user = user
+        self.room = room
+        self.comm = WebsocketCommunicator(
+            application,
+            f'/ws/chatroom/{room.group_name}',
+            headers=[(b'cookie', session_cookie(user)), (b'origin', b'http://localhost')],
+            subprotocols=[protocol.JSON_SUBPROTOCOL] if json_protocol else None,
+        )
+        self.reader = None
+        self.closed = None
+
+
+class Command(BaseCommand):
+    help = 'Load test the chat sockets in-process and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Simulated users, one socket each')
+        parser.add_argument('--rooms', type=int, default=5, help='Group chats the users are spread across')
+        parser.add_argument('--rate', type=float, default=20, help='Messages per second, over all rooms')
+        parser.add_argument('--duration', type=float, default=5, help='Seconds of traffic')
+        parser.add_argument('--protocol', choices=['html', 'json'], default='html', help='Wire protocol of the sockets')
+        parser.add_argument('--write-behind', action='store_true', help='Enable CHAT_WRITE_BEHIND')
+        parser.add_argument('--connect-concurrency', type=int, default=10, help='Sockets connecting at once')
+        parser.add_argument('--settle', type=float, default=10, help='Seconds to wait for late deliveries')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        with bench_database():
+            users = create_users(options['users'], prefix='load')
+            # Group chats need a verified email
+            EmailAddress.objects.bulk_create([
+                EmailAddress(user=user, email=f'{user.username}@example.com', verified=True, primary=True)
+                for user in users
+            ])
+            rooms = [ChatGroup.objects.create(groupchat_name=f'load {i}') for i in range(options['rooms'])]
+            members = {room.id: [] for room in rooms}
+            for i, user in enumerate(users):
+                members[rooms[i % len(rooms)].id].append(user)
+            for room in rooms:
+                room.members.add(*members[room.id])
+
+            config = {**write_behind_settings(), 'ENABLED': options['write_behind']}
+            with override_settings(CHAT_WRITE_BEHIND=config):
+                # Imported here so the application is built against the benchmark settings
+                from a_core.asgi import application
+                clients = [
+                    Client(application, user, room, options['protocol'] == 'json')
+                    for room in rooms for user in members[room.id]
+                ]
+                with QueryCounter() as queries:
+                    results = async_to_sync(self.run)(clients, queries, options)
+
+        results = {
+            'revision': git_revision(),
+            'database': connections['default'].vendor,
+            'config': {
+                key: options[key] for key in
+                ('users', 'rooms', 'rate', 'duration', 'protocol', 'write_behind', 'connect_concurrency', 'seed')
+            },
+            **results,
+        }
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+
+    async def run(self, clients, queries, options):
+        """
+        Connect every client, send messages at the requested rate from random
+        clients, and wait until every socket of the sender's room got each one.
+        """
+        loop = asyncio.get_running_loop()
+        sent_at = {}          # message number -> send time
+        expected = {}         # message number -> sockets still to receive it
+        delivery = []         # seconds from send to receipt, one per socket
+        frames = {'total': 0, 'traffic': 0}
+        phase = {'traffic': False}
+        done = asyncio.Event()
+
+        async def read(client):
+            while True:
+                output = await client.comm.receive_output(timeout=3600)
+                if output['type'] == 'websocket.close':
+                    client.closed = output.get('code', 1000)
+                    return
+                now = loop.time()
+                frames['total'] += 1
+                if phase['traffic']:
+                    frames['traffic'] += 1
+                match = MARKER.search(output.get('text') or '')
+                if match is None:
+                    continue
+                number = int(match.group(1))
+                delivery.append(now - sent_at[number])
+                expected[number] -= 1
+                if expected[number] == 0:
+                    del expected[number]
+                    if not expected and len(sent_at) == total:
+                        done.set()
+
+        # Connect
+        connect_latency = []
+        failed_connects = 0
+        semaphore = asyncio.Semaphore(max(1, options['connect_concurrency']))
+
+        async def connect(client):
+            nonlocal failed_connects
+            async with semaphore:
+                start = loop.time()
+                connected, _ = await client.comm.connect(timeout=60)
+                if not connected:
+                    failed_connects += 1
+                    return
+                connect_latency.append(loop.time() - start)
+                client.reader = asyncio.create_task(read(client))
+
+        connect_start = loop.time()
+        await asyncio.gather(*(connect(client) for client in clients))
+        connect_elapsed = loop.time() - connect_start
+        connect_queries = queries.count
+        connected = [client for client in clients if client.reader is not None]
+        by_room = {}
+        for client in connected:
+            by_room.setdefault(client.room.id, []).append(client)
+
+        # Traffic
+        total = int(options['rate'] * options['duration'])
+        interval = 1 / options['rate'] if options['rate'] else 0
+        behind = []
+        phase['traffic'] = True
+        start = loop.time()
+        for number in range(total):
+            due = start + number * interval
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                behind.append(-delay)
+            sender = random.choice(connected)
+            expected[number] = len([c for c in by_room[sender.room.id] if c.closed is None])
+            sent_at[number] = loop.time()
+            await sender.comm.send_to(text_data=json.dumps({'body': f'loadtest-{number}'}))
+        send_elapsed = loop.time() - start
+        if expected:
+            try:
+                await asyncio.wait_for(done.wait(), timeout=options['settle'])
+            except asyncio.TimeoutError:
+                pass
+        traffic_elapsed = loop.time() - start
+        phase['traffic'] = False
+        if options['write_behind']:
+            # Writes still buffered belong to the messages too
+            await asyncio.sleep(write_behind_settings()['FLUSH_INTERVAL'] * 2)
+        message_queries = queries.count - connect_queries
+
+        for client in connected:
+            client.reader.cancel()
+        await asyncio.gather(*(client.reader for client in connected), return_exceptions=True)
+        for client in connected:
+            if client.closed is None:
+                await client.comm.disconnect()
+
+        deliveries = len(delivery)
+        missing = sum(expected.values())
+        return {
+            'connect': {
+                'sockets': len(clients),
+                'failed': failed_connects,
+                'per_sec': round(rate(len(connected), connect_elapsed), 1),
+                'latency_ms': percentiles(connect_latency),
+                'queries_per_connect': round(connect_queries / len(connected), 2) if connected else None,
+            },
+            'messages': {
+                'sent': total,
+                'achieved_rate': round(rate(total, send_elapsed), 1),
+                'sender_lag_ms': percentiles(behind),
+                'queries_per_message': round(message_queries / total, 2) if total else None,
+            },
+            'delivery': {
+                'delivered': deliveries,
+                'missing': missing,
+                'per_sec': round(rate(deliveries, traffic_elapsed), 1),
+                'latency_ms': percentiles(delivery),
+            },
+            'frames': {
+                'total': frames['total'],
+                'per_sec': round(rate(frames['traffic'], traffic_elapsed), 1),
+            },
+            'closed_by_server': sum(1 for client in connected if client.closed is not None),
+            'elapsed_sec': round(traffic_elapsed, 3),
+        }
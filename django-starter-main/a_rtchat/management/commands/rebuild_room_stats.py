@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+
+from a_rtchat.archive import archive_stats, parse_created
+from a_rtchat.models import MESSAGE_PREVIEW_LENGTH, ChatGroup, GroupMessage
+
+STATS_FIELDS = ['last_message_at', 'last_message', 'message_count', 'last_message_preview']
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized activity stats of every chatroom from its messages, archived ones included'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rooms per query and transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        room_ids = list(ChatGroup.objects.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(room_ids), batch_size):
+            self.rebuild(room_ids[start:start + batch_size])
+        self.stdout.write(f'Rebuilt stats of {len(room_ids)} chatrooms')
+
+    def rebuild(self, room_ids):
+        latest = GroupMessage.objects.filter(group=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+        with transaction.atomic():
+            rooms = list(
+                ChatGroup.objects.filter(id__in=room_ids)
+                .select_for_update()
+                .annotate(counted=Count('chat_messages'), latest_id=Subquery(latest))
+                .only('id')
+            )
+            last_messages = GroupMessage.objects.only('created', 'body').in_bulk(
+                [room.latest_id for room in rooms if room.latest_id]
+            )
+            for room in rooms:
+                last_message = last_messages.get(room.latest_id)
+                archived, newest_archived = archive_stats(room.id)
+                room.message_count = room.counted + archived
+                room.last_message = last_message
+                if last_message is not None:
+                    room.last_message_at = last_message.created
+                    room.last_message_preview = last_message.body[:MESSAGE_PREVIEW_LENGTH]
+                elif newest_archived is not None:
+                    # Every message is archived: the row is gone, its time and text aren't
+                    room.last_message_at = parse_created(newest_archived[2])
+                    room.last_message_preview = newest_archived[3][:MESSAGE_PREVIEW_LENGTH]
+                else:
+                    room.last_message_at = None
+                    room.last_message_preview = ''
+            ChatGroup.objects.bulk_update(rooms, STATS_FIELDS)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from a_rtchat.search import optimize_index, rebuild_index, uses_fts
+from ._bench import Timer
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of chat messages from the messages table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-optimize', action='store_true', help='Skip merging the index afterwards')
+
+    def handle(self, *args, **options):
+        if not uses_fts():
+            raise CommandError('The full-text index only exists on SQLite; other databases search without one')
+        with Timer() as t:
+            rebuild_index()
+        self.stdout.write(f'Rebuilt the search index in {t.elapsed:.1f}s')
+        if not options['no_optimize']:
+            with Timer() as t:
+                optimize_index()
+            self.stdout.write(f'Optimized the search index in {t.elapsed:.1f}s')
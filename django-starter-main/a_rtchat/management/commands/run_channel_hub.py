@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from a_rtchat.layers import DEFAULT_PATH, ChannelHub
+
+
+class Command(BaseCommand):
+    help = 'Run the hub process used by a_rtchat.layers.UnixSocketChannelLayer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Unix socket path (defaults to the CHANNEL_LAYERS config)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if path is None:
+            config = settings.CHANNEL_LAYERS.get('default', {}).get('CONFIG', {})
+            path = config.get('path', DEFAULT_PATH)
+        self.stdout.write(f'Channel hub listening on {path}')
+        try:
+            ChannelHub(path).run()
+        except KeyboardInterrupt:
+            pass
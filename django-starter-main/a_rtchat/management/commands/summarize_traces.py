@@ -0,0 +1,107 @@
+import json
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from a_rtchat.tracing import tracing_settings
+from ._bench import percentiles
+
+
+class Command(BaseCommand):
+    help = 'Summarize the spans written by a_rtchat.tracing: where the time of each kind of trace goes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="Span file, CHAT_TRACING['PATH'] by default")
+        parser.add_argument('--root', help='Only traces whose root span has this name, e.g. ws.receive')
+        parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+
+    def handle(self, *args, **options):
+        path = options['path'] or tracing_settings()['PATH']
+        traces = self.load(path)
+        summary = self.summarize(traces, options['root'])
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        for root, report in summary.items():
+            e2e = report['end_to_end_ms']
+            self.stdout.write(
+                f"{root}: {report['traces']} traces, end to end p50 {e2e['p50']} ms"
+                f"  p90 {e2e['p90']} ms  p99 {e2e['p99']} ms  max {e2e['max']} ms"
+            )
+            self.stdout.write(
+                f"  {'span':24s} {'count':>7s} {'p50':>9s} {'p90':>9s} {'p99':>9s} {'self ms':>11s} {'share':>7s}"
+            )
+            for name, row in report['spans'].items():
+                self.stdout.write(
+                    f"  {name:24s} {row['count']:7d} {row['p50']:9.3f} {row['p90']:9.3f} {row['p99']:9.3f}"
+                    f" {row['self_ms']:11.1f} {row['share']:7.1%}"
+                )
+
+    def load(self, path):
+        traces = defaultdict(list)
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short by a crash
+                    traces[span['trace']].append(span)
+        except FileNotFoundError:
+            raise CommandError(f'No span file at {path}; is CHAT_TRACING["SAMPLE_RATE"] above 0?')
+        return traces
+
+    def summarize(self, traces, only_root=None):
+        """
+        Group traces by the name of their root span and, for each group,
+        compute end-to-end latency and per-span-name durations.
+
+        A span's self time is its duration minus that of its children,
+        floored at zero since async children (ws.send) can outlive their
+        parent. Self times add up to the work done, so their shares show
+        where latency goes without counting nested spans twice.
+
+        Returns:
+            {root name: {'traces', 'end_to_end_ms', 'spans': {name: stats}}},
+            spans sorted by total self time
+        """
+        groups = defaultdict(list)
+        for spans in traces.values():
+            root = next((span for span in spans if span['parent'] is None), None)
+            if root is None or (only_root and root['name'] != only_root):
+                continue  # Continued from a trace whose root was not written here
+            groups[root['name']].append((root, spans))
+
+        summary = {}
+        for root_name, group in sorted(groups.items()):
+            end_to_end = []
+            durations = defaultdict(list)
+            self_times = defaultdict(float)
+            for root, spans in group:
+                end = max(span['start'] + span['ms'] / 1000 for span in spans)
+                end_to_end.append(end - root['start'])
+                children = defaultdict(float)
+                for span in spans:
+                    if span['parent'] is not None:
+                        children[span['parent']] += span['ms']
+                for span in spans:
+                    durations[span['name']].append(span['ms'] / 1000)
+                    self_times[span['name']] += max(0.0, span['ms'] - children[span['span']])
+            total_self = sum(self_times.values()) or 1
+            rows = {}
+            for name in sorted(durations, key=lambda name: -self_times[name]):
+                stats = percentiles(durations[name])
+                rows[name] = {
+                    'count': stats['count'],
+                    'p50': stats['p50'],
+                    'p90': stats['p90'],
+                    'p99': stats['p99'],
+                    'self_ms': round(self_times[name], 3),
+                    'share': self_times[name] / total_self,
+                }
+            summary[root_name] = {
+                'traces': len(group),
+                'end_to_end_ms': percentiles(end_to_end),
+                'spans': rows,
+            }
+        return summary
@@ -0,0 +1,68 @@
+"""
+Removing members from a chatroom and telling their open sockets.
+
+Every chat socket also joins a channel group of its own user:
+
+    user_group(user.id)  ->  'user_<id>'
+
+so an event meant for a few users goes to their connections only, in
+whatever room or process they are, instead of to the whole room for each
+socket to check whether it is meant for it.
+
+A socket of a removed member sends its client a redirect and closes with
+REMOVED_CLOSE_CODE; it accepts nothing from the client in between.
+"""
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from a_rtchat.presence import get_presence_store
+
+REMOVED_CLOSE_CODE = 4003
+
+
+def user_group(user_id):
+    """
+    Name of the channel group holding every socket of a user.
+    """
+    return f'user_{user_id}'
+
+
+def remove_members(chat_group, user_ids):
+    """
+    Remove users from a chatroom and close their way into it.
+
+    This function:
+    1. Deletes the memberships in one query; the m2m_changed receiver drops
+       the cached ACL answers and room indexes of all of them at once
+    2. Drops their connections from the room's presence and broadcasts one
+       diff with those who went offline
+    3. Sends member_removed to the removed users' own channel groups, so
+       their sockets leave the room, send the clients home and close
+
+    Parameters:
+        chat_group: the ChatGroup
+        user_ids: ids of the members to remove
+
+    Returns:
+        None
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    chat_group.members.remove(*user_ids)
+    went_offline = get_presence_store().remove_users(chat_group.group_name, user_ids)
+    async_to_sync(_notify)(chat_group.group_name, user_ids, sorted(went_offline))
+
+
+async def _notify(chatroom_name, user_ids, went_offline):
+    # Imported here: the consumers module imports this one for user_group
+    from a_rtchat.consumers import broadcast_presence
+
+    channel_layer = get_channel_layer()
+    event = {'type': 'member_removed', 'room': chatroom_name}
+    sends = [channel_layer.group_send(user_group(user_id), event) for user_id in user_ids]
+    if went_offline:
+        sends.append(broadcast_presence(chatroom_name, [], went_offline))
+    await asyncio.gather(*sends)
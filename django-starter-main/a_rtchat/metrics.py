@@ -0,0 +1,449 @@
+"""
+In-process metrics for the chat sockets, served in the Prometheus text format.
+
+Instruments are module-level objects updated inline on the hot path:
+
+    metrics.connects.inc()
+    metrics.render_seconds.labels('message').observe(elapsed)
+
+Updates are plain attribute arithmetic with no lock (a few hundred
+nanoseconds at most, see the bench_metrics command). They happen on the
+event loop or in the sync thread running ORM work, so the rare increment
+lost to a thread switch is accepted in exchange for that cost. Gauges that
+are cheaper to read than to maintain (queue depths, cache stats) are
+computed by collectors when the endpoint is scraped.
+
+Labels only take values from a fixed set (event and template names); room
+names are private and unbounded, so per-room numbers are folded into
+aggregates at scrape time (see collect_rooms).
+
+The endpoint is mounted in front of Django in a_core.asgi. Scrapers must
+send the configured bearer token; the client address is not checked, since
+behind a reverse proxy every request comes from the proxy:
+
+    CHAT_METRICS = {
+        'PATH': '/metrics',
+        'TOKEN': 'long random string',  # None disables the endpoint
+    }
+
+Numbers are per process; with several workers, scrape each of them.
+"""
+import hmac
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+DEFAULT_METRICS = {
+    'PATH': '/metrics',
+    'TOKEN': None,
+}
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+def metrics_settings():
+    return {**DEFAULT_METRICS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class _Gauge(_Counter):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, cumulative
+
+
+class Metric:
+    """
+    A named metric, optionally split by labels.
+
+    Without labels the metric proxies its single child, so `counter.inc()`
+    works directly; with labels, `labels(*values)` returns the child for
+    those values, creating it on first use.
+    """
+
+    kinds = {'counter': _Counter, 'gauge': _Gauge}
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children = {}
+        if not self.labelnames:
+            child = self._new_child()
+            self.children[()] = child
+            # Bind the hot-path methods of the only child onto the metric
+            for method in ('inc', 'dec', 'set', 'observe'):
+                if hasattr(child, method):
+                    setattr(self, method, getattr(child, method))
+
+    def _new_child(self):
+        if self.kind == 'histogram':
+            return _Histogram(self.buckets)
+        return self.kinds[self.kind]()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            labels = tuple(zip(self.labelnames, values))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(f'{name}{_format_labels(sample_labels)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    """
+    Metrics plus collectors, rendered together by expose().
+
+    A collector is a function returning (kind, name, documentation, samples)
+    tuples, where samples is a list of (labels dict, value). Collectors run
+    at scrape time only.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Metric('counter', name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Metric('gauge', name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Metric('histogram', name, documentation, labelnames, buckets))
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        # Collectors first: they may also update metrics (see collect_deliveries)
+        collected = [family for collect in self.collectors for family in collect()]
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for kind, name, documentation, samples in collected:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+connects = registry.counter('chat_connects_total', 'Sockets accepted')
+disconnects = registry.counter('chat_disconnects_total', 'Accepted sockets closed')
+connections = registry.gauge('chat_connections', 'Open sockets')
+messages_received = registry.counter('chat_messages_received_total', 'Chat messages received from clients')
+messages_rate_limited = registry.counter('chat_messages_rate_limited_total', 'Chat messages rejected by the rate limiter')
+messages_broadcast = registry.counter('chat_messages_broadcast_total', 'Chat messages sent to the channel layer')
+fanout = registry.histogram(
+    'chat_message_fanout', 'Sockets of this process a chat message was sent to', buckets=SIZE_BUCKETS,
+)
+delivery_seconds = registry.histogram(
+    'chat_message_delivery_seconds', 'Time from receiving a chat message to its last send by this process',
+)
+render_seconds = registry.histogram('chat_render_seconds', 'Time spent rendering frames', ['template'])
+event_queries = registry.histogram(
+    'chat_event_db_queries', 'Database queries per consumer event', ['event'], buckets=QUERY_BUCKETS,
+)
+event_db_seconds = registry.histogram('chat_event_db_seconds', 'Database time per consumer event', ['event'])
+
+
+class DeliveryTracker:
+    """
+    Follows each chat message until this process has sent it to every socket.
+
+    The broadcast is fire-and-forget, so nothing knows when the last
+    subscriber wrote its frame. Each send updates the message's entry
+    (last send time, sockets reached); entries idle for SETTLE seconds are
+    complete and turned into one fanout and one delivery_seconds
+    observation when the endpoint is scraped, or when too many pile up.
+    """
+
+    SETTLE = 1.0
+
+    def __init__(self, max_pending=10000):
+        self.max_pending = max_pending
+        self.pending = {}  # message id -> [received_at, last sent at, sockets]
+
+    def sent(self, message_id, received_at):
+        now = time.time()
+        entry = self.pending.get(message_id)
+        if entry is None:
+            self.pending[message_id] = [received_at, now, 1]
+            if len(self.pending) > self.max_pending:
+                self.settle(now, force=len(self.pending) // 2)
+        else:
+            entry[1] = now
+            entry[2] += 1
+
+    def settle(self, now=None, force=0):
+        """
+        Record the messages whose sends are over.
+
+        Parameters:
+            now: current time.time(), looked up if None
+            force: record at least this many of the oldest messages, done or not
+        """
+        now = now or time.time()
+        done = []
+        for message_id, (received_at, last_sent, sockets) in list(self.pending.items()):
+            if len(done) >= force and now - last_sent < self.SETTLE:
+                # Entries are in arrival order, but a later one may already
+                # be idle; those are picked up by the next scrape
+                break
+            done.append(message_id)
+            fanout.observe(sockets)
+            delivery_seconds.observe(last_sent - received_at)
+        for message_id in done:
+            del self.pending[message_id]
+
+
+deliveries = DeliveryTracker()
+
+# Open sockets per chatroom; only aggregates are exposed
+room_sockets = {}
+
+
+def room_joined(room):
+    connections.inc()
+    room_sockets[room] = room_sockets.get(room, 0) + 1
+
+
+def room_left(room):
+    connections.dec()
+    remaining = room_sockets.get(room, 0) - 1
+    if remaining > 0:
+        room_sockets[room] = remaining
+    else:
+        room_sockets.pop(room, None)
+
+
+@contextmanager
+def timed(histogram):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+class _QueryRecorder:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+
+
+def track_queries(event, func):
+    """
+    Wrap a sync function so the queries it runs are recorded for `event`.
+
+    Meant for the functions consumers hand to database_sync_to_async, so
+    the count and time are per consumer event.
+    """
+    queries = event_queries.labels(event)
+    seconds = event_db_seconds.labels(event)
+
+    def tracked(*args, **kwargs):
+        recorder = _QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            result = func(*args, **kwargs)
+        queries.observe(recorder.count)
+        seconds.observe(recorder.seconds)
+        return result
+
+    tracked.__name__ = func.__name__
+    tracked.__doc__ = func.__doc__
+    return tracked
+
+
+@registry.collector
+def collect_deliveries():
+    deliveries.settle()
+    return ()
+
+
+@registry.collector
+def collect_rooms():
+    counts = list(room_sockets.values())
+    return [
+        ('gauge', 'chat_rooms_active', 'Chatrooms with an open socket', [({}, len(counts))]),
+        ('gauge', 'chat_room_connections_max', 'Open sockets of the busiest chatroom', [({}, max(counts, default=0))]),
+    ]
+
+
+@registry.collector
+def collect_outbound():
+    from a_rtchat.outbound import queue_depths, totals
+
+    total, deepest = queue_depths()
+    return [
+        ('counter', 'chat_outbound_frames_total', 'Outbound queue events, by kind',
+         [({'event': name}, value) for name, value in sorted(totals.items()) if name != 'high_water']),
+        ('gauge', 'chat_outbound_queued_frames', 'Frames waiting in outbound queues', [({}, total)]),
+        ('gauge', 'chat_outbound_deepest_queue', 'Frames waiting in the fullest outbound queue', [({}, deepest)]),
+    ]
+
+
+@registry.collector
+def collect_channel_layer():
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    queues = list(getattr(layer, 'channels', {}).values())
+    depths = [queue.qsize() for queue in queues if hasattr(queue, 'qsize')]
+    return [
+        ('gauge', 'chat_channel_layer_channels', 'Channels with an inbox in this process', [({}, len(depths))]),
+        ('gauge', 'chat_channel_layer_queued_messages', 'Messages waiting in channel layer inboxes',
+         [({}, sum(depths))]),
+        ('gauge', 'chat_channel_layer_deepest_inbox', 'Messages waiting in the fullest inbox',
+         [({}, max(depths, default=0))]),
+    ]
+
+
+@registry.collector
+def collect_fragment_cache():
+    from a_rtchat.fragments import get_fragment_cache
+
+    cache = get_fragment_cache()
+    if cache is None:
+        return ()
+    return [
+        ('counter', 'chat_fragment_cache_total', 'Fragment cache lookups and evictions',
+         [({'result': name}, cache.stats[name]) for name in ('hits', 'misses', 'evictions')]),
+        ('gauge', 'chat_fragment_cache_bytes', 'Size of the cached fragments', [({}, cache.size)]),
+    ]
+
+
+def authorized(scope, token):
+    """
+    Whether the request carries `Authorization: Bearer <token>`.
+    """
+    expected = b'Bearer ' + token.encode()
+    for name, value in scope.get('headers', ()):
+        if name.lower() == b'authorization':
+            return hmac.compare_digest(value, expected)
+    return False
+
+
+class MetricsEndpoint:
+    """
+    ASGI app serving the registry at CHAT_METRICS['PATH'] and passing
+    every other HTTP request to `app`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        config = metrics_settings()
+        if scope['type'] != 'http' or scope['path'] != config['PATH']:
+            return await self.app(scope, receive, send)
+
+        token = config['TOKEN']
+        if token is None:
+            return await self.app(scope, receive, send)
+
+        headers = []
+        if not authorized(scope, token):
+            status, body, content_type = 401, b'Unauthorized\n', b'text/plain; charset=utf-8'
+            headers.append((b'www-authenticate', b'Bearer'))
+        else:
+            status, body = 200, registry.expose().encode()
+            content_type = b'text/plain; version=0.0.4; charset=utf-8'
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers + [(b'content-type', content_type), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
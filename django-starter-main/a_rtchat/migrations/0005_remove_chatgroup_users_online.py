@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:15
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0004_chatgroup_admin_chatgroup_groupchat_name_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chatgroup',
+            name='users_online',
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0005_remove_chatgroup_users_online'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'created', 'id'], name='groupmessage_history_idx'),
+        ),
+    ]
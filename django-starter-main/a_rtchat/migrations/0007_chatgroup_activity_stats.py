@@ -0,0 +1,72 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+BATCH_SIZE = 500
+
+
+def backfill_stats(apps, schema_editor):
+    """
+    Compute the activity stats of the existing rooms from their messages.
+    """
+    ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+    GroupMessage = apps.get_model('a_rtchat', 'GroupMessage')
+    latest = GroupMessage.objects.filter(group=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+    room_ids = list(ChatGroup.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(room_ids), BATCH_SIZE):
+        rooms = list(
+            ChatGroup.objects.filter(id__in=room_ids[start:start + BATCH_SIZE])
+            .annotate(counted=Count('chat_messages'), latest_id=Subquery(latest))
+            .only('id')
+        )
+        last_messages = GroupMessage.objects.only('created', 'body').in_bulk(
+            [room.latest_id for room in rooms if room.latest_id]
+        )
+        for room in rooms:
+            last_message = last_messages.get(room.latest_id)
+            room.message_count = room.counted
+            room.last_message = last_message
+            room.last_message_at = last_message.created if last_message else None
+            room.last_message_preview = last_message.body[:100] if last_message else ''
+        ChatGroup.objects.bulk_update(
+            rooms, ['last_message_at', 'last_message', 'message_count', 'last_message_preview'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0006_groupmessage_history_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='a_rtchat.groupmessage'),
+        ),
+        migrations.AddField(
+            model_name='chatgroup',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatgroup',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatgroup',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatgroup',
+            index=models.Index(fields=['-last_message_at'], name='chatgroup_activity_idx'),
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
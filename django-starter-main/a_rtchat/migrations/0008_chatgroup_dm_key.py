@@ -0,0 +1,73 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:34
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def merge_duplicate_dms(apps, schema_editor):
+    """
+    Give every private chat its dm_key, merging rooms that share a user pair.
+
+    The pair of a room is its two members. A room one of them has left is
+    completed with the other authors of its messages, so it still gets the
+    key (or merges into the pair's room) instead of leaving the pair with
+    a second room later. The oldest room of a pair is kept; the messages
+    and members of the others move into it. Rooms whose pair can't be told
+    keep dm_key empty.
+    """
+    ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+    GroupMessage = apps.get_model('a_rtchat', 'GroupMessage')
+    Membership = ChatGroup.members.through
+
+    members = defaultdict(set)
+    for room_id, user_id in Membership.objects.filter(chatgroup__is_private=True).values_list('chatgroup_id', 'user_id'):
+        members[room_id].add(user_id)
+    room_ids = list(ChatGroup.objects.filter(is_private=True).order_by('id').values_list('id', flat=True))
+
+    lonely = [room_id for room_id in room_ids if len(members[room_id]) == 1]
+    for room_id, author_id in (
+        GroupMessage.objects.filter(group_id__in=lonely).values_list('group_id', 'author_id').distinct()
+    ):
+        members[room_id].add(author_id)
+
+    by_pair = defaultdict(list)
+    for room_id in room_ids:
+        if len(members[room_id]) == 2:
+            by_pair['%d:%d' % tuple(sorted(members[room_id]))].append(room_id)
+
+    for key, (keeper, *duplicates) in by_pair.items():
+        if duplicates:
+            GroupMessage.objects.filter(group_id__in=duplicates).update(group_id=keeper)
+            joined = set(Membership.objects.filter(chatgroup_id=keeper).values_list('user_id', flat=True))
+            Membership.objects.bulk_create([
+                Membership(chatgroup_id=keeper, user_id=user_id)
+                for user_id in set(Membership.objects.filter(chatgroup_id__in=duplicates).values_list('user_id', flat=True))
+                - joined
+            ])
+            ChatGroup.objects.filter(id__in=duplicates).delete()
+            messages = GroupMessage.objects.filter(group_id=keeper)
+            last_message = messages.order_by('-created', '-id').first()
+            ChatGroup.objects.filter(id=keeper).update(
+                message_count=messages.count(),
+                last_message=last_message,
+                last_message_at=last_message.created if last_message else None,
+                last_message_preview=last_message.body[:100] if last_message else '',
+            )
+        ChatGroup.objects.filter(id=keeper).update(dm_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0007_chatgroup_activity_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='dm_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(merge_duplicate_dms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# External-content FTS5 index over GroupMessage.body: the index stores no
+# copy of the text, only the tokens, and triggers keep it in step with
+# every insert, delete and body update, including bulk ones.
+FORWARD = [
+    """
+    CREATE VIRTUAL TABLE a_rtchat_groupmessage_fts USING fts5(
+        body,
+        content='a_rtchat_groupmessage',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER a_rtchat_groupmessage_fts_insert AFTER INSERT ON a_rtchat_groupmessage BEGIN
+        INSERT INTO a_rtchat_groupmessage_fts (rowid, body) VALUES (new.id, new.body);
+    END
+    """,
+    """
+    CREATE TRIGGER a_rtchat_groupmessage_fts_delete AFTER DELETE ON a_rtchat_groupmessage BEGIN
+        INSERT INTO a_rtchat_groupmessage_fts (a_rtchat_groupmessage_fts, rowid, body)
+        VALUES ('delete', old.id, old.body);
+    END
+    """,
+    """
+    CREATE TRIGGER a_rtchat_groupmessage_fts_update AFTER UPDATE OF body ON a_rtchat_groupmessage BEGIN
+        INSERT INTO a_rtchat_groupmessage_fts (a_rtchat_groupmessage_fts, rowid, body)
+        VALUES ('delete', old.id, old.body);
+        INSERT INTO a_rtchat_groupmessage_fts (rowid, body) VALUES (new.id, new.body);
+    END
+    """,
+    # Index the messages that already exist
+    "INSERT INTO a_rtchat_groupmessage_fts (a_rtchat_groupmessage_fts) VALUES ('rebuild')",
+]
+
+BACKWARD = [
+    'DROP TRIGGER IF EXISTS a_rtchat_groupmessage_fts_update',
+    'DROP TRIGGER IF EXISTS a_rtchat_groupmessage_fts_delete',
+    'DROP TRIGGER IF EXISTS a_rtchat_groupmessage_fts_insert',
+    'DROP TABLE IF EXISTS a_rtchat_groupmessage_fts',
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        # Other databases search with icontains (see a_rtchat.search)
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0008_chatgroup_dm_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(FORWARD), run(BACKWARD)),
+    ]
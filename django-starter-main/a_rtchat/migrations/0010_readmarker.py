@@ -0,0 +1,47 @@
+# Generated by Django 5.1.7 on 2026-10-17 05:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_markers(apps, schema_editor):
+    """
+    Give every existing membership a read marker, with everything counted as read.
+    """
+    ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+    ReadMarker = apps.get_model('a_rtchat', 'ReadMarker')
+    Membership = ChatGroup.members.through
+    last_read = dict(ChatGroup.objects.values_list('id', 'last_message_id'))
+    ReadMarker.objects.bulk_create(
+        (
+            ReadMarker(user_id=user_id, group_id=group_id, last_read_message_id=last_read[group_id] or 0)
+            for user_id, group_id in Membership.objects.values_list('user_id', 'chatgroup_id').iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0009_groupmessage_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadMarker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to='a_rtchat.chatgroup')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'group'), name='readmarker_user_group_unique')],
+            },
+        ),
+        migrations.RunPython(create_markers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-17 05:28
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0010_readmarker'),
+    ]
+
+    operations = [
+        # The column is the same either way. Altering it on SQLite would remake
+        # the table and drop the search triggers of 0009.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='groupmessage',
+                    name='created',
+                    field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+                ),
+            ],
+        ),
+    ]
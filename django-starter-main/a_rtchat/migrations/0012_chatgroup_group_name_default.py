@@ -0,0 +1,24 @@
+# Generated by Django 5.1.7 on 2026-10-17 06:02
+
+import a_rtchat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0011_groupmessage_created_default'),
+    ]
+
+    operations = [
+        # Defaults live in Python only; the column doesn't change
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='chatgroup',
+                    name='group_name',
+                    field=models.CharField(default=a_rtchat.models.new_group_name, max_length=128, unique=True),
+                ),
+            ],
+        ),
+    ]
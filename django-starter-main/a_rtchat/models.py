@@ -1,27 +1,122 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
 import shortuuid
 # Create your models here.
 
+MESSAGE_PREVIEW_LENGTH = 100
+
+
+def new_group_name():
+  """
+  Default group_name of a new chatroom.
+
+  A module-level function rather than shortuuid.uuid, a method of a new
+  ShortUUID object on every import, which makemigrations sees as a changed
+  default each time.
+  """
+  return shortuuid.uuid()
+
+
+def dm_key(user_id, other_user_id):
+  """
+  Canonical key of the private chat between two users, the same whichever side asks.
+  """
+  return '%d:%d' % tuple(sorted((user_id, other_user_id)))
+
+
+class ChatGroupQuerySet(models.QuerySet):
+  def by_activity(self):
+    """
+    Rooms with the most recent message first; rooms without messages last.
+    """
+    return self.order_by(models.F('last_message_at').desc(nulls_last=True), '-id')
+
+  def get_or_create_dm(self, user, other_user):
+    """
+    Return the private chat between two users, creating it if needed.
+
+    The lookup is a single query on the unique dm_key. If two requests race
+    to create the room, the loser's INSERT fails on that constraint and it
+    returns the winner's room instead.
+
+    Returns:
+        Tuple (chatroom, created)
+    """
+    key = dm_key(user.id, other_user.id)
+    chatroom = self.filter(dm_key=key).first()
+    if chatroom is not None:
+      return chatroom, False
+    try:
+      with transaction.atomic():
+        chatroom = self.create(is_private=True, dm_key=key)
+        chatroom.members.add(user, other_user)
+    except IntegrityError:
+      return self.get(dm_key=key), False
+    return chatroom, True
+
+
 class ChatGroup(models.Model):
-  group_name = models.CharField(max_length=128,unique=True,default=shortuuid.uuid)
+  group_name = models.CharField(max_length=128,unique=True,default=new_group_name)
   groupchat_name = models.CharField(max_length=128,null=True,blank=True)
   admin = models.ForeignKey(User,related_name='groupchats',blank=True,null=True,on_delete=models.SET_NULL)
-  users_online = models.ManyToManyField(User,related_name='online_in_groups',blank=True)
   members = models.ManyToManyField(User,related_name='chat_groups',blank=True)
   is_private = models.BooleanField(default=False)
+  # "<lower user id>:<higher user id>" for private chats, None otherwise
+  dm_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+  # Activity stats, kept up to date by a_rtchat.persistence on every new
+  # message (rebuild with `manage.py rebuild_room_stats`)
+  last_message_at = models.DateTimeField(null=True, blank=True)
+  last_message = models.ForeignKey('GroupMessage', related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+  message_count = models.PositiveIntegerField(default=0)
+  last_message_preview = models.CharField(max_length=MESSAGE_PREVIEW_LENGTH, blank=True, default='')
+
+  objects = ChatGroupQuerySet.as_manager()
 
   def __str__(self):
     return self.group_name
+
+  class Meta:
+    indexes = [
+      models.Index(fields=['-last_message_at'], name='chatgroup_activity_idx'),
+    ]
   
 class GroupMessage(models.Model):
   group = models.ForeignKey(ChatGroup,related_name='chat_messages' , on_delete=models.CASCADE)
   author = models.ForeignKey(User,on_delete=models.CASCADE)
   body = models.CharField(max_length=300)
-  created = models.DateTimeField(auto_now_add=True)
+  # Not auto_now_add: write-behind sets it when the message is broadcast
+  created = models.DateTimeField(default=timezone.now, editable=False)
 
   def __str__(self):
     return f'{self.author.username} : {self.body}'
   
   class Meta:
     ordering = ['-created']
+    indexes = [
+      # Keyset pagination of a room's history (a_rtchat.history)
+      models.Index(fields=['group', 'created', 'id'], name='groupmessage_history_idx'),
+    ]
+
+
+class ReadMarker(models.Model):
+  """
+  How far a member has read a chatroom, and how many messages they haven't.
+
+  unread_count is kept up to date incrementally by a_rtchat.unread: bumped
+  on the message write path, reset by the socket's "read" frames. The
+  marker is a plain id rather than a foreign key, since the message it
+  points to may still be in a write-behind batch or already archived.
+  """
+  user = models.ForeignKey(User, related_name='read_markers', on_delete=models.CASCADE)
+  group = models.ForeignKey(ChatGroup, related_name='read_markers', on_delete=models.CASCADE)
+  last_read_message_id = models.BigIntegerField(default=0)
+  unread_count = models.PositiveIntegerField(default=0)
+
+  def __str__(self):
+    return f'{self.user_id} in {self.group_id}: {self.unread_count} unread'
+
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['user', 'group'], name='readmarker_user_group_unique'),
+    ]
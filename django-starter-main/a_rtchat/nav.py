@@ -0,0 +1,122 @@
+"""
+Cached per-user room index for the header's chat dropdown.
+
+The header is on every page. Instead of walking the user's rooms and the
+members of each private chat on every render, the list is built once (two
+queries whatever the number of rooms) and cached per user:
+
+    {
+        'me': {'name': 'Alice', 'avatar': '/media/avatars/a.png'},
+        'rooms': [
+            {'group_name': 'x9..', 'name': 'Friends', 'is_private': False,
+             'username': None, 'avatar': None, 'preview': 'see you'},
+            {'group_name': 'k2..', 'name': 'Bob', 'is_private': True,
+             'username': 'bob', 'avatar': '/static/images/avatar.svg', 'preview': 'hi'},
+        ],
+    }
+
+Rooms are ordered by recent activity at the time the index was built.
+Entries are dropped by the signal handlers in a_rtchat.signals when the
+user's memberships, a listed room, or the profile of the user or of a DM
+partner change, and expire after CHAT_NAV_TIMEOUT seconds regardless (which
+also bounds how stale the activity order gets).
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from a_rtchat.models import ChatGroup
+from a_users.models import Profile
+
+
+def nav_cache():
+    return caches[getattr(settings, 'CHAT_NAV_CACHE', 'default')]
+
+
+def nav_timeout():
+    return getattr(settings, 'CHAT_NAV_TIMEOUT', 300)
+
+
+def nav_key(user_id):
+    return f'chat:nav:{user_id}'
+
+
+def get_room_index(user_id):
+    """
+    Return the cached room index of the user, building it if needed.
+    """
+    cache = nav_cache()
+    index = cache.get(nav_key(user_id))
+    if index is None:
+        index = build_room_index(user_id)
+        cache.set(nav_key(user_id), index, nav_timeout())
+    return index
+
+
+def build_room_index(user_id):
+    """
+    Build the room index of the user with two queries.
+
+    The other participant of a private chat comes from its dm_key, so the
+    members of the rooms are never loaded.
+    """
+    rooms = [
+        room for room in
+        ChatGroup.objects.filter(members=user_id).by_activity()
+        .values('group_name', 'groupchat_name', 'is_private', 'dm_key', 'last_message_preview')
+        # Same rooms the header always listed: named group chats and DMs
+        if room['is_private'] or room['groupchat_name']
+    ]
+    for room in rooms:
+        room['partner_id'] = other_user_id(room['dm_key'], user_id)
+    profiles = {
+        profile.user_id: profile
+        for profile in Profile.objects.select_related('user').filter(
+            user_id__in={user_id, *(room['partner_id'] for room in rooms if room['partner_id'])}
+        )
+    }
+
+    entries = []
+    for room in rooms:
+        entry = {
+            'group_name': room['group_name'],
+            'name': room['groupchat_name'],
+            'is_private': room['is_private'],
+            'username': None,
+            'avatar': None,
+            'preview': room['last_message_preview'],
+        }
+        if room['is_private']:
+            partner = profiles.get(room['partner_id'])
+            if partner is None:
+                continue  # Not a two-person chat
+            entry.update(name=partner.name, username=partner.user.username, avatar=partner.avatar_url(64))
+        entries.append(entry)
+
+    me = profiles.get(user_id)
+    return {
+        'me': {'name': me.name, 'avatar': me.avatar_url(64)} if me else None,
+        'rooms': entries,
+    }
+
+
+def other_user_id(dm_key, user_id):
+    if not dm_key:
+        return None
+    first, second = (int(part) for part in dm_key.split(':'))
+    return second if first == user_id else first
+
+
+def invalidate_users(user_ids):
+    nav_cache().delete_many([nav_key(user_id) for user_id in user_ids])
+
+
+def dm_partner_ids(user_id):
+    """
+    Ids of the users who have a private chat with the user (and so show their profile).
+    """
+    return (
+        ChatGroup.members.through.objects
+        .filter(chatgroup__is_private=True, chatgroup__members=user_id)
+        .exclude(user_id=user_id)
+        .values_list('user_id', flat=True)
+    )
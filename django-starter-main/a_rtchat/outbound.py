@@ -0,0 +1,193 @@
+"""
+Per-connection outbound queue with backpressure.
+
+Channel-layer handlers don't send frames directly; they put them on the
+socket's OutboundQueue and return, so the consumer keeps draining its
+channel-layer inbox even when the client is slow to read. A single task
+per socket writes the queue out in order. When the queue fills up:
+
+    1. a new presence diff is merged into the one already waiting (only the
+       latest count and the net online/offline change matter)
+    2. the oldest pending presence frame is dropped
+    3. if only chat messages are left, the client is too far behind and the
+       consumer closes the socket (close code 4008); the same happens when
+       the oldest frame has been waiting longer than MAX_LAG seconds
+
+If writing a frame fails (the socket is already gone), the queue stops:
+later frames are discarded and on_failed lets the consumer close.
+
+Limits come from settings.CHAT_OUTBOUND:
+
+    CHAT_OUTBOUND = {
+        'MAX_FRAMES': 256,
+        'MAX_LAG': 30,
+    }
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import Counter, deque
+
+from django.conf import settings
+
+DEFAULT_OUTBOUND = {
+    'MAX_FRAMES': 256,
+    'MAX_LAG': 30,
+}
+
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+logger = logging.getLogger(__name__)
+
+MESSAGE = 'message'
+PRESENCE = 'presence'
+
+# Process-wide counters, summed over every OutboundQueue
+totals = Counter()
+_queues = weakref.WeakSet()
+
+
+def outbound_settings():
+    return {**DEFAULT_OUTBOUND, **getattr(settings, 'CHAT_OUTBOUND', {})}
+
+
+def queue_depths():
+    """
+    Returns:
+        Tuple (total, deepest) of frames waiting in this process's open queues.
+    """
+    depths = [queue.depth for queue in list(_queues)]
+    return sum(depths), max(depths, default=0)
+
+
+class _Frame:
+    __slots__ = ('kind', 'text', 'data', 'queued_at')
+
+    def __init__(self, kind, text, data):
+        self.kind = kind
+        self.text = text
+        self.data = data
+        self.queued_at = time.monotonic()
+
+
+class SlowConsumer(Exception):
+    """
+    Raised by OutboundQueue.put when the client has fallen too far behind.
+    """
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of text frames for one socket.
+
+    Parameters:
+        send: coroutine function taking the frame text
+        render_presence: function turning merged presence data
+                         (online_count, online, offline) back into a frame
+        on_sent: optional function called with the data of each chat
+                 message frame once it has been written
+        on_failed: optional coroutine function called with the exception
+                   when writing a frame fails
+    """
+
+    def __init__(self, send, render_presence, max_frames=256, max_lag=30, on_sent=None, on_failed=None):
+        self.send = send
+        self.render_presence = render_presence
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.failed = False
+        self.max_frames = max_frames
+        self.max_lag = max_lag
+        self.frames = deque()
+        self.stats = Counter()
+        self._ready = asyncio.Event()
+        _queues.add(self)
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def put(self, text, kind=MESSAGE, data=None):
+        """
+        Queue a frame. `data` is passed to on_sent once a message frame is written.
+
+        Raises:
+            SlowConsumer if the frame can't be queued without dropping chat messages.
+        """
+        if self.failed:
+            return
+        self._check_lag()
+        if len(self.frames) >= self.max_frames and not self._drop_oldest_presence():
+            self._count('slow_consumer')
+            raise SlowConsumer()
+        self.frames.append(_Frame(kind, text, data))
+        self._queued()
+
+    def put_presence(self, online_count, online, offline, text):
+        """
+        Queue a presence diff, merging it into a pending one if there is any.
+        """
+        if self.failed:
+            return
+        pending = next((frame for frame in reversed(self.frames) if frame.kind == PRESENCE), None)
+        if pending is not None:
+            _, pending_online, pending_offline = pending.data
+            pending_online = (pending_online - set(offline)) | set(online)
+            pending_offline = (pending_offline - set(online)) | set(offline)
+            pending.data = (online_count, pending_online, pending_offline)
+            pending.text = None  # re-rendered when it is sent
+            self._count('collapsed')
+            return
+        self.put(text, kind=PRESENCE)
+        self.frames[-1].data = (online_count, set(online), set(offline))
+
+    async def run(self):
+        """
+        Write queued frames to the socket, in order, until cancelled or a write fails.
+        """
+        while True:
+            if not self.frames:
+                self._ready.clear()
+                await self._ready.wait()
+            frame = self.frames.popleft()
+            text = frame.text
+            if text is None:
+                online_count, online, offline = frame.data
+                text = self.render_presence(online_count, sorted(online), sorted(offline))
+            try:
+                await self.send(text)
+            except Exception as error:
+                self.failed = True
+                self.frames.clear()
+                self._count('send_failed')
+                logger.warning('Sending a frame failed, closing the socket: %r', error)
+                if self.on_failed is not None:
+                    await self.on_failed(error)
+                return
+            self._count('sent')
+            if frame.kind == MESSAGE and frame.data is not None and self.on_sent is not None:
+                self.on_sent(frame.data)
+
+    def _queued(self):
+        self._count('queued')
+        if len(self.frames) > self.stats['high_water']:
+            self.stats['high_water'] = len(self.frames)
+        self._ready.set()
+
+    def _drop_oldest_presence(self):
+        for frame in self.frames:
+            if frame.kind == PRESENCE:
+                self.frames.remove(frame)
+                self._count('dropped_presence')
+                return True
+        return False
+
+    def _check_lag(self):
+        if self.frames and time.monotonic() - self.frames[0].queued_at > self.max_lag:
+            self._count('slow_consumer')
+            raise SlowConsumer()
+
+    def _count(self, name):
+        self.stats[name] += 1
+        totals[name] += 1
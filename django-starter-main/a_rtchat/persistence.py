@@ -0,0 +1,337 @@
+"""
+Chat message persistence.
+
+save_message() is the single write path for new messages. By default it
+does a plain INSERT before returning, so a message is durable before it is
+broadcast. With write-behind enabled the message gets its id up front, is
+returned (and broadcast) immediately, and a background thread writes the
+pending messages with bulk_create in batches:
+
+    CHAT_WRITE_BEHIND = {
+        'ENABLED': False,        # durability (False) vs throughput (True)
+        'BATCH_SIZE': 200,       # flush as soon as this many are pending
+        'FLUSH_INTERVAL': 0.05,  # ... or after this many seconds
+        'ID_BLOCK_SIZE': 100,    # ids reserved from the DB per round trip
+        'ID_FILE': None,         # share the reserved ids between processes
+    }
+
+Ids are the ordering key: replay, read markers and unread counters all
+compare them. They are reserved in blocks from the table's own id
+sequence, so rows inserted by other code paths can never collide with
+them. A block held by one process would hand out ids older than those
+another process already broadcast, so with several worker processes set
+ID_FILE: the current block then lives in a small SQLite file (like
+a_rtchat.presence.FilePresenceStore) and every process on the host takes
+the next id of the same sequence. The id, the created timestamp and the
+place in the queue are assigned together, and `created` is stored as
+broadcast. One flusher thread writes batches in submission order, so
+messages of a room are stored in the order they were broadcast. Pending messages are
+flushed when the process exits; a crash loses at most the last
+FLUSH_INTERVAL worth of messages, which is the trade-off being switched on.
+
+A batch that fails to write (the database is locked or gone) goes back to
+the front of the queue and is retried with exponential backoff, up to
+MAX_RETRY_DELAY seconds apart; the flusher thread never dies of it. A batch
+violating a constraint (its room was deleted meanwhile) is retried message
+by message, and the messages that still fail are logged and dropped.
+
+Both paths keep the room's activity stats (ChatGroup.last_message_at,
+last_message, message_count, last_message_preview) and its members' unread
+counters (see a_rtchat.unread) current in the same transaction as the
+insert, with one UPDATE of each per room per write.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from a_rtchat.models import MESSAGE_PREVIEW_LENGTH, ChatGroup, GroupMessage
+from a_rtchat.unread import record_unread
+
+logger = logging.getLogger(__name__)
+
+# Longest wait between retries of a batch that failed to write, in seconds
+MAX_RETRY_DELAY = 5.0
+
+DEFAULT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.05,
+    'ID_BLOCK_SIZE': 100,
+    'ID_FILE': None,
+}
+
+
+def reserve_message_ids(count):
+    """
+    Reserve `count` ids from the GroupMessage primary key sequence.
+
+    Returns:
+        A list of ids no other insert will ever use.
+    """
+    table = GroupMessage._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT never hands out ids at or below sqlite_sequence.seq,
+            # so bumping it reserves the range for us. Write first so the
+            # transaction takes the write lock up front.
+            cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s', [count, table])
+            if cursor.rowcount:
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                last = cursor.fetchone()[0] - count
+            else:
+                cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+                last = cursor.fetchone()[0]
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, last + count])
+            return list(range(last + 1, last + count + 1))
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+    raise ImproperlyConfigured(f'Write-behind message persistence does not support {connection.vendor}')
+
+
+class SharedIdSequence:
+    """
+    Hands out the ids of blocks reserved from the DB to every process on the
+    host, in one increasing sequence.
+
+    The current block is a single row of a SQLite file; taking an id is one
+    short transaction on it, and only every `block_size`-th one reserves a
+    new block from the main database.
+    """
+
+    def __init__(self, path, block_size=100):
+        self.path = str(path)
+        self.block_size = block_size
+        self._local = threading.local()
+        db = self._connection()
+        db.execute('CREATE TABLE IF NOT EXISTS message_ids (next INTEGER NOT NULL, last INTEGER NOT NULL)')
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            self._local.db = db
+        return db
+
+    def next_id(self):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT next, last FROM message_ids').fetchone()
+            if row is None or row[0] > row[1]:
+                ids = reserve_message_ids(self.block_size)
+                row = (ids[0], ids[-1])
+            db.execute('DELETE FROM message_ids')
+            db.execute('INSERT INTO message_ids VALUES (?, ?)', (row[0] + 1, row[1]))
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return row[0]
+
+
+def record_room_activity(group_id, count, last_message):
+    """
+    Bump a room's activity stats for `count` new messages ending with `last_message`.
+
+    The last_* fields only move forward: if a concurrent writer already
+    recorded a newer message, only the count changes (a second, rare UPDATE).
+    """
+    rooms = ChatGroup.objects.filter(id=group_id)
+    updated = rooms.filter(Q(last_message_id__isnull=True) | Q(last_message_id__lt=last_message.id)).update(
+        message_count=F('message_count') + count,
+        last_message_id=last_message.id,
+        last_message_at=last_message.created,
+        last_message_preview=last_message.body[:MESSAGE_PREVIEW_LENGTH],
+    )
+    if not updated:
+        rooms.update(message_count=F('message_count') + count)
+
+
+class MessageWriter:
+    """
+    Buffers new messages and writes them with bulk_create from a background thread.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=0.05, id_block_size=100, id_file=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block_size = id_block_size
+        self._shared_ids = SharedIdSequence(id_file, id_block_size) if id_file else None
+        self._ids = []
+        self._ids_lock = threading.Lock()
+        self._pending = []
+        self._wakeup = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='chat-message-writer', daemon=True)
+        self._thread.start()
+
+    def next_id(self):
+        if self._shared_ids is not None:
+            return self._shared_ids.next_id()
+        with self._ids_lock:
+            if not self._ids:
+                self._ids = reserve_message_ids(self.id_block_size)
+            return self._ids.pop(0)
+
+    def submit(self, message):
+        """
+        Assign an id to an unsaved GroupMessage and queue it for writing.
+        """
+        with self._wakeup:
+            # Together, so ids, timestamps and queue order agree
+            message.id = self.next_id()
+            message.created = timezone.now()
+            self._pending.append(message)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.notify()
+        return message
+
+    def flush(self):
+        """
+        Write everything pending now. Safe to call from any thread.
+
+        If the write fails, the batch is put back at the front of the queue
+        and the error is raised.
+
+        Returns:
+            Number of messages written.
+        """
+        with self._flush_lock:
+            with self._wakeup:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                return self._write(batch)
+            except Exception:
+                with self._wakeup:
+                    self._pending[:0] = batch
+                raise
+
+    def _write(self, batch):
+        try:
+            self._write_batch(batch)
+            return len(batch)
+        except IntegrityError:
+            if len(batch) == 1:
+                raise
+        # One bad message must not hold up the others
+        written = 0
+        for message in batch:
+            try:
+                self._write_batch([message])
+                written += 1
+            except IntegrityError:
+                logger.exception('Dropping chat message %s of room %s', message.id, message.group_id)
+        return written
+
+    def _write_batch(self, batch):
+        rooms = {}
+        for message in batch:
+            rooms.setdefault(message.group_id, []).append(message)
+        with transaction.atomic():
+            GroupMessage.objects.bulk_create(batch, batch_size=self.batch_size)
+            for group_id, messages in rooms.items():
+                record_room_activity(group_id, len(messages), messages[-1])
+                record_unread(group_id, messages)
+
+    def close(self):
+        """
+        Stop the flusher thread and write whatever is still pending.
+        """
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._wakeup:
+                if failures:
+                    # Back off even if batches fill up meanwhile
+                    deadline = time.monotonic() + min(self.flush_interval * 2 ** min(failures, 16), MAX_RETRY_DELAY)
+                    while not self._closed and time.monotonic() < deadline:
+                        self._wakeup.wait(deadline - time.monotonic())
+                elif not self._closed and len(self._pending) < self.batch_size:
+                    self._wakeup.wait(self.flush_interval)
+                if self._closed:
+                    return
+            close_old_connections()
+            try:
+                self.flush()
+                failures = 0
+            except Exception:
+                failures += 1
+                logger.exception('Writing chat messages failed (attempt %d), retrying', failures)
+
+
+def write_behind_settings():
+    return {**DEFAULT_WRITE_BEHIND, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+@lru_cache(maxsize=None)
+def get_message_writer():
+    """
+    Return the process-wide MessageWriter, or None if write-behind is disabled.
+    """
+    config = write_behind_settings()
+    if not config['ENABLED']:
+        return None
+    writer = MessageWriter(
+        batch_size=config['BATCH_SIZE'],
+        flush_interval=config['FLUSH_INTERVAL'],
+        id_block_size=config['ID_BLOCK_SIZE'],
+        id_file=config['ID_FILE'],
+    )
+    atexit.register(writer.close)
+    return writer
+
+
+@receiver(setting_changed)
+def reset_message_writer(setting, **kwargs):
+    if setting == 'CHAT_WRITE_BEHIND':
+        if get_message_writer.cache_info().currsize:
+            writer = get_message_writer()
+            if writer is not None:
+                atexit.unregister(writer.close)
+                writer.close()
+        get_message_writer.cache_clear()
+
+
+def save_message(author, group_id, body):
+    """
+    Store a new chat message.
+
+    Returns:
+        The GroupMessage, with its id set. Depending on CHAT_WRITE_BEHIND the
+        row is either already written or queued for the next batch.
+    """
+    message = GroupMessage(author=author, group_id=group_id, body=body)
+    writer = get_message_writer()
+    if writer is None:
+        with transaction.atomic():
+            message.save()
+            record_room_activity(group_id, 1, message)
+            record_unread(group_id, [message])
+        return message
+    return writer.submit(message)
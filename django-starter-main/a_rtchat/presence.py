@@ -0,0 +1,419 @@
+"""
+Presence registry for chat rooms.
+
+Tracks who is online in which room without touching the main database.
+Every open socket registers a connection under (room, user); a user is
+online while at least one of their connections is alive, so closing one of
+several tabs doesn't mark them offline. Connections carry an expiry that
+the consumer refreshes with heartbeats, so entries left behind by a crashed
+process simply time out. Heartbeats also sweep the room: users whose last
+connection timed out are reported once, so the room hears they went offline.
+
+The store is pluggable through settings.CHAT_PRESENCE, in the same shape
+as CHANNEL_LAYERS:
+
+    CHAT_PRESENCE = {
+        'BACKEND': 'a_rtchat.presence.InMemoryPresenceStore',
+        'TTL': 60,
+        'HEARTBEAT_INTERVAL': 20,
+        'BROADCAST_WINDOW': 0.25,
+        'OPTIONS': {},
+    }
+
+Changes are not broadcast one by one: PresenceCoalescer collects them per
+room for BROADCAST_WINDOW seconds and emits a single diff, so a reconnect
+storm produces a handful of frames per room.
+
+InMemoryPresenceStore only sees sockets of its own process. Use
+FilePresenceStore (a small SQLite file shared by every worker on the host)
+when running several processes.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+DEFAULT_PRESENCE = {
+    'BACKEND': 'a_rtchat.presence.InMemoryPresenceStore',
+    'TTL': 60,
+    'HEARTBEAT_INTERVAL': 20,
+    'BROADCAST_WINDOW': 0.25,
+    'OPTIONS': {},
+}
+
+# A room's expired connections are swept by at most one heartbeat per second
+# per process, not by every socket's
+SWEEP_INTERVAL = 1.0
+
+
+class BasePresenceStore:
+    """
+    Interface every presence store implements.
+
+    Rooms are identified by their group_name and users by id. A connection
+    id is anything unique per socket; consumers use their channel name.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._next_sweep = {}
+
+    def _sweep_due(self, room, now):
+        if now < self._next_sweep.get(room, 0):
+            return False
+        self._next_sweep[room] = now + SWEEP_INTERVAL
+        return True
+
+    def connect(self, room, user_id, connection_id):
+        """
+        Register a connection. Returns True if the user just came online.
+        """
+        raise NotImplementedError
+
+    def disconnect(self, room, user_id, connection_id):
+        """
+        Drop a connection. Returns True if it was the user's last one.
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, room, user_id, connection_id):
+        """
+        Push back the expiry of a live connection and drop the room's expired ones.
+
+        Returns:
+            Set of user ids whose last connection in the room had expired;
+            each is reported by one heartbeat only.
+        """
+        raise NotImplementedError
+
+    def online(self, room):
+        """
+        Return the set of user ids with at least one live connection.
+        """
+        raise NotImplementedError
+
+    def remove_users(self, room, user_ids):
+        """
+        Drop every connection of these users in the room, e.g. when they are
+        removed from it. Returns the set of those who were online.
+        """
+        raise NotImplementedError
+
+    def count(self, room):
+        return len(self.online(room))
+
+    def is_online(self, room, user_id):
+        return user_id in self.online(room)
+
+
+class InMemoryPresenceStore(BasePresenceStore):
+    """
+    Presence store kept in a dict of the current process.
+    """
+
+    def __init__(self, ttl=60):
+        super().__init__(ttl)
+        # room -> user_id -> connection_id -> expires_at
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def _live_connections(self, room, user_id, now):
+        connections = self._rooms.get(room, {}).get(user_id)
+        if not connections:
+            return {}
+        for connection_id, expires_at in list(connections.items()):
+            if expires_at <= now:
+                del connections[connection_id]
+        return connections
+
+    def connect(self, room, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            was_online = bool(self._live_connections(room, user_id, now))
+            users = self._rooms.setdefault(room, {})
+            users.setdefault(user_id, {})[connection_id] = now + self.ttl
+            return not was_online
+
+    def disconnect(self, room, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            connections = self._live_connections(room, user_id, now)
+            if connection_id not in connections:
+                return False
+            del connections[connection_id]
+            if connections:
+                return False
+            del self._rooms[room][user_id]
+            if not self._rooms[room]:
+                del self._rooms[room]
+            return True
+
+    def heartbeat(self, room, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            users = self._rooms.get(room)
+            if not users:
+                return set()
+            connections = users.get(user_id)
+            if connections is not None and connection_id in connections:
+                connections[connection_id] = now + self.ttl
+            if not self._sweep_due(room, now):
+                return set()
+            return {other for other in list(users) if not self._prune_user(room, other, now)}
+
+    def _prune_user(self, room, user_id, now):
+        # Drop expired connections, and the user and room once empty;
+        # returns whether the user is still online
+        if self._live_connections(room, user_id, now):
+            return True
+        users = self._rooms[room]
+        del users[user_id]
+        if not users:
+            del self._rooms[room]
+        return False
+
+    def remove_users(self, room, user_ids):
+        now = time.time()
+        with self._lock:
+            users = self._rooms.get(room)
+            if not users:
+                return set()
+            went_offline = {user_id for user_id in user_ids if self._live_connections(room, user_id, now)}
+            for user_id in user_ids:
+                users.pop(user_id, None)
+            if not users:
+                del self._rooms[room]
+            return went_offline
+
+    def online(self, room):
+        now = time.time()
+        with self._lock:
+            users = self._rooms.get(room)
+            if not users:
+                return set()
+            # Read only: expired users are left for heartbeat() to report
+            return {
+                user_id for user_id, connections in users.items()
+                if any(expires_at > now for expires_at in connections.values())
+            }
+
+
+class FilePresenceStore(BasePresenceStore):
+    """
+    Presence store backed by a SQLite file, shared by every process on the host.
+
+    This is deliberately not the Django database: presence writes are
+    frequent, disposable and must not contend with message writes.
+    """
+
+    def __init__(self, ttl=60, path=None):
+        super().__init__(ttl)
+        self.path = str(path or settings.BASE_DIR / 'presence.sqlite3')
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS presence ('
+                ' room TEXT NOT NULL, user_id INTEGER NOT NULL,'
+                ' connection_id TEXT NOT NULL, expires_at REAL NOT NULL,'
+                ' PRIMARY KEY (room, user_id, connection_id))'
+            )
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            self._local.db = db
+        return _Transaction(db)
+
+    def _user_live(self, db, room, user_id, now):
+        return db.execute(
+            'SELECT 1 FROM presence WHERE room = ? AND user_id = ? AND expires_at > ? LIMIT 1',
+            (room, user_id, now),
+        ).fetchone() is not None
+
+    def connect(self, room, user_id, connection_id):
+        now = time.time()
+        with self._connection() as db:
+            was_online = self._user_live(db, room, user_id, now)
+            # Other users' expired rows are left for heartbeat() to report
+            db.execute('DELETE FROM presence WHERE room = ? AND user_id = ? AND expires_at <= ?', (room, user_id, now))
+            db.execute(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+                (room, user_id, connection_id, now + self.ttl),
+            )
+            return not was_online
+
+    def disconnect(self, room, user_id, connection_id):
+        now = time.time()
+        with self._connection() as db:
+            deleted = db.execute(
+                'DELETE FROM presence WHERE room = ? AND user_id = ? AND connection_id = ? AND expires_at > ?',
+                (room, user_id, connection_id, now),
+            ).rowcount
+            return bool(deleted) and not self._user_live(db, room, user_id, now)
+
+    def heartbeat(self, room, user_id, connection_id):
+        now = time.time()
+        with self._connection() as db:
+            db.execute(
+                'UPDATE presence SET expires_at = ? WHERE room = ? AND user_id = ? AND connection_id = ?',
+                (now + self.ttl, room, user_id, connection_id),
+            )
+            if not self._sweep_due(room, now):
+                return set()
+            rows = db.execute(
+                'SELECT DISTINCT user_id FROM presence WHERE room = ? AND expires_at <= ?'
+                ' AND user_id NOT IN (SELECT user_id FROM presence WHERE room = ? AND expires_at > ?)',
+                (room, now, room, now),
+            )
+            expired = {user_id for (user_id,) in rows}
+            # In the same transaction, so only one process reports them
+            db.execute('DELETE FROM presence WHERE room = ? AND expires_at <= ?', (room, now))
+            return expired
+
+    def remove_users(self, room, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        placeholders = ', '.join('?' * len(user_ids))
+        with self._connection() as db:
+            rows = db.execute(
+                f'SELECT DISTINCT user_id FROM presence'
+                f' WHERE room = ? AND user_id IN ({placeholders}) AND expires_at > ?',
+                (room, *user_ids, time.time()),
+            )
+            went_offline = {user_id for (user_id,) in rows}
+            db.execute(
+                f'DELETE FROM presence WHERE room = ? AND user_id IN ({placeholders})',
+                (room, *user_ids),
+            )
+            return went_offline
+
+    def online(self, room):
+        with self._connection() as db:
+            rows = db.execute(
+                'SELECT DISTINCT user_id FROM presence WHERE room = ? AND expires_at > ?',
+                (room, time.time()),
+            )
+            return {user_id for (user_id,) in rows}
+
+
+class _Transaction:
+    """
+    Run a block inside BEGIN IMMEDIATE / COMMIT on an autocommit connection.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class PresenceCoalescer:
+    """
+    Merge presence changes per room over a short window into one diff.
+
+    record() is called from the event loop whenever a user comes online or
+    goes offline. The first change in a room schedules a flush `window`
+    seconds later; by then a user who dropped and came back within the window
+    cancels out and only net changes are passed to `broadcast`.
+
+    The instance is shared by the whole process. A pending flush whose event
+    loop is gone (a finished async_to_sync call, a test's loop) never runs,
+    so record() only joins a pending flush of the running loop; otherwise
+    it starts a new window.
+    """
+
+    def __init__(self, window=0.25):
+        self.window = window
+        # room -> (flush task, {user_id: (online before the window, online now)})
+        self._pending = {}
+        self._tasks = set()
+
+    def record(self, room, user_id, online, broadcast):
+        """
+        Note that `user_id` went online/offline in `room`.
+
+        Parameters:
+            broadcast: coroutine function called as broadcast(room, online, offline)
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(room)
+        if pending is None or pending[0].done() or pending[0].get_loop() is not loop:
+            changes = {}
+            task = loop.create_task(self._flush(room, changes, broadcast))
+            self._pending[room] = (task, changes)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            changes = pending[1]
+        was_online = changes[user_id][0] if user_id in changes else not online
+        changes[user_id] = (was_online, online)
+
+    async def wait(self, room):
+        """
+        Wait until the pending flush of `room` in the running loop has run.
+
+        A socket that disconnects waits for the window it queued its change
+        in, so the flush isn't left pending if the loop closes right after
+        (an async_to_sync call or a test ending).
+        """
+        pending = self._pending.get(room)
+        if pending is not None and pending[0].get_loop() is asyncio.get_running_loop():
+            # Shielded: other sockets' changes are in it too
+            await asyncio.shield(pending[0])
+
+    async def _flush(self, room, changes, broadcast):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            # Also when cancelled or dropped with its loop, so the room gets
+            # a new window next time
+            if self._pending.get(room, (None, None))[1] is changes:
+                del self._pending[room]
+        online = [user_id for user_id, (was, now) in changes.items() if now and not was]
+        offline = [user_id for user_id, (was, now) in changes.items() if was and not now]
+        if online or offline:
+            await broadcast(room, online, offline)
+
+
+def presence_settings():
+    return {**DEFAULT_PRESENCE, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+@lru_cache(maxsize=None)
+def get_presence_store():
+    """
+    Return the process-wide presence store configured in settings.CHAT_PRESENCE.
+    """
+    config = presence_settings()
+    backend = import_string(config['BACKEND'])
+    return backend(ttl=config['TTL'], **config['OPTIONS'])
+
+
+@lru_cache(maxsize=None)
+def get_presence_coalescer():
+    """
+    Return the process-wide PresenceCoalescer.
+    """
+    return PresenceCoalescer(window=presence_settings()['BROADCAST_WINDOW'])
+
+
+@receiver(setting_changed)
+def reset_presence_store(setting, **kwargs):
+    if setting == 'CHAT_PRESENCE':
+        get_presence_store.cache_clear()
+        get_presence_coalescer.cache_clear()
@@ -0,0 +1,70 @@
+"""
+Compact JSON wire protocol for chat sockets.
+
+The default protocol sends HTML fragments for htmx's ws extension. A client
+that opens the socket with the `chat.json.v1` subprotocol gets small JSON
+events instead and renders them itself (static/js/chat_client.js):
+
+    {"t": "hello", "me": 5, "c": 3, "on": [5, 8, 9]}
+    {"t": "m", "id": 12, "a": {"id": 8, "u": "bob", "n": "Bob", "av": "/media/..."}, "b": "hi"}
+    {"t": "p", "c": 4, "on": [7], "off": []}
+    {"t": "r", "url": "/"}
+    {"t": "e", "code": "rate_limited", "retry_after": 1.5}
+    {"t": "replay", "m": [<message>, ...], "more": false}
+
+Frames are built once by whoever produces the event and shipped as
+strings, so subscribers send them without re-encoding.
+"""
+import json
+
+JSON_SUBPROTOCOL = 'chat.json.v1'
+
+
+def dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+def message_data(message):
+    """
+    A GroupMessage as a dict. The author and profile must already be loaded.
+    """
+    author = message.author
+    return {
+        't': 'm',
+        'id': message.id,
+        'a': {
+            'id': author.id,
+            'u': author.username,
+            'n': author.profile.name,
+            'av': author.profile.avatar_url(64),
+        },
+        'b': message.body,
+    }
+
+
+def message_frame(message):
+    return dumps(message_data(message))
+
+
+def replay_frame(messages, more):
+    """
+    Messages missed while disconnected, oldest first; `more` is True if
+    older ones were left out and the client should reload the history.
+    """
+    return dumps({'t': 'replay', 'm': [message_data(message) for message in messages], 'more': more})
+
+
+def presence_frame(online_count, online, offline):
+    return dumps({'t': 'p', 'c': online_count, 'on': list(online), 'off': list(offline)})
+
+
+def hello_frame(user_id, online_user_ids):
+    return dumps({'t': 'hello', 'me': user_id, 'c': len(online_user_ids), 'on': list(online_user_ids)})
+
+
+def redirect_frame(url):
+    return dumps({'t': 'r', 'url': url})
+
+
+def error_frame(code, **fields):
+    return dumps({'t': 'e', 'code': code, **fields})
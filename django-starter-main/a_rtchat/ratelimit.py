@@ -0,0 +1,132 @@
+"""
+In-process token-bucket rate limiting for new chat messages.
+
+Every message costs one token from the author's bucket and one from the
+room's bucket. Buckets refill continuously at RATE tokens per second up to
+BURST. A message is only accepted if both buckets have a token; otherwise
+nothing is taken and the caller gets the number of seconds to wait.
+
+    CHAT_RATE_LIMITS = {
+        'USER': {'RATE': 1, 'BURST': 10},   # per user, across rooms
+        'ROOM': {'RATE': 20, 'BURST': 50},  # per room, across users
+    }
+
+Set a scope to None to disable it. Buckets live in the memory of the
+process handling the socket or request, so with several workers the
+effective limit is per worker. Full buckets are forgotten once a scope
+holds more than MAX_BUCKETS; if most of them are still draining, the next
+sweep waits until the count has doubled, so a sweep costs O(1) per call
+amortised.
+"""
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULT_RATE_LIMITS = {
+    'USER': {'RATE': 1, 'BURST': 10},
+    'ROOM': {'RATE': 20, 'BURST': 50},
+    'MAX_BUCKETS': 100000,
+}
+
+
+class TokenBuckets:
+    """
+    A set of token buckets sharing one rate and burst, keyed by any hashable.
+
+    Buckets are stored as (tokens, timestamp) and only refilled when looked
+    at, so idle keys cost nothing but their dict entry.
+    """
+
+    def __init__(self, rate, burst, max_buckets=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.prune_at = max_buckets
+        self.buckets = {}
+
+    def level(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, stamp = bucket
+        return min(self.burst, tokens + (now - stamp) * self.rate)
+
+    def wait_time(self, tokens):
+        """
+        Seconds until a bucket holding `tokens` has a whole token.
+        """
+        return (1 - tokens) / self.rate
+
+    def take(self, key, tokens, now):
+        self.buckets[key] = (tokens - 1, now)
+        if len(self.buckets) > self.prune_at:
+            self.prune(now)
+            self.prune_at = max(self.max_buckets, 2 * len(self.buckets))
+
+    def prune(self, now):
+        """
+        Forget buckets that have refilled completely; they equal a new bucket.
+        """
+        self.buckets = {
+            key: (tokens, stamp) for key, (tokens, stamp) in self.buckets.items()
+            if tokens + (now - stamp) * self.rate < self.burst
+        }
+
+
+class ChatRateLimiter:
+    """
+    Per-user and per-room message limits. Thread safe.
+    """
+
+    def __init__(self, user=None, room=None, max_buckets=100000, clock=time.monotonic):
+        self.user = TokenBuckets(user['RATE'], user['BURST'], max_buckets) if user else None
+        self.room = TokenBuckets(room['RATE'], room['BURST'], max_buckets) if room else None
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def acquire(self, user_id, room_id):
+        """
+        Take a token for a new message by `user_id` in `room_id`.
+
+        Returns:
+            0 if the message is allowed, otherwise the number of seconds
+            until it would be.
+        """
+        now = self.clock()
+        user, room = self.user, self.room
+        with self._lock:
+            user_tokens = user.level(user_id, now) if user else 1
+            room_tokens = room.level(room_id, now) if room else 1
+            if user_tokens < 1 or room_tokens < 1:
+                return max(
+                    user.wait_time(user_tokens) if user_tokens < 1 else 0,
+                    room.wait_time(room_tokens) if room_tokens < 1 else 0,
+                )
+            if user:
+                user.take(user_id, user_tokens, now)
+            if room:
+                room.take(room_id, room_tokens, now)
+            return 0
+
+
+def rate_limit_settings():
+    return {**DEFAULT_RATE_LIMITS, **getattr(settings, 'CHAT_RATE_LIMITS', {})}
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter():
+    """
+    Return the process-wide ChatRateLimiter configured in settings.CHAT_RATE_LIMITS.
+    """
+    config = rate_limit_settings()
+    return ChatRateLimiter(config['USER'], config['ROOM'], max_buckets=config['MAX_BUCKETS'])
+
+
+@receiver(setting_changed)
+def reset_rate_limiter(setting, **kwargs):
+    if setting == 'CHAT_RATE_LIMITS':
+        get_rate_limiter.cache_clear()
@@ -0,0 +1,156 @@
+"""
+Full-text search over the messages of the rooms a user belongs to.
+
+On SQLite, messages are indexed by the a_rtchat_groupmessage_fts FTS5
+table (migration 0009), kept in sync by triggers on every insert, delete
+and edit. Results are ranked by bm25 and come with a highlighted snippet.
+Other databases fall back to a case-insensitive substring match, newest
+first, which scans every message of the user's rooms.
+
+The query is split into words; every word must match, and the last one
+also matches as a prefix so results show up while typing:
+
+    search_messages(user.id, 'deploy frid')  ->  "deploy" AND "frid"*
+
+Results are paginated by offset: ranked results have no stable cursor, and
+nobody reads page 50 of a search. MAX_PAGE bounds the cost of deep pages.
+
+    CHAT_SEARCH_PAGE_SIZE = 20
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from a_rtchat.models import ChatGroup, GroupMessage
+
+FTS_TABLE = 'a_rtchat_groupmessage_fts'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE = 50
+SNIPPET_TOKENS = 16
+
+# Control characters can't appear in a message typed in the browser, so
+# they are safe snippet markers to turn into <mark> after escaping
+_START, _END = '\x02', '\x03'
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def page_size():
+    return getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def uses_fts():
+    return connection.vendor == 'sqlite'
+
+
+def fts_query(text):
+    """
+    Turn what the user typed into an FTS5 query, or None if it has no words.
+
+    Every word is quoted, so FTS5 operators and column filters in the input
+    are searched for as plain text instead of being interpreted.
+    """
+    words = _WORD.findall(text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search_messages(user_id, text, page=1, size=None):
+    """
+    Search the messages of the rooms the user is a member of.
+
+    Parameters:
+        user_id: id of the user searching
+        text: the search box contents
+        page: 1-based page number, capped at MAX_PAGE
+        size: results per page, CHAT_SEARCH_PAGE_SIZE by default
+
+    Returns:
+        Tuple (results, has_more). results is a list of (message, snippet)
+        with the message's author, profile and group loaded; snippet is
+        safe HTML with the matches wrapped in <mark>.
+    """
+    size = size or page_size()
+    page = min(max(page, 1), MAX_PAGE)
+    offset = (page - 1) * size
+    if uses_fts():
+        hits = _fts_hits(user_id, text, offset, size + 1)
+    else:
+        hits = _scan_hits(user_id, text, offset, size + 1)
+    has_more = len(hits) > size
+    hits = hits[:size]
+
+    messages = GroupMessage.objects.select_related('author__profile', 'group').in_bulk([id for id, _ in hits])
+    results = [
+        (messages[id], _highlight(snippet))
+        for id, snippet in hits if id in messages  # Deleted since the search ran
+    ]
+    return results, has_more
+
+
+def _fts_hits(user_id, text, offset, limit):
+    query = fts_query(text)
+    if query is None:
+        return []
+    members = ChatGroup.members.through._meta.db_table
+    messages = GroupMessage._meta.db_table
+    # The match runs first and the few hits are then joined to the user's
+    # memberships; the rank orders them within the user's rooms only
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT m.id, snippet({FTS_TABLE}, 0, %s, %s, '…', %s)
+            FROM {FTS_TABLE} f
+            JOIN {messages} m ON m.id = f.rowid
+            JOIN {members} cm ON cm.chatgroup_id = m.group_id AND cm.user_id = %s
+            WHERE {FTS_TABLE} MATCH %s
+            ORDER BY bm25({FTS_TABLE}), m.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [_START, _END, SNIPPET_TOKENS, user_id, query, limit, offset],
+        )
+        return cursor.fetchall()
+
+
+def _scan_hits(user_id, text, offset, limit):
+    text = text.strip()
+    if not text:
+        return []
+    rows = (
+        GroupMessage.objects
+        .filter(group__members=user_id, body__icontains=text)
+        .order_by('-created', '-id')
+        .values_list('id', 'body')[offset:offset + limit]
+    )
+    return [(id, _mark_substring(body, text)) for id, body in rows]
+
+
+def _mark_substring(body, text):
+    start = body.lower().find(text.lower())
+    if start < 0:
+        return body
+    end = start + len(text)
+    return f'{body[:start]}{_START}{body[start:end]}{_END}{body[end:]}'
+
+
+def _highlight(snippet):
+    return mark_safe(escape(snippet).replace(_START, '<mark>').replace(_END, '</mark>'))
+
+
+def rebuild_index():
+    """
+    Rebuild the FTS index from the messages table (SQLite only).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def optimize_index():
+    """
+    Merge the FTS index b-trees into one, which makes queries faster (SQLite only).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
@@ -0,0 +1,124 @@
+from allauth.account.models import EmailAddress
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.db import transaction
+from django.dispatch import receiver
+
+from a_rtchat import acl, archive, nav, unread
+from a_rtchat.models import ChatGroup
+from a_users.models import Profile
+from a_users.thumbnails import thumbnails_recorded
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def chatgroup_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drop cached membership answers and room indexes when members are added or
+    removed, and create or delete the read markers of those memberships.
+
+    Covers both sides of the relation (chat_group.members.add(...) and
+    user.chat_groups.add(...)). For clear() the affected ids are only known
+    before the rows are gone, so they are collected on pre_clear.
+    """
+    if action == 'pre_clear':
+        if reverse:
+            instance._acl_cleared = list(instance.chat_groups.values_list('id', flat=True))
+        else:
+            instance._acl_cleared = list(instance.members.values_list('id', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_acl_cleared', [])
+    elif action not in ('post_add', 'post_remove'):
+        return
+
+    if reverse:
+        # instance is a User, pk_set holds chatgroup ids
+        for room_id in pk_set:
+            acl.invalidate_members(room_id, [instance.pk])
+        nav.invalidate_users([instance.pk])
+        room_ids, user_ids = pk_set, [instance.pk]
+    else:
+        acl.invalidate_members(instance.pk, pk_set)
+        nav.invalidate_users(pk_set)
+        room_ids, user_ids = [instance.pk], pk_set
+
+    if not pk_set:
+        return
+    if action == 'post_add':
+        if reverse:
+            rooms = dict(ChatGroup.objects.filter(id__in=room_ids).values_list('id', 'last_message_id'))
+        else:
+            rooms = {instance.pk: instance.last_message_id}
+        unread.create_markers(rooms, user_ids)
+    else:
+        unread.delete_markers(room_ids, user_ids)
+
+
+@receiver(post_save, sender=ChatGroup)
+def chatgroup_saved(sender, instance, created, **kwargs):
+    acl.invalidate_room(instance.group_name)
+    # A new room has no members yet; they are handled by m2m_changed
+    if not created:
+        nav.invalidate_users(instance.members.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=ChatGroup)
+def chatgroup_deleting(sender, instance, **kwargs):
+    # Membership rows are deleted by cascade, without m2m_changed
+    instance._nav_members = list(instance.members.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=ChatGroup)
+def chatgroup_deleted(sender, instance, **kwargs):
+    acl.invalidate_room(instance.group_name)
+    nav.invalidate_users(getattr(instance, '_nav_members', []))
+    # Files can't roll back, so they go once the room is really gone
+    room_id = instance.pk
+    transaction.on_commit(lambda: archive.delete_room(room_id))
+
+
+@receiver(post_save, sender=EmailAddress)
+@receiver(post_delete, sender=EmailAddress)
+def emailaddress_changed(sender, instance, **kwargs):
+    """
+    Email verification gates group chats, so drop the cached answer.
+    """
+    acl.invalidate_verified(instance.user_id)
+
+
+@receiver(post_save, sender=Profile)
+def profile_changed(sender, instance, created, **kwargs):
+    """
+    Names and avatars are part of the room index of the user and of everyone
+    with a private chat with them.
+    """
+    if created:
+        nav.invalidate_users([instance.user_id])
+    else:
+        nav.invalidate_users([instance.user_id, *nav.dm_partner_ids(instance.user_id)])
+
+
+@receiver(thumbnails_recorded, sender=Profile)
+def profile_thumbnails_recorded(sender, profile_id, user_id, **kwargs):
+    """
+    The avatar variants are recorded with an UPDATE, which sends no post_save.
+    """
+    nav.invalidate_users([user_id, *nav.dm_partner_ids(user_id)])
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    # Logins only touch last_login; anything else may be a new username
+    if created or update_fields == frozenset(['last_login']):
+        return
+    nav.invalidate_users([instance.pk, *nav.dm_partner_ids(instance.pk)])
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    instance._nav_partners = list(nav.dm_partner_ids(instance.pk))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    nav.invalidate_users(getattr(instance, '_nav_partners', []))
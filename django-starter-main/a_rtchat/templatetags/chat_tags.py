@@ -0,0 +1,18 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from a_rtchat.fragments import OTHER, OWN, render_message
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def chat_message(context, message):
+    """
+    Render a chat message for the current user through the fragment cache.
+
+    Usage: {% load chat_tags %} {% chat_message message %}
+    """
+    user = context.get('user')
+    variant = OWN if user is not None and message.author_id == user.id else OTHER
+    return mark_safe(render_message(message, variant))
@@ -0,0 +1,62 @@
+"""
+Test helpers for keeping the chat's pages within a query budget.
+
+    class ChatViewTests(QueryBudgetMixin, TestCase):
+        def test_chat_view(self):
+            with self.assertQueryBudget(8):
+                self.client.get('/')
+
+A budget is an upper bound, not an exact count like assertNumQueries: a
+change that saves queries passes, one that adds a per-row query fails and
+prints every query the block ran, repeated ones first.
+"""
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(budget, using=DEFAULT_DB_ALIAS, label=None):
+    """
+    Fail with QueryBudgetExceeded if the block runs more than `budget` queries.
+    """
+    with CaptureQueriesContext(connections[using]) as context:
+        yield context
+    if len(context) > budget:
+        raise QueryBudgetExceeded(format_report(context.captured_queries, budget, label))
+
+
+def format_report(queries, budget, label=None):
+    counts = Counter(query['sql'] for query in queries)
+    lines = [f'{label or "Block"} ran {len(queries)} queries, budget is {budget}:']
+    for sql, count in counts.most_common():
+        lines.append(f'  {count} x {sql}')
+    return '\n'.join(lines)
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin adding assertQueryBudget and assertViewQueryBudget.
+    """
+
+    def assertQueryBudget(self, budget, using=DEFAULT_DB_ALIAS):
+        return query_budget(budget, using=using)
+
+    def assertViewQueryBudget(self, budget, url, client=None, status=200, **extra):
+        """
+        GET `url` and fail if the response takes more than `budget` queries.
+
+        Returns:
+            The response
+        """
+        client = client or self.client
+        with query_budget(budget, label=f'GET {url}'):
+            response = client.get(url, **extra)
+        self.assertEqual(response.status_code, status)
+        return response
@@ -1,3 +1,1536 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from allauth.account.models import EmailAddress
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.template import Context, Template
+from django.template.loader import get_template
+from django.utils import timezone
+
+from a_rtchat import acl, archive, metrics, protocol, routing
+from a_rtchat.consumers import render_message_variants
+from a_rtchat.fragments import OTHER, FragmentCache, get_fragment_cache, render_message
+from a_rtchat.history import history_page
+from a_rtchat.membership import REMOVED_CLOSE_CODE, remove_members
+from a_rtchat.layers import ChannelHub, UnixSocketChannelLayer
+from a_rtchat.metrics import MetricsEndpoint, Registry
+from a_rtchat.models import ChatGroup, ChatGroupQuerySet, GroupMessage, ReadMarker
+from a_rtchat.nav import get_room_index
+from a_rtchat.outbound import PRESENCE, SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, SlowConsumer
+from a_rtchat import tracing
+from a_rtchat.presence import FilePresenceStore, InMemoryPresenceStore, PresenceCoalescer, get_presence_coalescer, get_presence_store
+from a_rtchat.persistence import MessageWriter, SharedIdSequence, save_message
+from a_rtchat.ratelimit import ChatRateLimiter, TokenBuckets
+from a_rtchat.search import search_messages
+from a_rtchat.unread import mark_read, record_unread, unread_counts
+from a_rtchat.testing import QueryBudgetExceeded, QueryBudgetMixin
+from a_users.models import Profile
+from a_users.thumbnails import record_thumbnails
+
+
+def layer_worker(path, group, ready, results):
+    """
+    Worker process: join `group` on its own layer and report the first message.
+    """
+    async def main():
+        layer = UnixSocketChannelLayer(path=path)
+        channel = await layer.new_channel()
+        receiving = asyncio.create_task(layer.receive(channel))
+        await layer.group_add(group, channel)
+        results.put(('ready', channel, None))
+        ready.set()
+        message = await asyncio.wait_for(receiving, 10)
+        results.put(('received', channel, time.time() - message['sent_at']))
+    asyncio.run(main())
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    """
+    Start a hub and several worker processes and check cross-process delivery.
+    """
+    workers = 3
+
+    def setUp(self):
+        self.context = multiprocessing.get_context('fork')
+        self.path = os.path.join(tempfile.mkdtemp(), 'hub.sock')
+        hub_ready = self.context.Event()
+        hub = ChannelHub(self.path, max_pending=20, drain_timeout=1)
+        self.hub = self.context.Process(target=hub.run, args=(hub_ready,), daemon=True)
+        self.hub.start()
+        self.assertTrue(hub_ready.wait(5))
+        self.results = self.context.Queue()
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes + [self.hub]:
+            process.kill()
+            process.join()
+
+    def start_workers(self, group):
+        channels = []
+        for _ in range(self.workers):
+            ready = self.context.Event()
+            process = self.context.Process(target=layer_worker, args=(self.path, group, ready, self.results), daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.assertTrue(ready.wait(5))
+            kind, channel, _ = self.results.get(timeout=5)
+            channels.append(channel)
+        return channels
+
+    def collect(self, expected, publish):
+        """
+        Publish until `expected` workers reported a message, return their latencies.
+        """
+        latencies = {}
+        deadline = time.time() + 10
+        while len(latencies) < expected and time.time() < deadline:
+            publish()
+            try:
+                while True:
+                    kind, channel, latency = self.results.get(timeout=0.05)
+                    latencies[channel] = latency
+            except queue.Empty:
+                pass
+        return latencies
+
+    def test_group_send_reaches_every_process(self):
+        channels = self.start_workers('room-1')
+        layer = UnixSocketChannelLayer(path=self.path)
+        publish = lambda: async_to_sync(layer.group_send)('room-1', {'type': 'chat', 'sent_at': time.time()})
+
+        latencies = self.collect(len(channels), publish)
+
+        self.assertEqual(set(latencies), set(channels))
+        self.assertLess(max(latencies.values()), 0.5)
+
+    def test_send_to_channel_in_other_process(self):
+        channel = self.start_workers('room-2')[0]
+        layer = UnixSocketChannelLayer(path=self.path)
+        publish = lambda: async_to_sync(layer.send)(channel, {'type': 'chat', 'sent_at': time.time()})
+
+        latencies = self.collect(1, publish)
+
+        self.assertEqual(list(latencies), [channel])
+        self.assertLess(latencies[channel], 0.5)
+
+    def test_group_send_skips_other_groups(self):
+        self.start_workers('room-3')
+        layer = UnixSocketChannelLayer(path=self.path)
+        async_to_sync(layer.group_send)('room-4', {'type': 'chat', 'sent_at': time.time()})
+
+        with self.assertRaises(queue.Empty):
+            self.results.get(timeout=0.3)
+
+    def test_stalled_worker_does_not_block_delivery(self):
+        stalled = socket.socket(socket.AF_UNIX)
+        stalled.connect(self.path)
+        self.addCleanup(stalled.close)
+        for frame in ({'op': 'hello', 'worker': 'stalled'}, {'op': 'listen'},
+                      {'op': 'group_add', 'group': 'room-5', 'channel': 'specific.stalled!1'}):
+            payload = json.dumps(frame).encode()
+            stalled.sendall(struct.pack('!I', len(payload)) + payload)
+        layer = UnixSocketChannelLayer(path=self.path)
+
+        async def flood():
+            for _ in range(200):
+                await layer.group_send('room-5', {'type': 'chat', 'padding': 'x' * 65536})
+        async_to_sync(flood)()
+
+        channels = self.start_workers('room-5')
+        publish = lambda: async_to_sync(layer.group_send)('room-5', {'type': 'chat', 'sent_at': time.time()})
+        latencies = self.collect(len(channels), publish)
+
+        self.assertEqual(set(latencies), set(channels))
+        self.assertLess(max(latencies.values()), 0.5)
+        # The hub hung up on the stalled worker
+        stalled.settimeout(5)
+        while stalled.recv(1 << 20):
+            pass
+
+
+    def test_disconnected_channels_are_forgotten(self):
+        layer = UnixSocketChannelLayer(path=self.path)
+
+        async def run():
+            for _ in range(50):
+                # What a consumer does: receive until it leaves its group and stops
+                channel = await layer.new_channel()
+                await layer.group_add('room-6', channel)
+                receiving = asyncio.create_task(layer.receive(channel))
+                await asyncio.sleep(0)
+                await layer.group_send('room-6', {'type': 'chat'})
+                await receiving
+                receiving = asyncio.create_task(layer.receive(channel))
+                await asyncio.sleep(0)
+                await layer.group_discard('room-6', channel)
+                receiving.cancel()
+                # Delivered to this worker after the discard reached the hub: dropped
+                await layer.send(channel, {'type': 'chat'})
+            await asyncio.sleep(0.2)
+            return dict(layer.channels), dict(layer.receivers), dict(layer.memberships)
+
+        self.assertEqual(async_to_sync(run)(), ({}, {}, {}))
+
+
+class ACLCacheTests(TestCase):
+    """
+    Cached access answers follow membership, room and email changes.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.email = EmailAddress.objects.create(user=self.user, email=self.user.email, primary=True, verified=True)
+        self.room = ChatGroup.objects.create(groupchat_name='Group')
+
+    def can_join(self):
+        return acl.can_join(self.user.id, self.room.group_name) is not None
+
+    def test_answers_are_cached(self):
+        self.room.members.add(self.user)
+        self.assertTrue(self.can_join())
+        with self.assertNumQueries(0):
+            self.assertTrue(self.can_join())
+
+    def test_membership_changes(self):
+        self.assertFalse(self.can_join())
+        self.room.members.add(self.user)
+        self.assertTrue(self.can_join())
+        self.room.members.remove(self.user)
+        self.assertFalse(self.can_join())
+        self.user.chat_groups.add(self.room)
+        self.assertTrue(self.can_join())
+        self.user.chat_groups.clear()
+        self.assertFalse(self.can_join())
+        self.room.members.add(self.user)
+        self.assertTrue(self.can_join())
+        self.room.members.clear()
+        self.assertFalse(self.can_join())
+
+    def test_room_changes(self):
+        self.room.members.add(self.user)
+        self.assertTrue(self.can_join())
+        name = self.room.group_name
+        self.assertFalse(acl.get_room(name)['is_private'])
+        self.room.is_private = True
+        self.room.save()
+        self.assertTrue(acl.get_room(name)['is_private'])
+        self.room.delete()
+        self.assertIsNone(acl.can_join(self.user.id, name))
+
+    def test_email_verification_changes(self):
+        self.room.members.add(self.user)
+        self.assertTrue(self.can_join())
+        self.email.verified = False
+        self.email.save()
+        self.assertFalse(self.can_join())
+        self.email.delete()
+        EmailAddress.objects.create(user=self.user, email='alice@example.org', verified=True)
+        self.assertTrue(self.can_join())
+
+    def test_short_timeout_with_several_processes(self):
+        layers = {'default': {'BACKEND': 'a_rtchat.layers.UnixSocketChannelLayer'}}
+        with override_settings(CHAT_ACL_TIMEOUT=300):
+            self.assertEqual(acl.acl_timeout(), 300)
+            with override_settings(CHANNEL_LAYERS=layers):
+                self.assertEqual(acl.acl_timeout(), acl.LOCAL_CACHE_TIMEOUT)
+                shared = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp'}}
+                with override_settings(CACHES=shared):
+                    self.assertEqual(acl.acl_timeout(), 300)
+
+
+class ChatViewQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+    Chat pages must cost the same number of queries whatever the number of
+    messages, members and private chats on the page.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice', email='alice@example.com')
+        EmailAddress.objects.create(user=cls.user, email=cls.user.email, primary=True, verified=True)
+        others = [User.objects.create(username=f'user{i}') for i in range(12)]
+
+        cls.public = ChatGroup.objects.create(group_name='public-chat')
+        cls.group = ChatGroup.objects.create(groupchat_name='Group', admin=cls.user)
+        cls.group.members.add(cls.user, *others)
+        cls.dm, _ = ChatGroup.objects.get_or_create_dm(cls.user, others[0])
+        for other in others[1:6]:
+            ChatGroup.objects.get_or_create_dm(cls.user, other)
+
+        for i in range(45):
+            for room in (cls.public, cls.group, cls.dm):
+                save_message(others[i % 2], room.id, f'message {i}')
+
+    def setUp(self):
+        cache.clear()  # Budgets hold with a cold ACL cache
+        self.client.force_login(self.user)
+
+    def test_public_chat(self):
+        # Includes joining the public chat on the first visit
+        self.assertViewQueryBudget(11, '/')
+
+    def test_group_chat(self):
+        self.assertViewQueryBudget(10, f'/chat/room/{self.group.group_name}')
+
+    def test_private_chat(self):
+        self.assertViewQueryBudget(9, f'/chat/room/{self.dm.group_name}')
+
+    def test_history(self):
+        oldest = self.group.chat_messages.order_by('id').values_list('id', flat=True)[10]
+        self.assertViewQueryBudget(6, f'/chat/room/{self.group.group_name}/history?before={oldest}')
+
+    def test_chatroom_edit(self):
+        self.assertViewQueryBudget(7, f'/chat/edit/{self.group.group_name}')
+
+    def test_budget_failure_lists_queries(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with self.assertQueryBudget(1):
+                list(User.objects.all())
+                list(User.objects.all())
+        self.assertIn('ran 2 queries, budget is 1', str(raised.exception))
+        self.assertIn('2 x SELECT', str(raised.exception))
+
+
+class RoomIndexTests(TestCase):
+    """
+    The cached header room index must follow membership and profile changes.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.dm, _ = ChatGroup.objects.get_or_create_dm(self.user, self.bob)
+
+    def names(self):
+        return [room['name'] for room in get_room_index(self.user.id)['rooms']]
+
+    def test_built_with_constant_queries(self):
+        for i in range(10):
+            ChatGroup.objects.get_or_create_dm(self.user, User.objects.create(username=f'user{i}'))
+        cache.clear()
+        with self.assertNumQueries(2):
+            get_room_index(self.user.id)
+        with self.assertNumQueries(0):
+            get_room_index(self.user.id)
+
+    def test_membership_changes(self):
+        group = ChatGroup.objects.create(groupchat_name='Team')
+        self.assertEqual(self.names(), ['bob'])
+        group.members.add(self.user)
+        self.assertIn('Team', self.names())
+        group.groupchat_name = 'Renamed'
+        group.save()
+        self.assertIn('Renamed', self.names())
+        self.user.chat_groups.remove(group)
+        self.assertEqual(self.names(), ['bob'])
+
+    def test_partner_profile_changes(self):
+        self.assertEqual(self.names(), ['bob'])
+        self.bob.profile.displayname = 'Bobby'
+        self.bob.profile.save()
+        self.assertEqual(self.names(), ['Bobby'])
+
+    def test_partner_thumbnails_recorded(self):
+        Profile.objects.filter(user=self.bob).update(image='avatars/bob.png')
+        self.assertNotIn('/thumbs/', get_room_index(self.user.id)['rooms'][0]['avatar'])
+        # Recorded with an UPDATE, which sends no post_save
+        self.assertTrue(record_thumbnails(self.bob.profile.id, 'avatars/bob.png'))
+        self.assertIn('/thumbs/', get_room_index(self.user.id)['rooms'][0]['avatar'])
+
+
+class FragmentCacheTests(TestCase):
+
+    def test_lru_eviction_respects_memory_cap(self):
+        html = 'x' * 1000
+        cache = FragmentCache(max_bytes=3 * sys.getsizeof(html))
+        for key in 'abc':
+            cache.set(key, html)
+        cache.get('a')  # 'b' is now the least recently used
+        cache.set('d', html)
+        self.assertEqual(list(cache.entries), ['c', 'a', 'd'])
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_profile_edit_invalidates_rendered_messages(self):
+        author = User.objects.create(username='bob')
+        room = ChatGroup.objects.create()
+        message = save_message(author, room.id, 'hello')
+        with override_settings(CHAT_FRAGMENT_CACHE={'ENABLED': True}):
+            self.assertIn('bob', render_message(message, OTHER))
+            author.profile.displayname = 'Bobby'
+            author.profile.save()
+            self.assertIn('Bobby', render_message(message, OTHER))
+            self.assertEqual(get_fragment_cache().stats['hits'], 0)
+
+
+class MessageVariantTests(TestCase):
+    """
+    Rendering once per message must give each recipient what rendering per
+    recipient gave them.
+    """
+
+    def setUp(self):
+        self.alice, self.bob = (User.objects.create(username=name) for name in ('alice', 'bob'))
+        room = ChatGroup.objects.create()
+        message = save_message(self.alice, room.id, '<b>hi</b> & bye')
+        self.message = GroupMessage.objects.select_related('author__profile').get(id=message.id)
+        # The partial as it was, rendered for one recipient at a time
+        source = get_template('a_rtchat/partials/chat_message_p.html').template.source
+        self.assertIn('{% chat_message message %}', source)
+        self.per_recipient = Template(
+            source.replace('{% load chat_tags %}', '')
+            .replace('{% chat_message message %}', "{% include 'a_rtchat/chat_message.html' %}")
+        )
+
+    def render_for(self, user):
+        return self.per_recipient.render(Context({'message': self.message, 'user': user}))
+
+    # A fresh fragment cache, dropped afterwards with the rolled back messages
+    @override_settings(CHAT_FRAGMENT_CACHE={'ENABLED': True})
+    def test_variants_match_per_recipient_render(self):
+        variants = render_message_variants(self.message)
+        self.assertEqual(variants['own'], self.render_for(self.alice))
+        self.assertEqual(variants['other'], self.render_for(self.bob))
+        self.assertEqual(variants['other'], self.render_for(AnonymousUser()))
+        self.assertIn('&lt;b&gt;hi&lt;/b&gt; &amp; bye', variants['other'])
+        # Cached on the first call, the same afterwards
+        self.assertEqual(render_message_variants(self.message), variants)
+
+async def not_found_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_exposition_format(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'A counter')
+        gauge = registry.gauge('test_room', 'A gauge', ['room'])
+        histogram = registry.histogram('test_seconds', 'A histogram', buckets=(0.01, 0.1))
+        counter.inc()
+        counter.inc(2)
+        gauge.labels('a"b').inc()
+        histogram.observe(0.005)
+        histogram.observe(0.05)
+        lines = registry.expose().splitlines()
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total 3', lines)
+        self.assertIn('test_room{room="a\\"b"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="0.01"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_count 2', lines)
+
+    def get(self, path, token=None):
+        headers = [(b'authorization', b'Bearer ' + token.encode())] if token else []
+        comm = HttpCommunicator(MetricsEndpoint(not_found_app), 'GET', path, headers=headers)
+        comm.scope['client'] = ('127.0.0.1', 50000)
+        return async_to_sync(comm.get_response)()
+
+    @override_settings(CHAT_METRICS={'TOKEN': 'secret'})
+    def test_endpoint(self):
+        response = self.get('/metrics', 'secret')
+        self.assertEqual(response['status'], 200)
+        self.assertIn(b'chat_connects_total', response['body'])
+        self.assertIn(b'chat_channel_layer_queued_messages', response['body'])
+        self.assertEqual(self.get('/', 'secret')['status'], 404)  # passed on to Django
+
+    @override_settings(CHAT_METRICS={'TOKEN': 'secret'})
+    def test_endpoint_requires_token_even_from_localhost(self):
+        self.assertEqual(self.get('/metrics')['status'], 401)
+        self.assertEqual(self.get('/metrics', 'wrong')['status'], 401)
+
+    @override_settings(CHAT_METRICS={'TOKEN': None})
+    def test_endpoint_disabled_without_token(self):
+        self.assertEqual(self.get('/metrics')['status'], 404)
+
+    @override_settings(CHAT_METRICS={'TOKEN': 'secret'})
+    def test_rooms_are_aggregated(self):
+        with mock.patch.dict(metrics.room_sockets, clear=True):
+            metrics.room_joined('private-room-a')
+            metrics.room_joined('private-room-a')
+            metrics.room_joined('private-room-b')
+            metrics.room_left('private-room-b')
+            body = self.get('/metrics', 'secret')['body'].decode()
+            metrics.room_left('private-room-a')
+            metrics.room_left('private-room-a')
+        self.assertNotIn('private-room', body)
+        self.assertIn('chat_rooms_active 1', body.splitlines())
+        self.assertIn('chat_room_connections_max 2', body.splitlines())
+
+
+class OutboundQueueTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.delivered = []
+
+    def queue(self, **kwargs):
+        async def send(text):
+            self.sent.append(text)
+
+        render = lambda count, online, offline: f'presence {count} +{online} -{offline}'
+        return OutboundQueue(send, render, on_sent=self.delivered.append, **kwargs)
+
+    def drain(self, queue):
+        async def run():
+            task = asyncio.create_task(queue.run())
+            while queue.frames:
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            task.cancel()
+        async_to_sync(run)()
+
+    def test_frames_go_out_in_order(self):
+        queue = self.queue()
+        queue.put('one', data=1)
+        queue.put_presence(2, [7], [], 'presence 2')
+        queue.put('two', data=2)
+        self.drain(queue)
+        self.assertEqual(self.sent, ['one', 'presence 2', 'two'])
+        self.assertEqual(self.delivered, [1, 2])
+        self.assertEqual(queue.stats['sent'], 3)
+
+    def test_presence_diffs_are_merged(self):
+        queue = self.queue()
+        queue.put_presence(2, [7], [], 'first')
+        queue.put('message')
+        queue.put_presence(1, [8], [7], 'second')
+        self.assertEqual(queue.depth, 2)
+        self.drain(queue)
+        self.assertEqual(self.sent, ['presence 1 +[8] -[7]', 'message'])
+        self.assertEqual(queue.stats['collapsed'], 1)
+
+    def test_full_queue_drops_presence_first(self):
+        queue = self.queue(max_frames=2)
+        queue.put_presence(1, [7], [], 'presence')
+        queue.put('one')
+        queue.put('two')
+        self.assertEqual([frame.kind for frame in queue.frames], ['message', 'message'])
+        self.assertEqual(queue.stats['dropped_presence'], 1)
+        with self.assertRaises(SlowConsumer):
+            queue.put('three')
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual(queue.stats['slow_consumer'], 1)
+
+    def test_failed_send_stops_the_queue(self):
+        failures = []
+
+        async def send(text):
+            raise ConnectionResetError()
+
+        async def on_failed(error):
+            failures.append(error)
+
+        queue = OutboundQueue(send, None, on_failed=on_failed)
+        queue.put('one')
+        queue.put('two')
+
+        async def run():
+            await asyncio.wait_for(queue.run(), 5)  # Returns instead of dying
+        async_to_sync(run)()
+        self.assertTrue(queue.failed)
+        self.assertEqual([type(error) for error in failures], [ConnectionResetError])
+        queue.put('three')
+        self.assertEqual(queue.depth, 0)
+        self.assertEqual(queue.stats['send_failed'], 1)
+
+    def test_lagging_queue_is_slow(self):
+        queue = self.queue(max_lag=30)
+        queue.put('old')
+        queue.frames[0].queued_at -= 31
+        with self.assertRaises(SlowConsumer):
+            queue.put_presence(1, [7], [], 'presence')
+        self.assertNotIn(PRESENCE, [frame.kind for frame in queue.frames])
+
+
+class RateLimiterTests(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+
+    def limiter(self, user=None, room=None, **kwargs):
+        return ChatRateLimiter(user, room, clock=lambda: self.now, **kwargs)
+
+    def test_user_limit_spans_rooms(self):
+        limiter = self.limiter(user={'RATE': 1, 'BURST': 2})
+        self.assertEqual([limiter.acquire(1, room) for room in (1, 2, 3)], [0, 0, 1.0])
+        self.assertEqual(limiter.acquire(2, 1), 0)  # other users have their own bucket
+        self.now = 0.5
+        self.assertEqual(limiter.acquire(1, 1), 0.5)
+        self.now = 1.0
+        self.assertEqual(limiter.acquire(1, 1), 0)
+
+    def test_room_limit_spans_users(self):
+        limiter = self.limiter(room={'RATE': 10, 'BURST': 2})
+        self.assertEqual([limiter.acquire(user, 1) for user in (1, 2, 3)], [0, 0, 0.1])
+        self.assertEqual(limiter.acquire(1, 2), 0)
+
+    def test_rejection_takes_nothing_and_waits_for_both(self):
+        limiter = self.limiter(user={'RATE': 1, 'BURST': 1}, room={'RATE': 0.5, 'BURST': 1})
+        self.assertEqual(limiter.acquire(1, 1), 0)
+        # The room needs 2s, the user 1s
+        self.assertEqual(limiter.acquire(1, 1), 2.0)
+        self.now = 1.0
+        # Room still empty; user 2's bucket must stay untouched
+        self.assertEqual(limiter.acquire(2, 1), 1.0)
+        self.assertNotIn(2, limiter.user.buckets)
+
+    def test_full_buckets_are_pruned(self):
+        limiter = self.limiter(user={'RATE': 1, 'BURST': 2}, max_buckets=3)
+        for user in range(3):
+            limiter.acquire(user, 1)
+        self.now = 10.0  # every bucket has refilled
+        limiter.acquire(3, 1)
+        self.assertEqual(list(limiter.user.buckets), [3])
+
+    def test_pruning_is_amortised(self):
+        buckets = TokenBuckets(rate=0.001, burst=2, max_buckets=100)
+        with mock.patch.object(TokenBuckets, 'prune', autospec=True, side_effect=TokenBuckets.prune) as prune:
+            # None of these refill, so nothing can be pruned
+            for key in range(1000):
+                buckets.take(key, 2, now=0.0)
+        self.assertEqual(len(buckets.buckets), 1000)
+        self.assertLessEqual(prune.call_count, 4)
+
+    # A fresh fragment cache, dropped afterwards with the rolled back messages
+    @override_settings(
+        CHAT_RATE_LIMITS={'USER': {'RATE': 0.1, 'BURST': 1}, 'ROOM': None},
+        CHAT_FRAGMENT_CACHE={'ENABLED': True},
+    )
+    def test_http_post_returns_429(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        ChatGroup.objects.create(group_name='public-chat')
+        self.client.force_login(user)
+        post = lambda: self.client.post('/', {'body': 'hi'}, HTTP_HX_REQUEST='true')
+        self.assertEqual(post().status_code, 200)
+        response = post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '10')
+
+
+class TracingTests(SimpleTestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def test_trace_follows_event_and_is_summarized(self):
+        with override_settings(CHAT_TRACING={'SAMPLE_RATE': 1, 'PATH': self.path}):
+            with tracing.start_trace('ws.receive'):
+                with tracing.span('save_message'):
+                    pass
+                with tracing.span('group_send'):
+                    event = {'trace': tracing.inject()}
+            # A subscriber, possibly in another process
+            with tracing.continue_trace(json.loads(json.dumps(event))['trace'], 'ws.message_handler'):
+                context = tracing.inject()
+            tracing.record(context, 'ws.send', time.time(), 0.002)
+
+        with open(self.path) as f:
+            spans = {span['name']: span for span in map(json.loads, f)}
+        self.assertEqual(len({span['trace'] for span in spans.values()}), 1)
+        self.assertIsNone(spans['ws.receive']['parent'])
+        self.assertEqual(spans['ws.message_handler']['parent'], spans['group_send']['span'])
+        self.assertEqual(spans['ws.send']['parent'], spans['ws.message_handler']['span'])
+
+        out = io.StringIO()
+        call_command('summarize_traces', self.path, '--json', stdout=out)
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['ws.receive']['traces'], 1)
+        self.assertEqual(set(summary['ws.receive']['spans']), set(spans))
+
+    def test_unsampled_traces_write_nothing(self):
+        with override_settings(CHAT_TRACING={'SAMPLE_RATE': 0, 'PATH': self.path}):
+            with tracing.start_trace('ws.receive') as root:
+                self.assertIs(root, tracing.NOOP_SPAN)
+                self.assertIs(tracing.span('save_message'), tracing.NOOP_SPAN)
+                self.assertIsNone(tracing.inject())
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+
+class ChatroomConsumerTests(TransactionTestCase):
+    """
+    Connect, receive and disconnect of the routed consumer.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice', email='alice@example.com')
+        self.bob = User.objects.create(username='bob', email='bob@example.com')
+        self.public = ChatGroup.objects.create(group_name='public-chat')
+        self.group = ChatGroup.objects.create(groupchat_name='Group')
+        self.group.members.add(self.alice)
+        EmailAddress.objects.create(user=self.alice, email=self.alice.email, primary=True, verified=True)
+
+    def communicator(self, user, chatroom_name='public-chat', json_protocol=True):
+        comm = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chatroom/{chatroom_name}',
+            subprotocols=['chat.json.v1'] if json_protocol else [],
+        )
+        comm.scope['user'] = user
+        return comm
+
+    def test_connect_checks_access(self):
+        async def run():
+            results = []
+            for user, room in [
+                (AnonymousUser(), 'public-chat'),
+                (self.bob, self.group.group_name),
+                (self.alice, self.group.group_name),
+                (self.alice, 'no-such-room'),
+            ]:
+                comm = self.communicator(user, room)
+                connected, _ = await comm.connect()
+                results.append(connected)
+                await comm.disconnect()
+            return results
+
+        self.assertEqual(async_to_sync(run)(), [False, False, True, False])
+
+    def test_disconnect_leaves_no_pending_presence_flush(self):
+        async def run():
+            comm = self.communicator(self.alice)
+            connected, _ = await comm.connect()
+            self.assertTrue(connected)
+            await comm.disconnect()
+            return {task for task in get_presence_coalescer()._tasks if not task.done()}
+
+        self.assertEqual(async_to_sync(run)(), set())
+
+    def test_message_reaches_every_socket_in_its_variant(self):
+        async def run():
+            alice = self.communicator(self.alice, json_protocol=False)
+            bob = self.communicator(self.bob, json_protocol=False)
+            for comm in (alice, bob):
+                connected, _ = await comm.connect()
+                self.assertTrue(connected)
+                await comm.receive_from()  # online status snapshot
+            await alice.send_json_to({'body': 'hello there'})
+            frames = {}
+            for name, comm in (('alice', alice), ('bob', bob)):
+                while name not in frames:
+                    frame = await comm.receive_from(timeout=5)
+                    if 'hello there' in frame:
+                        frames[name] = frame
+            await alice.disconnect()
+            await bob.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertIn('justify-end', frames['alice'])
+        self.assertNotIn('justify-end', frames['bob'])
+        self.assertIn('@alice', frames['bob'])
+        self.assertTrue(GroupMessage.objects.filter(author=self.alice, body='hello there').exists())
+
+    def test_failed_send_closes_the_socket(self):
+        async def broken(consumer, text):
+            raise RuntimeError('socket is gone')
+
+        async def run():
+            alice = self.communicator(self.alice)
+            await alice.connect()
+            await alice.receive_json_from()  # hello, sent directly
+            await alice.send_json_to({'body': 'hello'})
+            return await alice.receive_output(timeout=5)
+
+        with mock.patch('a_rtchat.consumers.ChatroomConsumer.send_text', broken):
+            closed = async_to_sync(run)()
+        self.assertEqual(closed['type'], 'websocket.close')
+
+    def test_profile_edit_shows_in_next_message(self):
+        async def message_from(comm, author, body):
+            await author.send_json_to({'body': body})
+            while True:
+                frame = await comm.receive_json_from(timeout=5)
+                if frame['t'] == 'm' and frame['b'] == body:
+                    return frame
+
+        def rename(name):
+            profile = User.objects.get(pk=self.alice.pk).profile
+            profile.displayname = name
+            profile.save()
+
+        async def run():
+            alice, bob = self.communicator(self.alice), self.communicator(self.bob)
+            for comm in (alice, bob):
+                await comm.connect()
+            before = await message_from(bob, alice, 'before')
+            await database_sync_to_async(rename)('Alice Liddell')
+            after = await message_from(bob, alice, 'after')
+            await alice.disconnect()
+            await bob.disconnect()
+            return before['a']['n'], after['a']['n']
+
+        before, after = async_to_sync(run)()
+        self.assertNotEqual(before, 'Alice Liddell')
+        self.assertEqual(after, 'Alice Liddell')
+
+    @override_settings(CHAT_PRESENCE={'BROADCAST_WINDOW': 0.01})
+    def test_disconnect_broadcasts_offline(self):
+        async def run():
+            alice, bob = self.communicator(self.alice), self.communicator(self.bob)
+            await alice.connect()
+            await alice.receive_json_from()  # hello
+            await bob.connect()
+            hello = await bob.receive_json_from()
+            # Within one window, coming and going would cancel out
+            while (await alice.receive_json_from(timeout=5))['t'] != 'p':
+                pass
+            await bob.disconnect()
+            while True:
+                frame = await alice.receive_json_from(timeout=5)
+                if frame['t'] == 'p' and frame['off']:
+                    break
+            await alice.disconnect()
+            return hello, frame
+
+        hello, frame = async_to_sync(run)()
+        self.assertEqual((hello['t'], hello['me']), ('hello', self.bob.id))
+        self.assertEqual((frame['c'], frame['off']), (1, [self.bob.id]))
+        self.assertEqual(get_presence_store().online('public-chat'), set())
+
+
+    @override_settings(CHAT_OUTBOUND={'MAX_FRAMES': 2})
+    def test_slow_client_is_closed(self):
+        async def stalled(consumer, text):
+            await asyncio.Event().wait()
+
+        async def run():
+            alice = self.communicator(self.alice)
+            await alice.connect()
+            await alice.receive_json_from()  # hello, sent directly
+            for i in range(5):
+                await alice.send_json_to({'body': f'message {i}'})
+            return await alice.receive_output(timeout=5)
+
+        with mock.patch('a_rtchat.consumers.ChatroomConsumer.send_text', stalled):
+            closed = async_to_sync(run)()
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': SLOW_CONSUMER_CLOSE_CODE})
+
+
+class ResumeTests(TransactionTestCase):
+    """
+    A socket connecting with ?resume=1 gets what it missed in one frame.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='alice')
+        self.room = ChatGroup.objects.create(group_name='public-chat')
+        self.room.members.add(self.user)
+        self.ids = [save_message(self.user, self.room.id, f'message {i}').id for i in range(4)]
+
+    def replay(self, last_id):
+        async def run():
+            comm = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), '/ws/chatroom/public-chat?resume=1',
+                subprotocols=['chat.json.v1'],
+            )
+            comm.scope['user'] = self.user
+            connected, _ = await comm.connect()
+            self.assertTrue(connected)
+            await comm.send_json_to({'type': 'resume', 'last_id': last_id})
+            while True:
+                frame = await comm.receive_json_from(timeout=5)
+                if frame['t'] == 'replay':
+                    break
+            await comm.disconnect()
+            return frame
+        return async_to_sync(run)()
+
+    def test_replays_missed_messages(self):
+        frame = self.replay(self.ids[1])
+        self.assertEqual([message['id'] for message in frame['m']], self.ids[2:])
+        self.assertFalse(frame['more'])
+
+    def test_too_many_missed_asks_for_reload(self):
+        with override_settings(CHAT_RESUME={'MAX_MESSAGES': 2}):
+            frame = self.replay(self.ids[0])
+        self.assertEqual([message['id'] for message in frame['m']], self.ids[2:])
+        self.assertTrue(frame['more'])
+
+
+class SearchTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice', email='alice@example.com')
+        cls.other = User.objects.create(username='bob')
+        cls.mine = ChatGroup.objects.create(groupchat_name='Mine')
+        cls.mine.members.add(cls.user, cls.other)
+        cls.theirs = ChatGroup.objects.create(groupchat_name='Theirs')
+        cls.theirs.members.add(cls.other)
+        save_message(cls.other, cls.mine.id, 'deploy on friday')
+        save_message(cls.other, cls.mine.id, 'deploy deploy deploy <b>now</b>')
+        save_message(cls.other, cls.mine.id, 'lunch?')
+        save_message(cls.other, cls.theirs.id, 'deploy in secret')
+
+    def bodies(self, text, **kwargs):
+        return [message.body for message, _ in search_messages(self.user.id, text, **kwargs)[0]]
+
+    def test_ranked_and_scoped_to_members(self):
+        self.assertEqual(self.bodies('deploy'), ['deploy deploy deploy <b>now</b>', 'deploy on friday'])
+        self.assertEqual(self.bodies('deploy fri'), ['deploy on friday'])  # Last word is a prefix
+        self.assertEqual(self.bodies('"secret" OR deploy'), [])  # Operators are plain words
+
+    def test_index_follows_deletes(self):
+        GroupMessage.objects.filter(body='deploy on friday').delete()
+        self.assertEqual(self.bodies('friday'), [])
+
+    def test_pages_and_snippet(self):
+        results, has_more = search_messages(self.user.id, 'deploy', size=1)
+        self.assertTrue(has_more)
+        self.assertIn('<mark>deploy</mark>', results[0][1])
+        self.assertIn('&lt;b&gt;', results[0][1])
+        self.assertEqual(self.bodies('deploy', page=2, size=1), ['deploy on friday'])
+
+    def test_search_view(self):
+        self.client.force_login(self.user)
+        response = self.assertViewQueryBudget(8, '/chat/search/?q=friday')
+        self.assertContains(response, '<mark>friday</mark>')
+        self.assertContains(response, 'in Mine')
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(CHAT_ARCHIVE={'PATH': directory.name, 'AFTER_DAYS': 30, 'SEGMENT_MESSAGES': 4})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.room = ChatGroup.objects.create(groupchat_name='Archived')
+        # 10 messages older than 30 days, 5 recent ones
+        now = timezone.now()
+        for i in range(15):
+            message = save_message(self.user, self.room.id, f'message {i}')
+            age = datetime.timedelta(days=60 - i) if i < 10 else datetime.timedelta(minutes=15 - i)
+            GroupMessage.objects.filter(id=message.id).update(created=now - age)
+
+    def scroll(self, size):
+        pages, before, has_more = [], None, True
+        while has_more:
+            messages, has_more = history_page(self.room.id, before=before, size=size)
+            pages.append([message.body for message in messages])
+            before = messages[-1].id
+        return pages
+
+    def test_history_continues_into_archive(self):
+        expected = self.scroll(size=3)
+        call_command('archive_messages', stdout=io.StringIO())
+
+        self.assertEqual(GroupMessage.objects.filter(group=self.room).count(), 5)
+        self.assertEqual([segment['count'] for segment in archive.read_index(self.room.id)], [4, 4, 2])
+        self.assertEqual(self.scroll(size=3), expected)
+        oldest = history_page(self.room.id, before=GroupMessage.objects.order_by('created').first().id, size=2)[0]
+        self.assertEqual(oldest[0].author.profile, self.user.profile)
+
+    def test_crash_before_delete_is_not_archived_twice(self):
+        # The segment was written but the process died before deleting the rows
+        old = list(GroupMessage.objects.filter(group=self.room).order_by('created', 'id')[:4])
+        archive.append_segment(self.room.id, old)
+        archive.archive_messages()
+        self.assertEqual(sum(segment['count'] for segment in archive.read_index(self.room.id)), 10)
+        self.assertEqual(len(self.scroll(size=100)[0]), 15)
+
+    def rebuilt(self, room):
+        ChatGroup.objects.filter(id=room.id).update(message_count=0, last_message=None, last_message_at=None)
+        call_command('rebuild_room_stats', stdout=io.StringIO())
+        return ChatGroup.objects.get(id=room.id)
+
+    def test_rebuilt_stats_include_archived_messages(self):
+        newest = GroupMessage.objects.filter(group=self.room).order_by('-created', '-id').first().id
+        archive.archive_messages()
+        room = self.rebuilt(self.room)
+        self.assertEqual((room.message_count, room.last_message_id), (15, newest))
+
+    def test_rebuilt_stats_of_interrupted_archive_count_once(self):
+        old = list(GroupMessage.objects.filter(group=self.room).order_by('created', 'id')[:4])
+        archive.append_segment(self.room.id, old)
+        self.assertEqual(self.rebuilt(self.room).message_count, 15)
+
+    def test_rebuilt_stats_of_fully_archived_room(self):
+        old = ChatGroup.objects.create(groupchat_name='Old')
+        message = save_message(self.user, old.id, 'long ago')
+        created = timezone.now() - datetime.timedelta(days=40)
+        GroupMessage.objects.filter(id=message.id).update(created=created)
+        archive.archive_messages()
+        room = self.rebuilt(old)
+        self.assertEqual((room.message_count, room.last_message_id), (1, None))
+        self.assertEqual((room.last_message_at, room.last_message_preview), (created, 'long ago'))
+
+    def test_room_delete_removes_segments(self):
+        archive.archive_messages()
+        self.assertTrue(os.path.isdir(archive.room_dir(self.room.id)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.delete()
+        self.assertFalse(os.path.exists(archive.room_dir(self.room.id)))
+
+
+class PresenceStoreTestsMixin:
+    """
+    Behaviour every presence store shares; subclasses provide make_store().
+    """
+
+    def test_online_while_any_connection_lives(self):
+        store = self.make_store()
+        self.assertTrue(store.connect('room', 1, 'tab-a'))
+        self.assertFalse(store.connect('room', 1, 'tab-b'))
+        self.assertFalse(store.disconnect('room', 1, 'tab-a'))
+        self.assertEqual(store.online('room'), {1})
+        self.assertTrue(store.disconnect('room', 1, 'tab-b'))
+        self.assertEqual(store.online('room'), set())
+        self.assertFalse(store.disconnect('room', 1, 'tab-b'))
+
+    @mock.patch('a_rtchat.presence.SWEEP_INTERVAL', 0)
+    def test_expired_connections_are_reported_once(self):
+        store = self.make_store(ttl=0.05)
+        store.connect('room', 1, 'crashed')
+        store.connect('room', 2, 'alive')
+        time.sleep(0.1)
+        self.assertEqual(store.online('room'), set())
+        self.assertEqual(store.heartbeat('room', 2, 'alive'), {1})
+        self.assertEqual(store.online('room'), {2})
+        self.assertEqual(store.heartbeat('room', 2, 'alive'), set())
+
+    def test_sweeps_are_throttled(self):
+        store = self.make_store(ttl=0.05)
+        store.connect('room', 2, 'alive')
+        store.heartbeat('room', 2, 'alive')
+        store.connect('room', 1, 'crashed')
+        time.sleep(0.1)
+        self.assertEqual(store.heartbeat('room', 2, 'alive'), set())
+
+    def test_remove_users(self):
+        store = self.make_store()
+        store.connect('room', 1, 'a')
+        store.connect('room', 2, 'b')
+        self.assertEqual(store.remove_users('room', [1, 3]), {1})
+        self.assertEqual(store.online('room'), {2})
+
+
+class InMemoryPresenceStoreTests(PresenceStoreTestsMixin, SimpleTestCase):
+
+    def make_store(self, ttl=60):
+        return InMemoryPresenceStore(ttl=ttl)
+
+    def test_offline_users_leave_no_entries(self):
+        store = self.make_store(ttl=0.05)
+        store.connect('room', 1, 'a')
+        store.connect('room', 2, 'b')
+        self.assertTrue(store.disconnect('room', 2, 'b'))
+        time.sleep(0.1)
+        self.assertEqual(store.heartbeat('room', 3, 'c'), {1})
+        self.assertEqual(store._rooms, {})
+
+
+class FilePresenceStoreTests(PresenceStoreTestsMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_store(self, ttl=60):
+        return FilePresenceStore(ttl=ttl, path=os.path.join(self.tmp.name, 'presence.sqlite3'))
+
+    def test_shared_between_processes(self):
+        first, second = self.make_store(), self.make_store()
+        first.connect('room', 1, 'a')
+        self.assertTrue(second.is_online('room', 1))
+        self.assertFalse(second.connect('room', 1, 'b'))
+
+
+class PresenceCoalescerTests(SimpleTestCase):
+    """
+    Presence changes of a room within one window go out as one net diff.
+    """
+
+    def setUp(self):
+        self.coalescer = PresenceCoalescer(window=0.05)
+        self.diffs = []
+
+    async def broadcast(self, room, online, offline):
+        self.diffs.append((room, sorted(online), sorted(offline)))
+
+    def run_loop(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_changes_in_a_window_are_merged(self):
+        async def run():
+            self.coalescer.record('room', 1, True, self.broadcast)
+            self.coalescer.record('room', 2, True, self.broadcast)
+            self.coalescer.record('room', 3, False, self.broadcast)
+            self.coalescer.record('other', 1, True, self.broadcast)
+            await asyncio.sleep(0.1)
+
+        self.run_loop(run())
+        self.assertEqual(sorted(self.diffs), [('other', [1], []), ('room', [1, 2], [3])])
+
+    def test_drop_and_return_cancels_out(self):
+        async def run():
+            self.coalescer.record('room', 1, False, self.broadcast)
+            self.coalescer.record('room', 1, True, self.broadcast)
+            await asyncio.sleep(0.1)
+
+        self.run_loop(run())
+        self.assertEqual(self.diffs, [])
+
+    def test_flush_lost_with_its_loop_does_not_block_the_room(self):
+        async def record_and_leave():
+            self.coalescer.record('room', 1, True, self.broadcast)
+
+        async def record_and_wait():
+            self.coalescer.record('room', 2, True, self.broadcast)
+            await asyncio.sleep(0.1)
+
+        # The first loop stops with the flush pending, like a finished
+        # async_to_sync call
+        left = asyncio.new_event_loop()
+        try:
+            left.run_until_complete(record_and_leave())
+            self.run_loop(record_and_wait())
+            self.assertEqual(self.diffs, [('room', [2], [])])
+        finally:
+            for task in asyncio.all_tasks(left):
+                task.cancel()
+            left.run_until_complete(asyncio.sleep(0))
+            left.close()
+
+    def test_wait_runs_the_pending_flush(self):
+        async def run():
+            self.coalescer.record('room', 1, False, self.broadcast)
+            await self.coalescer.wait('room')
+            self.assertEqual(self.diffs, [('room', [], [1])])
+            self.assertEqual(self.coalescer._tasks, set())
+            await self.coalescer.wait('room')  # Nothing pending
+
+        self.run_loop(run())
+
+    def test_cancelled_flush_clears_the_room(self):
+        async def run():
+            self.coalescer.record('room', 1, True, self.broadcast)
+            for task in list(self.coalescer._tasks):
+                task.cancel()
+            await asyncio.sleep(0)
+            self.coalescer.record('room', 2, True, self.broadcast)
+            await asyncio.sleep(0.1)
+
+        self.run_loop(run())
+        self.assertEqual(self.diffs, [('room', [2], [])])
+
+
+class WriteBehindTests(TransactionTestCase):
+    """
+    MessageWriter batches writes, flushes on close and survives failed writes.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.room = ChatGroup.objects.create(group_name='public-chat')
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+
+    def writer(self, **kwargs):
+        writer = MessageWriter(**kwargs)
+        self.writers.append(writer)
+        return writer
+
+    def submit(self, writer, count, group_id=None):
+        return [
+            writer.submit(GroupMessage(author=self.user, group_id=group_id or self.room.id, body=f'message {i}'))
+            for i in range(count)
+        ]
+
+    def wait_for_flush(self, writer, timeout=5):
+        # Polling the table would race the flusher for SQLite's table lock
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with writer._flush_lock, writer._wakeup:
+                if not writer._pending:
+                    return GroupMessage.objects.count()
+            time.sleep(0.01)
+        self.fail('The writer did not flush')
+
+    def test_full_batch_is_written(self):
+        writer = self.writer(batch_size=3, flush_interval=60)
+        messages = self.submit(writer, 3)
+        self.assertEqual(self.wait_for_flush(writer), 3)
+        self.assertEqual(
+            list(GroupMessage.objects.order_by('id').values_list('id', flat=True)),
+            [message.id for message in messages],
+        )
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.last_message_id), (3, messages[-1].id))
+
+    def test_created_is_stored_as_broadcast(self):
+        writer = self.writer(batch_size=100, flush_interval=60)
+        message, = self.submit(writer, 1)
+        time.sleep(0.01)
+        writer.flush()
+        self.assertEqual(GroupMessage.objects.get(id=message.id).created, message.created)
+
+    def test_shared_ids_follow_one_sequence(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ids.sqlite3')
+            # Two processes' writers, taking turns
+            first, second = SharedIdSequence(path, block_size=3), SharedIdSequence(path, block_size=3)
+            ids = [sequence.next_id() for _ in range(4) for sequence in (first, second)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 8)
+        self.assertGreater(save_message(self.user, self.room.id, 'sync').id, ids[-1])
+
+    def test_close_flushes_pending(self):
+        writer = self.writer(batch_size=100, flush_interval=60)
+        self.submit(writer, 2)
+        self.assertEqual(GroupMessage.objects.count(), 0)
+        writer.close()
+        self.assertEqual(GroupMessage.objects.count(), 2)
+
+    def test_failed_batch_is_retried(self):
+        writer = self.writer(batch_size=100, flush_interval=0.01)
+        bulk_create = GroupMessage.objects.bulk_create
+        calls = []
+
+        def flaky(*args, **kwargs):
+            calls.append(len(args[0]))
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(GroupMessage.objects, 'bulk_create', side_effect=flaky), \
+                self.assertLogs('a_rtchat.persistence', 'ERROR'):
+            self.submit(writer, 2)
+            self.assertEqual(self.wait_for_flush(writer), 2)
+        self.assertEqual(calls[:2], [2, 2])
+        # The thread lives on
+        self.submit(writer, 1)
+        self.assertEqual(self.wait_for_flush(writer), 3)
+
+    def test_constraint_violation_drops_only_bad_messages(self):
+        writer = self.writer(batch_size=100, flush_interval=60)
+        self.submit(writer, 2)
+        self.submit(writer, 1, group_id=self.room.id + 1000)
+        with self.assertLogs('a_rtchat.persistence', 'ERROR'):
+            self.assertEqual(writer.flush(), 2)
+        self.assertEqual(GroupMessage.objects.count(), 2)
+
+
+class MemberRemovalTests(QueryBudgetMixin, TransactionTestCase):
+    """
+    Removing members is one bulk delete, and only their sockets hear of it.
+    """
+
+    def setUp(self):
+        cache.clear()
+        users = [User.objects.create(username=name, email=f'{name}@example.com') for name in ('alice', 'bob', 'carol')]
+        for user in users:
+            EmailAddress.objects.create(user=user, email=user.email, primary=True, verified=True)
+        self.alice, self.bob, self.carol = users
+        self.room = ChatGroup.objects.create(groupchat_name='Group', admin=self.alice)
+        self.extras = [User.objects.create(username=f'user{i}') for i in range(20)]
+        self.room.members.add(*users, *self.extras)
+
+    def test_bulk_removal_budget(self):
+        self.client.force_login(self.alice)
+        url = f'/chat/edit/{self.room.group_name}'
+        with self.assertQueryBudget(10):
+            response = self.client.post(url, {
+                'groupchat_name': 'Group',
+                'remove_members': [user.id for user in self.extras],
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(set(self.room.members.all()), {self.alice, self.bob, self.carol})
+
+    def test_only_removed_sockets_are_redirected(self):
+        async def connect(user):
+            comm = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f'/ws/chatroom/{self.room.group_name}',
+                subprotocols=['chat.json.v1'],
+            )
+            comm.scope['user'] = user
+            connected, _ = await comm.connect()
+            self.assertTrue(connected)
+            await comm.receive_json_from()  # hello
+            return comm
+
+        async def run():
+            bob, carol = await connect(self.bob), await connect(self.carol)
+            await database_sync_to_async(remove_members)(self.room, [self.bob.id])
+            removed = await bob.receive_json_from(timeout=5)
+            self.assertEqual(await bob.receive_output(), {'type': 'websocket.close', 'code': REMOVED_CLOSE_CODE})
+            # A client ignoring the redirect can't post anymore
+            await bob.send_json_to({'body': 'still here'})
+            frames = []
+            while not await carol.receive_nothing(timeout=0.5):
+                frames.append(await carol.receive_json_from())
+            await bob.disconnect()
+            await carol.disconnect()
+            return removed, frames
+
+        removed, frames = async_to_sync(run)()
+        self.assertEqual(removed['t'], 'r')
+        self.assertNotIn('r', [frame['t'] for frame in frames])
+        self.assertIn(self.bob.id, [user_id for frame in frames if frame['t'] == 'p' for user_id in frame['off']])
+        self.assertNotIn('m', [frame['t'] for frame in frames])
+        self.assertFalse(GroupMessage.objects.filter(body='still here').exists())
+        self.assertFalse(acl.is_member(self.room.id, self.bob.id))
+
+
+class UnreadTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = (
+            User.objects.create(username=name, email=f'{name}@example.com') for name in ('alice', 'bob', 'carol')
+        )
+        cls.room = ChatGroup.objects.create(groupchat_name='Room')
+        cls.room.members.add(cls.alice, cls.bob, cls.carol)
+        cls.other = ChatGroup.objects.create(groupchat_name='Other')
+        cls.other.members.add(cls.alice, cls.bob)
+
+    def unread(self, user, room=None):
+        return ReadMarker.objects.get(user=user, group=room or self.room).unread_count
+
+    def test_counters_follow_writes_and_reads(self):
+        ids = [save_message(author, self.room.id, 'hi').id for author in (self.bob, self.bob, self.carol)]
+        save_message(self.bob, self.other.id, 'hello')
+        self.assertEqual([self.unread(user) for user in (self.alice, self.bob, self.carol)], [3, 1, 2])
+        with self.assertNumQueries(1):
+            counts = unread_counts(self.alice.id)
+        self.assertEqual(counts, {self.room.group_name: 3, self.other.group_name: 1})
+
+        self.assertTrue(mark_read(self.alice.id, self.room.id, ids[0]))
+        self.assertEqual(self.unread(self.alice), 2)
+        self.assertTrue(mark_read(self.alice.id, self.room.id, ids[2]))
+        self.assertEqual(self.unread(self.alice), 0)
+        self.assertFalse(mark_read(self.alice.id, self.room.id, ids[1]))  # Never backwards
+
+    def test_read_of_missing_message_counts_by_id(self):
+        # The marker's message was archived: there is no `created` to start from
+        ids = [save_message(self.bob, self.room.id, 'hi').id for _ in range(3)]
+        GroupMessage.objects.filter(id=ids[0]).delete()
+        self.assertTrue(mark_read(self.alice.id, self.room.id, ids[0]))
+        self.assertEqual(self.unread(self.alice), 2)
+
+    def test_read_stops_at_newest_message(self):
+        ids = [save_message(self.bob, self.room.id, 'hi').id for _ in range(2)]
+        self.assertTrue(mark_read(self.alice.id, self.room.id, ids[1] + 1000))
+        self.assertEqual(ReadMarker.objects.get(user=self.alice, group=self.room).last_read_message_id, ids[1])
+        save_message(self.bob, self.room.id, 'later')
+        self.assertEqual(self.unread(self.alice), 1)
+
+    def test_read_of_queued_message(self):
+        # Write-behind: the socket was sent a message that isn't written yet
+        last = save_message(self.bob, self.room.id, 'hi').id
+        self.assertTrue(mark_read(self.alice.id, self.room.id, last + 1, newest_id=last + 1))
+        self.assertEqual(ReadMarker.objects.get(user=self.alice, group=self.room).last_read_message_id, last + 1)
+        self.assertEqual(self.unread(self.alice), 0)
+
+    def test_batch_counts_only_past_marker(self):
+        # A write-behind batch lands after alice read its second message over the socket
+        batch = [GroupMessage.objects.create(author=author, group=self.room, body='hi') for author in
+                 (self.bob, self.carol, self.bob, self.alice)]
+        ReadMarker.objects.filter(user=self.alice, group=self.room).update(last_read_message_id=batch[1].id)
+        with self.assertNumQueries(2):
+            record_unread(self.room.id, batch)
+        self.assertEqual([self.unread(user) for user in (self.alice, self.bob, self.carol)], [1, 2, 3])
+
+    def test_membership_changes_markers(self):
+        save_message(self.bob, self.room.id, 'before dave')
+        dave = User.objects.create(username='dave', email='dave@example.com')
+        dave.chat_groups.add(self.room)
+        self.assertEqual(self.unread(dave), 0)
+        self.room.members.remove(dave)
+        self.assertFalse(ReadMarker.objects.filter(user=dave).exists())
+
+    def test_header_badges(self):
+        save_message(self.bob, self.room.id, 'hi')
+        self.client.force_login(self.alice)
+        response = self.client.get('/chat/search/')
+        self.assertContains(response, 'title="Unread messages">1</span>')
+
+
+class MigrationStateTests(TestCase):
+
+    def test_models_match_migrations(self):
+        # Fails with SystemExit if makemigrations would write a migration
+        call_command('makemigrations', 'a_rtchat', check=True, dry_run=True, stdout=io.StringIO())
+
+
+class MigrationTestCase(TransactionTestCase):
+    """
+    Run the data migrations of a_rtchat on rows made with the models of an
+    earlier migration. The schema is migrated back to the latest state after
+    each test.
+    """
+
+    def migrate(self, name):
+        """
+        Migrate a_rtchat to migration `name` and return the historical models.
+        """
+        executor = MigrationExecutor(connection)
+        executor.migrate([('a_rtchat', name)])
+        return executor.loader.project_state([('a_rtchat', name)]).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        super().tearDown()
+
+
+class DirectMessageTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def test_one_room_per_pair(self):
+        room, created = ChatGroup.objects.get_or_create_dm(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(ChatGroup.objects.get_or_create_dm(self.bob, self.alice), (room, False))
+
+    def test_losing_a_creation_race_returns_the_winner(self):
+        room, _ = ChatGroup.objects.get_or_create_dm(self.alice, self.bob)
+        # The other request created the room between our lookup and our INSERT
+        with mock.patch.object(ChatGroupQuerySet, 'first', return_value=None):
+            self.assertEqual(ChatGroup.objects.get_or_create_dm(self.alice, self.bob), (room, False))
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 1)
+        self.assertEqual(set(room.members.all()), {self.alice, self.bob})
+
+
+class DirectMessageMigrationTests(MigrationTestCase):
+
+    def test_duplicate_rooms_merge_and_get_their_key(self):
+        apps = self.migrate('0007_chatgroup_activity_stats')
+        User = apps.get_model('auth', 'User')
+        ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+        GroupMessage = apps.get_model('a_rtchat', 'GroupMessage')
+        alice, bob, carol = (User.objects.create(username=name) for name in ('alice', 'bob', 'carol'))
+
+        def room(members, authors, is_private=True):
+            chatroom = ChatGroup.objects.create(group_name=f'room-{ChatGroup.objects.count()}', is_private=is_private)
+            chatroom.members.add(*members)
+            for author in authors:
+                GroupMessage.objects.create(group=chatroom, author=author, body=f'from {author.username}')
+            return chatroom.id
+
+        first = room([alice, bob], [alice])
+        second = room([alice, bob], [bob])
+        # Bob left this one, which makes it the pair's third room
+        left = room([alice], [bob, alice])
+        # Carol left before the key existed: the authors tell the pair
+        alone = room([alice], [carol])
+        unknown = room([alice], [alice])
+        group = room([alice, bob], [], is_private=False)
+
+        apps = self.migrate('0008_chatgroup_dm_key')
+        ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+        rooms = {chatroom.id: chatroom for chatroom in ChatGroup.objects.all()}
+        self.assertEqual(set(rooms), {first, alone, unknown, group})
+        self.assertEqual(rooms[first].dm_key, f'{alice.id}:{bob.id}')
+        self.assertEqual(rooms[first].message_count, 4)
+        self.assertEqual(set(rooms[first].members.values_list('username', flat=True)), {'alice', 'bob'})
+        self.assertEqual(rooms[alone].dm_key, f'{alice.id}:{carol.id}')
+        self.assertIsNone(rooms[unknown].dm_key)
+        self.assertIsNone(rooms[group].dm_key)
+        self.assertNotIn(second, rooms)
+        self.assertNotIn(left, rooms)
+
+
+class RoomStatsMigrationTests(MigrationTestCase):
+
+    def test_existing_rooms_get_their_stats(self):
+        apps = self.migrate('0006_groupmessage_history_idx')
+        User = apps.get_model('auth', 'User')
+        ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+        GroupMessage = apps.get_model('a_rtchat', 'GroupMessage')
+        alice = User.objects.create(username='alice')
+        busy = ChatGroup.objects.create(group_name='busy')
+        quiet = ChatGroup.objects.create(group_name='quiet')
+        for i in range(3):
+            last = GroupMessage.objects.create(group=busy, author=alice, body=f'message {i}')
+
+        apps = self.migrate('0007_chatgroup_activity_stats')
+        ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+        busy, quiet = ChatGroup.objects.get(id=busy.id), ChatGroup.objects.get(id=quiet.id)
+        self.assertEqual((busy.message_count, busy.last_message_id), (3, last.id))
+        self.assertEqual((busy.last_message_at, busy.last_message_preview), (last.created, 'message 2'))
+        self.assertEqual((quiet.message_count, quiet.last_message_id, quiet.last_message_at), (0, None, None))
+
+
+class ProtocolTests(TestCase):
+    """
+    The chat.json.v1 frames, as static/js/chat_client.js reads them.
+    """
+
+    def setUp(self):
+        self.bob = User.objects.create(username='bob')
+        self.bob.profile.displayname = 'Bobby'
+        self.bob.profile.save()
+        self.room = ChatGroup.objects.create()
+
+    def message(self, body):
+        message = save_message(self.bob, self.room.id, body)
+        return GroupMessage.objects.select_related('author__profile').get(id=message.id)
+
+    def test_message_frame(self):
+        message = self.message('hi <b>there</b>')
+        self.assertEqual(json.loads(protocol.message_frame(message)), {
+            't': 'm',
+            'id': message.id,
+            'a': {'id': self.bob.id, 'u': 'bob', 'n': 'Bobby', 'av': self.bob.profile.avatar_url(64)},
+            'b': 'hi <b>there</b>',  # The client escapes it by setting textContent
+        })
+
+    def test_replay_frame(self):
+        messages = [self.message('one'), self.message('two')]
+        frame = json.loads(protocol.replay_frame(messages, more=True))
+        self.assertEqual((frame['t'], frame['more']), ('replay', True))
+        self.assertEqual([message['b'] for message in frame['m']], ['one', 'two'])
+        self.assertEqual(json.loads(protocol.replay_frame([], more=False)), {'t': 'replay', 'm': [], 'more': False})
+
+    def test_control_frames(self):
+        self.assertEqual(json.loads(protocol.hello_frame(5, [5, 8])), {'t': 'hello', 'me': 5, 'c': 2, 'on': [5, 8]})
+        self.assertEqual(json.loads(protocol.presence_frame(3, {7}, ())), {'t': 'p', 'c': 3, 'on': [7], 'off': []})
+        self.assertEqual(json.loads(protocol.redirect_frame('/')), {'t': 'r', 'url': '/'})
+        self.assertEqual(
+            json.loads(protocol.error_frame('rate_limited', retry_after=1.5)),
+            {'t': 'e', 'code': 'rate_limited', 'retry_after': 1.5},
+        )
+        # Compact: no whitespace between tokens
+        self.assertEqual(protocol.redirect_frame('/'), '{"t":"r","url":"/"}')
@@ -0,0 +1,216 @@
+"""
+Sampled span tracing of chat messages, exported to a local JSONL file.
+
+A trace starts where work enters the process (a socket connect or message,
+the HTMX post of chat_view) and is kept for SAMPLE_RATE of them. Work done
+inside it is wrapped in spans:
+
+    with tracing.start_trace('ws.receive', room=name):
+        with tracing.span('save_message'):
+            ...
+
+The current span lives in a context variable, so it follows the code into
+database_sync_to_async threads. To follow a message through the channel
+layer, the producer puts `tracing.inject()` in the event and every
+subscriber continues the trace with `tracing.continue_trace(event['trace'], ...)`;
+the context is a plain dict, so it survives any layer backend.
+
+Each finished span is one JSON line:
+
+    {"trace": "9f..", "span": "1c..", "parent": "77..", "name": "save_message",
+     "start": 1718000000.123, "ms": 1.42, "attrs": {...}}
+
+`python manage.py summarize_traces` reads the file back and shows where
+the time goes. Outside a sampled trace, span() and friends return a shared
+no-op object, so unsampled traffic pays one context variable lookup.
+
+    CHAT_TRACING = {
+        'SAMPLE_RATE': 0.01,               # fraction of traces kept, 0 disables
+        'PATH': BASE_DIR / 'traces.jsonl',
+    }
+"""
+import json
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULT_TRACING = {
+    'SAMPLE_RATE': 0,
+    'PATH': 'traces.jsonl',
+}
+
+_current = ContextVar('chat_trace_span', default=None)
+
+
+def tracing_settings():
+    return {**DEFAULT_TRACING, **getattr(settings, 'CHAT_TRACING', {})}
+
+
+def new_id(nbytes=8):
+    return os.urandom(nbytes).hex()
+
+
+class Span:
+    """
+    A timed operation in a trace; use it as a context manager.
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attrs', 'start', '_started', '_token')
+
+    def __init__(self, trace_id, parent_id, name, attrs):
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        export(self.trace_id, self.span_id, self.parent_id, self.name, self.start, elapsed, self.attrs)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def start_trace(name, **attrs):
+    """
+    Start a new trace, or return the no-op span if this one isn't sampled.
+    """
+    rate = get_sample_rate()
+    if not rate or random.random() >= rate:
+        return NOOP_SPAN
+    return Span(new_id(16), None, name, attrs)
+
+
+def span(name, **attrs):
+    """
+    A child of the current span, or the no-op span outside a sampled trace.
+    """
+    parent = _current.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace_id, parent.span_id, name, attrs)
+
+
+def inject():
+    """
+    The context to carry in a channel-layer event, or None outside a sampled trace.
+    """
+    current = _current.get()
+    if current is None:
+        return None
+    return {'id': current.trace_id, 'parent': current.span_id}
+
+
+def continue_trace(context, name, **attrs):
+    """
+    Continue a trace received in an event (the value of inject() on the other side).
+    """
+    if not context:
+        return NOOP_SPAN
+    return Span(context['id'], context['parent'], name, attrs)
+
+
+def record(context, name, start, seconds, **attrs):
+    """
+    Export a span that was timed by the caller, e.g. one that ends in a callback.
+
+    Parameters:
+        context: dict from inject() naming the trace and the parent span
+        name: name of the span
+        start: time.time() at which it started
+        seconds: its duration
+    """
+    export(context['id'], new_id(), context['parent'], name, start, seconds, attrs)
+
+
+def export(trace_id, span_id, parent_id, name, start, seconds, attrs):
+    get_exporter().export({
+        'trace': trace_id,
+        'span': span_id,
+        'parent': parent_id,
+        'name': name,
+        'start': start,
+        'ms': round(seconds * 1000, 3),
+        'attrs': attrs,
+    })
+
+
+class JsonlExporter:
+    """
+    Append spans to a file, one JSON object per line. Thread safe.
+
+    Lines are written as spans finish, from whatever thread or event loop
+    finishes them; that is a small blocking write, acceptable for the
+    sampled fraction of traffic only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@lru_cache(maxsize=None)
+def get_sample_rate():
+    return tracing_settings()['SAMPLE_RATE']
+
+
+@lru_cache(maxsize=None)
+def get_exporter():
+    return JsonlExporter(tracing_settings()['PATH'])
+
+
+@receiver(setting_changed)
+def reset_tracing(setting, **kwargs):
+    if setting == 'CHAT_TRACING':
+        get_sample_rate.cache_clear()
+        if get_exporter.cache_info().currsize:
+            get_exporter().close()
+        get_exporter.cache_clear()
@@ -0,0 +1,167 @@
+"""
+Unread message counters per user per chatroom.
+
+Every member of a room has a ReadMarker: the id of the newest message they
+have read and the number of messages from others after it. Counters are
+maintained incrementally, never by counting the messages of a room:
+
+- a_rtchat.persistence bumps them in the transaction that writes new
+  messages, with one UPDATE per room per write (per batch with
+  write-behind), whatever the number of members;
+- the chat socket's {"type": "read", "last_id": ...} frame moves the
+  marker forward and resets the counter (mark_read);
+- memberships get a marker when added and lose it when removed (see
+  a_rtchat.signals).
+
+unread_counts() then reads the counters of all of a user's rooms in one
+query for the header.
+"""
+import datetime
+from collections import Counter
+
+from django.db import connection
+from django.db.models import Case, Count, DateTimeField, Exists, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Least
+
+from a_rtchat.models import ChatGroup, GroupMessage, ReadMarker
+
+# Messages per UPDATE when some members have read into a batch
+CASE_CHUNK = 50
+# Lower bound of `created` when the marker's message isn't in the table
+EARLIEST = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def record_unread(group_id, messages):
+    """
+    Count new messages of a room as unread for its other members.
+
+    A member only gets the messages newer than their marker. With
+    write-behind, a reader can be past some of a batch before it is
+    written: they saw it over the socket and sent a read frame.
+
+    This runs in every message write, so the statements are written out
+    rather than built with the ORM, whose expression compiling cost more
+    than the UPDATEs themselves.
+
+    Parameters:
+        group_id: id of the ChatGroup
+        messages: the new GroupMessages of the room, with ids
+    """
+    table = ReadMarker._meta.db_table
+    messages = sorted(messages, key=lambda message: message.id)
+    with connection.cursor() as cursor:
+        for start in range(0, len(messages), CASE_CHUNK):
+            chunk = messages[start:start + CASE_CHUNK]
+            first, last = chunk[0].id, chunk[-1].id
+            # Members who haven't read any of them: all count but their own
+            own = Counter(message.author_id for message in chunk)
+            cursor.execute(
+                f"""
+                UPDATE {table} SET unread_count = unread_count + CASE user_id
+                    {' '.join(['WHEN %s THEN %s'] * len(own))} ELSE %s END
+                WHERE group_id = %s AND last_read_message_id < %s
+                """,
+                [*(value for author_id, count in own.items() for value in (author_id, len(chunk) - count)),
+                 len(chunk), group_id, first],
+            )
+            if first == last:
+                continue
+            # Members who already read into them: only the ones past their marker count
+            cursor.execute(
+                f"""
+                UPDATE {table} SET unread_count = unread_count + {' + '.join(
+                    ['(CASE WHEN last_read_message_id < %s AND user_id != %s THEN 1 ELSE 0 END)'] * (len(chunk) - 1)
+                )}
+                WHERE group_id = %s AND last_read_message_id >= %s AND last_read_message_id < %s
+                """,
+                [*(value for message in chunk[1:] for value in (message.id, message.author_id)),
+                 group_id, first, last],
+            )
+
+
+def mark_read(user_id, group_id, last_id, newest_id=0):
+    """
+    Move the user's marker of a room forward to message `last_id`, in one query.
+
+    When last_id is the room's newest message, which is the usual case,
+    the counter becomes 0 without counting anything. Otherwise the messages
+    from others after it are counted from there on. Markers never move
+    backwards, so late or repeated read frames change nothing, and never
+    past the room's newest message, so a bogus id can't hide the messages
+    still to come.
+
+    Parameters:
+        user_id: id of the reader
+        group_id: id of the ChatGroup
+        last_id: id of the newest message the user has read
+        newest_id: newest message id of the room known to the caller;
+                   with write-behind it may be queued and not yet the
+                   room's last_message_id
+
+    Returns:
+        True if the marker moved
+    """
+    marker_created = Subquery(GroupMessage.objects.filter(id=last_id).values('created')[:1])
+    newer = (
+        GroupMessage.objects
+        .filter(
+            group_id=group_id,
+            id__gt=last_id,
+            # Enter the (group, created, id) index at the marker. When its
+            # message is archived or still queued there is no row to read
+            # `created` from, and the id alone bounds the count
+            created__gte=Coalesce(marker_created, Value(EARLIEST, output_field=DateTimeField())),
+        )
+        .exclude(author_id=user_id)
+        .order_by()
+        .values('group_id')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    room_last = Coalesce(Subquery(ChatGroup.objects.filter(id=group_id).values('last_message_id')[:1]), 0)
+    target = Least(Value(last_id), Greatest(room_last, Value(newest_id)))
+    moved = ReadMarker.objects.filter(
+        user_id=user_id, group_id=group_id, last_read_message_id__lt=target,
+    ).update(
+        last_read_message_id=target,
+        unread_count=Case(
+            When(Exists(ChatGroup.objects.filter(id=group_id, last_message_id__gt=last_id)), then=Coalesce(Subquery(newer), 0)),
+            default=0,
+        ),
+    )
+    return bool(moved)
+
+
+def unread_counts(user_id):
+    """
+    Unread counters of all of the user's rooms with unread messages.
+
+    Returns:
+        Dict {group_name: unread count}
+    """
+    return dict(
+        ReadMarker.objects
+        .filter(user_id=user_id, unread_count__gt=0)
+        .values_list('group__group_name', 'unread_count')
+    )
+
+
+def create_markers(rooms, user_ids):
+    """
+    Give new memberships a marker, with the messages before them counted as read.
+
+    Parameters:
+        rooms: dict {room id: id of its last message or None}
+        user_ids: ids of the users who joined them
+    """
+    ReadMarker.objects.bulk_create(
+        [
+            ReadMarker(user_id=user_id, group_id=group_id, last_read_message_id=last_message_id or 0)
+            for group_id, last_message_id in rooms.items() for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def delete_markers(group_ids, user_ids):
+    ReadMarker.objects.filter(group_id__in=group_ids, user_id__in=user_ids).delete()
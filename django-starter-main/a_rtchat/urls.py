@@ -5,6 +5,8 @@ urlpatterns = [
     path('', chat_view, name="home"),
     path('chat/<username>', get_or_create_chatroom, name="start_chat"),
     path('chat/room/<chatroom_name>', chat_view, name="chatroom"),
+    path('chat/room/<chatroom_name>/history', chat_history_view, name="chatroom-history"),
+    path('chat/search/', search_view, name="chat-search"),
     path('chat/new_groupchat/', create_groupchat, name="new-groupchat"), 
     path('chat/edit/<chatroom_name>', chatroom_edit_view, name="edit-chatroom"),
     path('chat/delete/<chatroom_name>', chatroom_delete_view, name="chatroom-delete"),
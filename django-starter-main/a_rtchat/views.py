@@ -1,7 +1,19 @@
-from django.http import Http404
+import math
+
+from django.conf import settings
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.contrib.auth.decorators import login_required
+from a_rtchat import acl, tracing
+from a_rtchat.history import history_page
+from a_rtchat.membership import remove_members
+from a_rtchat.nav import get_room_index
+from a_rtchat.search import search_messages
 from a_rtchat.models import ChatGroup
+from a_rtchat.persistence import save_message
+from a_rtchat.presence import get_presence_store
+from a_rtchat.ratelimit import get_rate_limiter
 from django.contrib import messages
 from .forms import * 
 from django.contrib.auth.models import User
@@ -22,8 +34,6 @@ def chat_view(request, chatroom_name='public-chat'):
     """
 
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    # Get the last 40 messages for the chatroom
-    chat_messages = chat_group.chat_messages.all()[:40]
     form = ChatmessageCreateForm()
 
     other_user = None
@@ -31,85 +41,153 @@ def chat_view(request, chatroom_name='public-chat'):
     # 1. Public chat - accessible to everyone
     if chatroom_name == 'public-chat':
         # Ensure user is a member (no verification needed)
-        if request.user not in chat_group.members.all():
+        if not acl.is_member(chat_group.id, request.user.id):
             chat_group.members.add(request.user)
     
     # 2. Private chat (direct messages)
     elif chat_group.is_private:
         # Ensure user is a member (no verification needed)
-        if request.user not in chat_group.members.all():
+        if not acl.is_member(chat_group.id, request.user.id):
             raise Http404()
         # Get the other user in the private chat
-        for member in chat_group.members.all():
-            if member != request.user:
-                other_user = member
-                break
+        other_user = chat_group.members.select_related('profile').exclude(id=request.user.id).first()
                 
     # 3. Group chats - need verification
     else:
         # Check email verification
-        if not request.user.emailaddress_set.filter(verified=True).exists():
+        if not acl.is_verified(request.user.id):
             messages.warning(request, 'Please verify your email address to join this group chat.')
             return redirect('profile-settings')
             
         # Add to members if verified
-        if request.user not in chat_group.members.all():
+        if not acl.is_member(chat_group.id, request.user.id):
             chat_group.members.add(request.user)
     
     # Process new messages submitted via HTMX
     if request.htmx:
         form = ChatmessageCreateForm(request.POST)
         if form.is_valid():
-            message = form.save(commit=False)
-            message.author = request.user
-            message.group = chat_group
-            message.save()
-            context = {
-                'message':message,
-                'user' : request.user
-            }
-            return render(request , 'a_rtchat/partials/chat_message_p.html', context)
+            with tracing.start_trace('http.chat_post', room=chatroom_name) as trace:
+                retry_after = get_rate_limiter().acquire(request.user.id, chat_group.id)
+                if retry_after:
+                    trace.set(rate_limited=True)
+                    response = HttpResponse('Too many messages, slow down.', status=429)
+                    response['Retry-After'] = math.ceil(retry_after)
+                    return response
+                with tracing.span('save_message'):
+                    message = save_message(request.user, chat_group.id, form.cleaned_data['body'])
+                trace.set(message_id=message.id)
+                context = {
+                    'message':message,
+                    'user' : request.user
+                }
+                with tracing.span('render'):
+                    return render(request , 'a_rtchat/partials/chat_message_p.html', context)
+
+    # Get the newest page of messages; older ones load as the user scrolls up
+    chat_messages, has_more = history_page(chat_group.id)
+    # Group chats list their members with avatars: load them in one go
+    if chat_group.groupchat_name:
+        prefetch_related_objects([chat_group], Prefetch('members', queryset=User.objects.select_related('profile')))
 
     context = {
         'chatroom_name': chatroom_name,
         'chat_messages': chat_messages,
+        'has_more': has_more,
         'form': form,
         'other_user': other_user,
         'chat_group' : chat_group,
+        'online_user_ids': get_presence_store().online(chatroom_name),
+        'client_protocol': getattr(settings, 'CHAT_CLIENT_PROTOCOL', 'html'),
     }
 
     return render(request, 'a_rtchat/chat.html', context )
 
 
+@login_required
+@require_http_methods(["GET"])
+def chat_history_view(request, chatroom_name):
+    """
+    Return the page of messages older than ?before=<message id> as an HTMX partial.
+
+    The partial starts with a sentinel that loads the next older page when
+    it scrolls into view, so the chat history scrolls back indefinitely.
+    """
+    room = acl.can_join(request.user.id, chatroom_name)
+    if room is None:
+        raise Http404()
+    try:
+        before = int(request.GET['before'])
+    except (KeyError, ValueError):
+        raise Http404()
+
+    chat_messages, has_more = history_page(room['id'], before=before)
+    context = {
+        'chatroom_name': chatroom_name,
+        'chat_messages': chat_messages,
+        'has_more': has_more,
+    }
+    return render(request, 'a_rtchat/partials/chat_history.html', context)
+
+
+@login_required
+@require_http_methods(["GET"])
+def search_view(request):
+    """
+    Search the messages of the user's chatrooms: ?q=<words>&page=<n>.
+
+    Results are ranked by relevance (see a_rtchat.search) and labelled with
+    the room they were posted in, named as in the header's chat list.
+    """
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+
+    results, has_more = search_messages(request.user.id, query, page) if query else ([], False)
+    room_names = {room['group_name']: room['name'] for room in get_room_index(request.user.id)['rooms']}
+    context = {
+        'query': query,
+        'page': page,
+        'has_more': has_more,
+        'results': [
+            {
+                'message': message,
+                'snippet': snippet,
+                'room_name': room_names.get(
+                    message.group.group_name,
+                    'Public Chat' if message.group.group_name == 'public-chat' else 'Chat',
+                ),
+            }
+            for message, snippet in results
+        ],
+    }
+    return render(request, 'a_rtchat/search.html', context)
+
+
 @login_required
 def get_or_create_chatroom(request, username):
     """
     Get an existing private chat with a user or create a new one.
     
     This function finds or creates a private chatroom between the current
-    user and another user specified by username.
+    user and another user specified by username. There is exactly one
+    private chatroom per pair of users, looked up by its dm_key.
     
     """
     if request.user.username == username:
         return redirect('home')
     
     # Check if the user exists
-    other_user = User.objects.get(username=username)
-    my_chatrooms = request.user.chat_groups.filter(is_private=True)
-
-    if my_chatrooms.exists():
-        for chatroom in my_chatrooms:
-            # Check if the other user is a member of the chatroom
-            if other_user in chatroom.members.all():
-                chatroom = chatroom
-                break
-            else:
-                # Create a new private chatroom if the other user is not a member
-                chatroom = ChatGroup.objects.create(is_private=True)
-                chatroom.members.add(other_user,request.user )
-    else:
-        chatroom = ChatGroup.objects.create(is_private=True)
-        chatroom.members.add(other_user,request.user )
+    other_user = get_object_or_404(User, username=username)
+    chatroom, created = ChatGroup.objects.get_or_create_dm(request.user, other_user)
+
+    # Bring back whoever left the chat earlier
+    if not created and not (
+        acl.is_member(chatroom.id, request.user.id) and acl.is_member(chatroom.id, other_user.id)
+    ):
+        chatroom.members.add(request.user, other_user)
     return redirect('chatroom', chatroom.group_name)
 
 
@@ -143,14 +221,18 @@ def chatroom_edit_view(request, chatroom_name):
     Edit chatroom settings and manage members.
     
     Only the admin of the chatroom can access this view. Allows changing 
-    chatroom settings and removing members. When members are removed,
-    WebSocket notifications are sent to them.
+    chatroom settings and removing members. Removed members are dropped in
+    one query and only their own sockets are notified (see
+    a_rtchat.membership).
     
     """
     # Check if the user is the admin of the chatroom
     # If not, raise a 404 error
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    if request.user != chat_group.admin:
+    chat_group = get_object_or_404(
+        ChatGroup.objects.prefetch_related(Prefetch('members', queryset=User.objects.select_related('profile'))),
+        group_name=chatroom_name,
+    )
+    if request.user.id != chat_group.admin_id:
         raise Http404()
     
     form = ChatRoomEditForm(instance=chat_group)
@@ -160,32 +242,13 @@ def chatroom_edit_view(request, chatroom_name):
         if form.is_valid():
             form.save()
 
-            # Get removed members before removing them
-            removed_members = []
-            remove_members = request.POST.getlist('remove_members')
-            
-            for member_id in remove_members:
-                member = User.objects.get(id=member_id)
-                removed_members.append(member)
-                chat_group.members.remove(member)
-            
-            # Send WebSocket notifications to removed members
-            if removed_members:
-                from channels.layers import get_channel_layer
-                from asgiref.sync import async_to_sync
-                
-                channel_layer = get_channel_layer()
-                for member in removed_members:
-                    # Send message to notify the member they've been removed
-                    # This will trigger a WebSocket event that redirects them to home
-                    async_to_sync(channel_layer.group_send)(
-                        chatroom_name,
-                        {
-                            'type': 'member_removed',
-                            'removed_user_id': member.id
-                        }
-                    )
-            
+            # Only ids of actual members count; they are prefetched already
+            member_ids = {member.id for member in chat_group.members.all()}
+            remove_members(chat_group, {
+                int(member_id) for member_id in request.POST.getlist('remove_members')
+                if member_id.isdigit() and int(member_id) in member_ids
+            })
+
             return redirect('chatroom', chatroom_name)
 
     context = {
@@ -206,7 +269,7 @@ def chatroom_delete_view(request, chatroom_name):
     """
     # Check if the user is the admin of the chatroom
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name) 
-    if request.user != chat_group.admin:
+    if request.user.id != chat_group.admin_id:
         raise Http404()
     if request.method == 'POST':
         chat_group.delete()
@@ -225,7 +288,7 @@ def chatroom_leave_view(request,chatroom_name):
     
     """
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    if request.user not in chat_group.members.all():
+    if not acl.is_member(chat_group.id, request.user.id):
         raise Http404()
     if request.method == 'POST':
         chat_group.members.remove(request.user)
@@ -2,6 +2,7 @@ from django.forms import ModelForm
 from django import forms
 from django.contrib.auth.models import User
 from .models import Profile
+from .thumbnails import schedule_thumbnails
 
 class ProfileForm(ModelForm):
     class Meta:
@@ -12,6 +13,15 @@ class ProfileForm(ModelForm):
             'displayname' : forms.TextInput(attrs={'placeholder': 'Add display name'}),
             'info' : forms.Textarea(attrs={'rows':3, 'placeholder': 'Add information'})
         }
+
+    def save(self, commit=True):
+        """
+        Save the profile; a new image gets its resized variants made in the background.
+        """
+        profile = super().save(commit)
+        if commit and 'image' in self.changed_data and profile.image:
+            schedule_thumbnails(profile)
+        return profile
         
         
 class EmailForm(ModelForm):
@@ -0,0 +1,40 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from a_users.models import Profile
+from a_users.thumbnails import make_thumbnails, record_thumbnails, thumbnail_settings
+
+logger = logging.getLogger(__name__)
+
+
+def _make(image_name):
+    try:
+        make_thumbnails(image_name)
+        return True
+    except Exception:
+        logger.exception('Could not make the avatar thumbnails of %s', image_name)
+        return False
+
+
+class Command(BaseCommand):
+    help = 'Make the resized avatar variants of profiles that have none for their current image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Remake the variants of every avatar')
+        parser.add_argument('--workers', type=int, help="Threads, AVATAR_THUMBNAILS['WORKERS'] by default")
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['force']:
+            profiles = profiles.exclude(thumbnails_of=F('image'))
+        todo = list(profiles.values_list('id', 'image'))
+        done = 0
+        # Threads only resize; the profiles are updated from this one
+        with ThreadPoolExecutor(options['workers'] or thumbnail_settings()['WORKERS']) as pool:
+            for (profile_id, image_name), made in zip(todo, pool.map(_make, [image for _, image in todo])):
+                if made and record_thumbnails(profile_id, image_name):
+                    done += 1
+        self.stdout.write(f'Made the avatar variants of {done} of {len(todo)} profiles')
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_users', '0002_profile_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='thumbnails_of',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100),
+        ),
+    ]
@@ -7,6 +7,10 @@ class Profile(models.Model):
     image = models.ImageField(upload_to='avatars/', null=True, blank=True)
     displayname = models.CharField(max_length=20, null=True, blank=True)
     info = models.TextField(null=True, blank=True) 
+    # Bumped on every edit; part of the cache key of rendered chat messages
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Name of the image the resized variants were made from (see a_users.thumbnails)
+    thumbnails_of = models.CharField(max_length=100, blank=True, default='', editable=False)
     
     def __str__(self):
         return str(self.user)
@@ -22,3 +26,17 @@ class Profile(models.Model):
         if self.image:
             return self.image.url
         return f'{settings.STATIC_URL}images/avatar.svg'
+
+    def avatar_url(self, size):
+        """
+        URL of the avatar resized to at least `size` pixels.
+
+        Returns the smallest resized variant that big, or the original
+        upload until the variants are made or if none is that big.
+        """
+        if not self.image:
+            return self.avatar
+        if self.thumbnails_of != self.image.name:
+            return self.image.url
+        from a_users.thumbnails import thumbnail_url  # It imports this module
+        return thumbnail_url(self.image.name, size) or self.image.url
@@ -1,4 +1,5 @@
 from django.dispatch import receiver
+from django.db.models import F
 from django.db.models.signals import post_save, pre_save
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
@@ -58,4 +59,29 @@ def user_presave(sender, instance, **kwargs):
     - kwargs: Additional keyword arguments
     """
     if instance.username:
-        instance.username = instance.username.lower()
\ No newline at end of file
+        instance.username = instance.username.lower()
+
+
+@receiver(pre_save, sender=Profile)
+def profile_presave(sender, instance, **kwargs):
+    """
+    Signal handler that executes before a Profile instance is saved.
+
+    Bumps the profile version on every edit, so chat messages rendered
+    with the old name or avatar are no longer served from the fragment
+    cache (see a_rtchat.fragments).
+    """
+    if instance.pk:
+        instance.version += 1
+
+
+@receiver(post_save, sender=User)
+def user_version_postsave(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Signal handler that bumps the profile version when the username may have
+    changed (rendered chat messages show it). Logins only touch last_login
+    and are skipped.
+    """
+    if created or update_fields == frozenset(['last_login']):
+        return
+    Profile.objects.filter(user=instance).update(version=F('version') + 1)
@@ -0,0 +1,13 @@
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def avatar_url(profile, size):
+    """
+    URL of a profile's avatar resized to at least `size` pixels.
+
+    Usage: {% load avatars %} <img src="{{ profile|avatar_url:64 }}">
+    """
+    return profile.avatar_url(int(size))
@@ -1,3 +1,160 @@
-from django.test import TestCase
+import io
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models import F, QuerySet
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from a_rtchat.models import ChatGroup
+from a_rtchat.testing import QueryBudgetMixin
+from a_users.models import Profile
+from a_users.thumbnails import generate_thumbnails, thumbnail_name
+
+
+class ProfileViewQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+    Profile pages share the header with the chat pages; they must not query
+    per private chat in the chat dropdown.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice', email='alice@example.com')
+        cls.other = User.objects.create(username='bob')
+        for i in range(6):
+            ChatGroup.objects.get_or_create_dm(cls.user, User.objects.create(username=f'user{i}'))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_own_profile(self):
+        self.assertViewQueryBudget(5, '/profile/')
+
+    def test_other_profile(self):
+        self.assertViewQueryBudget(6, f'/profile/{self.other.username}/')
+
+    def test_profile_edit(self):
+        self.assertViewQueryBudget(5, '/profile/edit/')
+
+    def test_profile_settings(self):
+        self.assertViewQueryBudget(7, '/profile/settings/')
+
+
+@override_settings(STORAGES={'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'}})
+class AvatarThumbnailTests(TestCase):
+    """
+    Uploaded avatars get small square WebP variants; pages use them once made.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice', email='alice@example.com')
+
+    def upload(self, name='alice.png', size=(600, 400)):
+        out = io.BytesIO()
+        Image.new('RGB', size, 'red').save(out, 'PNG')
+        return SimpleUploadedFile(name, out.getvalue(), content_type='image/png')
+
+    def set_image(self, name='alice.png'):
+        profile = self.user.profile
+        profile.refresh_from_db()
+        profile.image = self.upload(name)
+        profile.save()
+        return profile
+
+    def test_generate(self):
+        profile = self.set_image()
+        self.assertEqual(profile.avatar_url(64), profile.image.url)
+        version = profile.version
+
+        self.assertTrue(generate_thumbnails(profile.id, profile.image.name))
+        profile.refresh_from_db()
+        for size in (32, 64, 128):
+            with default_storage.open(thumbnail_name(profile.image.name, size)) as f:
+                image = Image.open(f)
+                self.assertEqual((image.format, image.size), ('WEBP', (size, size)))
+        self.assertEqual(profile.avatar_url(40), default_storage.url(thumbnail_name(profile.image.name, 64)))
+        self.assertEqual(profile.avatar_url(512), profile.image.url)
+        self.assertEqual(profile.version, version + 1)
+
+    def test_new_image_replaces_variants(self):
+        profile = self.set_image('first.png')
+        generate_thumbnails(profile.id, profile.image.name)
+        old = profile.image.name
+        profile = self.set_image('second.png')
+        # Variants of an image the profile no longer has are thrown away
+        self.assertFalse(generate_thumbnails(profile.id, old))
+        self.assertFalse(default_storage.exists(thumbnail_name(old, 64)))
+
+        self.assertTrue(generate_thumbnails(profile.id, profile.image.name))
+        profile.refresh_from_db()
+        self.assertEqual(profile.thumbnails_of, profile.image.name)
+        self.assertIn('/thumbs/', profile.avatar_url(64))
+
+    def test_concurrent_changes_are_kept(self):
+        profile = self.set_image()
+        version = profile.version
+        first = QuerySet.first
+
+        def first_then_bump(queryset):
+            found = first(queryset)
+            # Another request renames the user while the variants are recorded
+            Profile.objects.filter(pk=profile.pk).update(version=F('version') + 1)
+            return found
+
+        with mock.patch.object(QuerySet, 'first', first_then_bump):
+            self.assertTrue(generate_thumbnails(profile.id, profile.image.name))
+        profile.refresh_from_db()
+        self.assertEqual(profile.version, version + 2)
+
+        # The image is replaced after the variants were made
+        old = profile.image.name
+
+        def first_then_replace(queryset):
+            found = first(queryset)
+            Profile.objects.filter(pk=profile.pk).update(image='avatars/other.png')
+            return found
+
+        with mock.patch.object(QuerySet, 'first', first_then_replace):
+            self.assertFalse(generate_thumbnails(profile.id, old))
+        profile.refresh_from_db()
+        self.assertEqual(profile.image.name, 'avatars/other.png')
+        self.assertEqual(profile.version, version + 2)
+        self.assertFalse(default_storage.exists(thumbnail_name(old, 64)))
+
+    def test_images_sharing_a_stem_keep_their_own_variants(self):
+        mine = self.set_image('photo.jpg')
+        other = User.objects.create(username='bob', email='bob@example.com').profile
+        other.image = self.upload('photo.png')
+        other.save()
+        generate_thumbnails(mine.id, mine.image.name)
+        generate_thumbnails(other.id, other.image.name)
+        self.assertNotEqual(thumbnail_name(mine.image.name, 64), thumbnail_name(other.image.name, 64))
+
+        # A new image of one of them deletes only that one's old variants
+        old = mine.image.name
+        mine = self.set_image('second.png')
+        generate_thumbnails(mine.id, mine.image.name)
+        self.assertFalse(default_storage.exists(thumbnail_name(old, 64)))
+        self.assertTrue(default_storage.exists(thumbnail_name(other.image.name, 64)))
+
+    def test_upload_schedules_thumbnails(self):
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post('/profile/edit/', {'image': self.upload(), 'displayname': 'Alice', 'info': ''})
+        self.assertEqual(len(callbacks), 1)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post('/profile/edit/', {'displayname': 'Alice A', 'info': ''})
+        self.assertEqual(callbacks, [])
+
+    def test_backfill_command(self):
+        profile = self.set_image()
+        out = io.StringIO()
+        call_command('generate_avatar_thumbnails', workers=1, stdout=out)
+        self.assertIn('1 of 1', out.getvalue())
+        profile.refresh_from_db()
+        self.assertEqual(profile.thumbnails_of, profile.image.name)
@@ -0,0 +1,172 @@
+"""
+Resized avatar variants, so pages don't load full-size uploads into 32 px circles.
+
+When a profile gets a new image, a background thread pool makes a square,
+centre-cropped WebP of it at every configured size and stores them next
+to the upload:
+
+    avatars/alice.jpg  ->  avatars/thumbs/alice.jpg-32.webp
+                           avatars/thumbs/alice.jpg-64.webp
+                           avatars/thumbs/alice.jpg-128.webp
+
+Once they are written, Profile.thumbnails_of is set to the image's name and
+Profile.avatar_url(size) starts returning them. The same UPDATE bumps the
+profile's version and thumbnails_recorded clears the room indexes that show
+it, so cached chat messages and headers pick up the small variant too.
+Until then, and for profiles made before this existed, the original is
+served; the generate_avatar_thumbnails command makes the variants of
+existing avatars.
+
+    AVATAR_THUMBNAILS = {
+        'SIZES': [32, 64, 128],  # square edges in pixels
+        'QUALITY': 80,           # WebP quality
+        'WORKERS': 2,            # threads of the pool
+    }
+"""
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.dispatch import Signal, receiver
+from PIL import Image, ImageOps
+
+from a_users.models import Profile
+
+# Sent with profile_id and user_id once a profile uses new variants
+thumbnails_recorded = Signal()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THUMBNAILS = {
+    'SIZES': [32, 64, 128],
+    'QUALITY': 80,
+    'WORKERS': 2,
+}
+
+
+def thumbnail_settings():
+    return {**DEFAULT_THUMBNAILS, **getattr(settings, 'AVATAR_THUMBNAILS', {})}
+
+
+def thumbnail_name(image_name, size):
+    # The whole file name: storage keeps it unique, the stem alone isn't
+    # (alice.jpg and alice.png can belong to different users)
+    directory, filename = os.path.split(image_name)
+    return os.path.join(directory, 'thumbs', f'{filename}-{size}.webp')
+
+
+def thumbnail_url(image_name, size):
+    """
+    URL of the smallest variant of an image at least `size` pixels wide, or
+    None if every variant is smaller.
+    """
+    for variant in sorted(thumbnail_settings()['SIZES']):
+        if variant >= size:
+            return default_storage.url(thumbnail_name(image_name, variant))
+    return None
+
+
+def make_thumbnails(image_name):
+    """
+    Write the variants of an image to storage.
+
+    The image is decoded once, turned upright according to its EXIF
+    orientation and cropped to a square; each size is then resized from
+    the previous, larger one.
+    """
+    config = thumbnail_settings()
+    sizes = sorted(config['SIZES'], reverse=True)
+    with default_storage.open(image_name) as f:
+        image = Image.open(f)
+        # JPEGs can be decoded at a fraction of their size, much faster
+        image.draft('RGB', (sizes[0] * 2, sizes[0] * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    edge = min(image.size)
+    image = ImageOps.fit(image, (edge, edge), Image.Resampling.LANCZOS)
+    for size in sizes:
+        if image.width > size:
+            image = image.resize((size, size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=config['QUALITY'], method=4)
+        name = thumbnail_name(image_name, size)
+        default_storage.delete(name)  # Otherwise storage picks another name
+        default_storage.save(name, ContentFile(out.getvalue()))
+
+
+def delete_thumbnails(image_name):
+    for size in thumbnail_settings()['SIZES']:
+        default_storage.delete(thumbnail_name(image_name, size))
+
+
+def record_thumbnails(profile_id, image_name):
+    """
+    Switch a profile to the variants of image_name once they are written.
+
+    Nothing is recorded if the profile got another image in the meantime;
+    the variants of the image it replaces are deleted.
+
+    Returns:
+        True if the profile now uses the variants of image_name
+    """
+    profile = Profile.objects.filter(pk=profile_id).values('user_id', 'thumbnails_of').first()
+    # Checks the image and bumps the version in one statement: a concurrent
+    # image change or version bump isn't overwritten with what was read here
+    updated = profile is not None and Profile.objects.filter(pk=profile_id, image=image_name).update(
+        thumbnails_of=image_name, version=F('version') + 1,
+    )
+    if not updated:
+        delete_thumbnails(image_name)
+        return False
+    previous = profile['thumbnails_of']
+    if previous and previous != image_name:
+        delete_thumbnails(previous)
+    thumbnails_recorded.send(sender=Profile, profile_id=profile_id, user_id=profile['user_id'])
+    return True
+
+
+def generate_thumbnails(profile_id, image_name):
+    """
+    Make the variants of a profile's image and switch the profile to them.
+    """
+    make_thumbnails(image_name)
+    return record_thumbnails(profile_id, image_name)
+
+
+def _run(profile_id, image_name):
+    try:
+        generate_thumbnails(profile_id, image_name)
+    except Exception:
+        logger.exception('Could not make the avatar thumbnails of %s', image_name)
+    finally:
+        close_old_connections()
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(thumbnail_settings()['WORKERS'], thread_name_prefix='avatar-thumbnails')
+
+
+def schedule_thumbnails(profile):
+    """
+    Make the variants of the profile's image in the background once the
+    current transaction commits.
+    """
+    profile_id, image_name = profile.pk, profile.image.name
+    transaction.on_commit(lambda: get_executor().submit(_run, profile_id, image_name))
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    if setting == 'AVATAR_THUMBNAILS':
+        if get_executor.cache_info().currsize:
+            get_executor().shutdown(wait=True)
+        get_executor.cache_clear()
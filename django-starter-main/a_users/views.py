@@ -7,6 +7,7 @@ from django.contrib.auth.models import User
 from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
 from .forms import *
+from .models import Profile
 
 def profile_view(request, username=None):
     """
@@ -18,7 +19,7 @@ def profile_view(request, username=None):
     
     """
     if username:
-        profile = get_object_or_404(User, username=username).profile
+        profile = get_object_or_404(Profile.objects.select_related('user'), user__username=username)
     else:
         try:
             profile = request.user.profile
@@ -0,0 +1,205 @@
+// Client for the chat.json.v1 protocol (see a_rtchat/protocol.py).
+// Renders the same markup as a_rtchat/chat_message.html from compact JSON
+// frames instead of receiving the HTML from the server.
+(function () {
+  const form = document.getElementById("chat_message_form");
+  if (!form || !form.dataset.wsUrl) return;
+
+  const messages = document.getElementById("chat_messages");
+  const svgNS = "http://www.w3.org/2000/svg";
+  // The server closed on purpose: removed from the room (membership.py) or
+  // too far behind (outbound.py). Reconnecting would not help.
+  const FINAL_CLOSE_CODES = [4003, 4008];
+  const MAX_RETRY_DELAY = 30000;
+  // Connects that fail before opening, in a row, before giving up: a denied
+  // connect (not a member, logged out) looks like any network error here
+  const MAX_FAILED_CONNECTS = 6;
+  let me = null;
+  let socket = null;
+  let readTimer = null;
+  let stopped = false;
+  let failedConnects = 0;
+
+  function el(tag, className, text) {
+    const node = document.createElement(tag);
+    if (className) node.className = className;
+    if (text !== undefined) node.textContent = text;
+    return node;
+  }
+
+  function tail(fill, d) {
+    const svg = document.createElementNS(svgNS, "svg");
+    svg.setAttribute("height", "13");
+    svg.setAttribute("width", "8");
+    const path = document.createElementNS(svgNS, "path");
+    path.setAttribute("fill", fill);
+    path.setAttribute("d", d);
+    svg.appendChild(path);
+    return svg;
+  }
+
+  function renderOwn(frame) {
+    const li = el("li", "flex justify-end mb-4 fade-in-up");
+    li.dataset.messageId = frame.id;
+    const bubble = el("div", "bg-green-200 rounded-l-lg rounded-tr-lg p-4 max-w-[75%]");
+    bubble.appendChild(el("span", "", frame.b));
+    const end = el("div", "flex items-end");
+    end.appendChild(tail("#bbf7d0", "M6.3,10.4C1.5,8.7,0.9,5.5,0,0.2L0,13l5.2,0C7,13,9.6,11.5,6.3,10.4z"));
+    li.append(bubble, end);
+    return li;
+  }
+
+  function renderOther(frame) {
+    const author = frame.a;
+    const li = el("li", "fade-in-up");
+    li.dataset.messageId = frame.id;
+    const row = el("div", "flex justify-start");
+    const avatarBox = el("div", "flex items-end mr-2");
+    const link = el("a");
+    link.href = "/profile/" + encodeURIComponent(author.u) + "/";
+    const img = el("img", "w-8 h-8 rounded-full object-cover");
+    img.src = author.av;
+    link.appendChild(img);
+    avatarBox.appendChild(link);
+    const tailBox = el("div", "flex items-end");
+    tailBox.appendChild(tail("white", "M2.8,13L8,13L8,0.2C7.1,5.5,6.5,8.7,1.7,10.4C-1.6,11.5,1,13,2.8,13z"));
+    const bubble = el("div", "bg-white p-4 max-w-[75%] rounded-r-lg rounded-tl-lg");
+    bubble.appendChild(el("span", "", frame.b));
+    row.append(avatarBox, tailBox, bubble);
+    const meta = el("div", "text-sm font-light py-1 ml-10");
+    meta.append(el("span", "text-white", author.n), " ", el("span", "text-gray-400", "@" + author.u));
+    li.append(row, meta);
+    return li;
+  }
+
+  function setOnline(count, on, off) {
+    const counter = document.getElementById("online-count");
+    if (counter) counter.textContent = count;
+    const icon = document.getElementById("online-icon");
+    if (icon) {
+      icon.classList.toggle("green-dot", count > 0);
+      icon.classList.toggle("gray-dot", count === 0);
+    }
+    for (const [ids, online] of [[on, true], [off, false]]) {
+      for (const id of ids) {
+        const dot = document.getElementById("member-dot-" + id);
+        if (!dot) continue;
+        dot.classList.toggle("green-dot", online);
+        dot.classList.toggle("gray-dot", !online);
+      }
+    }
+  }
+
+  function slowDown(retryAfter) {
+    const input = form.querySelector("input[name=body]");
+    const placeholder = input.placeholder;
+    input.placeholder = "Slow down, try again in " + Math.ceil(retryAfter) + "s";
+    setTimeout(function () { input.placeholder = placeholder; }, retryAfter * 1000);
+  }
+
+  function lastMessageId() {
+    const shown = messages.querySelectorAll("[data-message-id]");
+    return shown.length ? Number(shown[shown.length - 1].dataset.messageId) : null;
+  }
+
+  function reloadHint(text) {
+    const li = el("li", "text-gray-500 text-sm text-center p-2", text || "Some messages were missed while you were away. ");
+    const link = el("a", "underline", "Reload the history");
+    link.href = window.location.pathname;
+    li.appendChild(link);
+    return li;
+  }
+
+  // Tell the server how far the user has read (see ChatroomConsumer.read),
+  // at most once a second and only while the page is visible
+  function sendRead() {
+    if (readTimer) return;
+    readTimer = setTimeout(function () {
+      readTimer = null;
+      const lastId = lastMessageId();
+      if (lastId === null || document.visibilityState !== "visible") return;
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({ type: "read", last_id: lastId }));
+      }
+    }, 1000);
+  }
+
+  const handlers = {
+    hello(frame) {
+      me = frame.me;
+      setOnline(frame.c, frame.on, []);
+    },
+    m(frame) {
+      const placeholder = messages.querySelector("li.text-gray-400.text-center");
+      if (placeholder) placeholder.remove();
+      messages.appendChild(frame.a.id === me ? renderOwn(frame) : renderOther(frame));
+      scrollToBottom();
+      sendRead();
+    },
+    replay(frame) {
+      if (frame.more) messages.appendChild(reloadHint());
+      for (const message of frame.m) handlers.m(message);
+    },
+    p(frame) {
+      setOnline(frame.c, frame.on, frame.off);
+    },
+    r(frame) {
+      stopped = true;
+      window.location.href = frame.url;
+    },
+    e(frame) {
+      if (frame.code === "rate_limited") slowDown(frame.retry_after);
+    },
+  };
+
+  function connect() {
+    const scheme = window.location.protocol === "https:" ? "wss://" : "ws://";
+    socket = new WebSocket(scheme + window.location.host + form.dataset.wsUrl, ["chat.json.v1"]);
+    let opened = false;
+    socket.onopen = function () {
+      opened = true;
+      failedConnects = 0;
+      // Ask for whatever was sent while we were away (see ChatroomConsumer.resume)
+      socket.send(JSON.stringify({ type: "resume", last_id: lastMessageId() }));
+      sendRead();
+    };
+    socket.onmessage = function (e) {
+      const frame = JSON.parse(e.data);
+      const handler = handlers[frame.t];
+      if (handler) handler(frame);
+    };
+    socket.onclose = function (e) {
+      if (stopped) return;
+      if (FINAL_CLOSE_CODES.includes(e.code)) {
+        stopped = true;
+        messages.appendChild(reloadHint("The chat was disconnected. "));
+        return;
+      }
+      if (!opened && ++failedConnects >= MAX_FAILED_CONNECTS) {
+        stopped = true;
+        messages.appendChild(reloadHint("Could not reconnect to the chat. "));
+        return;
+      }
+      setTimeout(connect, retryDelay(failedConnects));
+    };
+  }
+
+  // Exponential backoff from 1s with full jitter, so clients dropped
+  // together don't all come back at the same moment
+  function retryDelay(failures) {
+    return Math.random() * Math.min(MAX_RETRY_DELAY, 1000 * 2 ** failures);
+  }
+
+  form.addEventListener("submit", function (e) {
+    e.preventDefault();
+    const input = form.querySelector("input[name=body]");
+    if (!input.value || !socket || socket.readyState !== WebSocket.OPEN) return;
+    socket.send(JSON.stringify({ body: input.value }));
+    form.reset();
+  });
+
+  document.addEventListener("visibilitychange", sendRead);
+  // Leaving the page closes the socket too
+  window.addEventListener("pagehide", function () { stopped = true; });
+  connect();
+})();